@@ -29,6 +29,7 @@ __DEFAULT_PLAYLIST_TIMEOUT = 120
 __DEFAULT_EPG_TIMEOUT = 120
 __DEFAULT_ICON_TIMEOUT = 15
 __DEFAULT_INTERNAL_TIMEOUT = 1
+__DEFAULT_HEARTBEAT_TIMEOUT = 30
 __DEFAULT_ALLOWED_URL_SCHEMES = ['http', 'https', 'mmsh', 'mmst', 'mmsu', 'mms', 'rtmp', 'rtsp']
 __DEFAULT_BLOCKED_PATH_TYPES = ['.m3u', '.m3u8', '.mpd']
 __DEFAULT_BLOCKED_URL_REGEXS = ['output=playlist.m3u[8]?', 'www.youtube.com/']
@@ -180,6 +181,7 @@ PLAYLIST_TIMEOUT = int(os.environ['PLAYLIST_TIMEOUT']) if 'PLAYLIST_TIMEOUT' in
 EPG_TIMEOUT = int(os.environ['EPG_TIMEOUT']) if 'EPG_TIMEOUT' in os.environ else __DEFAULT_EPG_TIMEOUT
 ICON_TIMEOUT = int(os.environ['ICON_TIMEOUT']) if 'ICON_TIMEOUT' in os.environ else __DEFAULT_ICON_TIMEOUT
 INTERNAL_TIMEOUT = int(os.environ['INTERNAL_TIMEOUT']) if 'INTERNAL_TIMEOUT' in os.environ else __DEFAULT_INTERNAL_TIMEOUT
+HEARTBEAT_TIMEOUT = int(os.environ['HEARTBEAT_TIMEOUT']) if 'HEARTBEAT_TIMEOUT' in os.environ else __DEFAULT_HEARTBEAT_TIMEOUT
 
 ALLOWED_URL_SCHEMES = os.environ['ALLOWED_URL_SCHEMES'].encode() if 'ALLOWED_URL_SCHEMES' in os.environ else __DEFAULT_ALLOWED_URL_SCHEMES
 BLOCKED_PATH_TYPES = os.environ['BLOCKED_PATH_TYPES'].encode() if 'BLOCKED_PATH_TYPES' in os.environ else __DEFAULT_BLOCKED_PATH_TYPES
@@ -206,6 +208,7 @@ logger.info(f'MANAGEMENT_URL: {MANAGEMENT_URL}')
 logger.info(f'INTERNAL_MANAGEMENT_PORT: {INTERNAL_MANAGEMENT_PORT}')
 logger.info(f'EXTERNAL_MANAGEMENT_PORT: {EXTERNAL_MANAGEMENT_PORT}')
 logger.info(f'INTERNAL_TIMEOUT: {INTERNAL_TIMEOUT}')
+logger.info(f'HEARTBEAT_TIMEOUT: {HEARTBEAT_TIMEOUT}')
 
 # Upstream connection filter
 logger.info(f'ALLOWED_URL_SCHEMES: {ALLOWED_URL_SCHEMES}')
@@ -7,6 +7,7 @@ from django.conf import settings
 from manager.models import iptvUpstreamPlaylist, iptvChannel, iptvGroup
 
 from lib.upstream_playlist_helper import UpstreamPlaylistHelper
+from lib.hash_ring import HashRing
 
 __playlist_dir__ = f'{settings.STATIC_ROOT}/playlists'
 __downstream_playlist_dir__ = f'{__playlist_dir__}/downstream'
@@ -26,16 +27,35 @@ class DownstreamPlaylistHelper():
     playlist_filepath = ''
     playlist_filter = ''
     playlist_filtermode = ''
+    playlist_output_format = ''
+    playlist_stream_prefix = ''
+    playlist_ring = None
 
     def __init__(self, playlist):
         self.playlist = playlist
         self.playlist_name = playlist.name
-        self.playlist_proxy_url = playlist.proxy.url
-        self.playlist_proxy_port = playlist.proxy.port
+        self.playlist_stream_prefix = f'{playlist.proxy.url}:{playlist.proxy.port}/stream'
+        if playlist.pk is not None and playlist.proxy_pool.exists():
+            if playlist.pool_routing == 'C':
+                # Channels are spread over the alive proxies of the pool, the playlist's proxy only stands in if none is alive
+                self.playlist_ring = HashRing(playlist.alive_pool() or [playlist.proxy])
+            else:
+                # Stream starts go through the manager, which redirects them to a proxy of the pool
+                self.playlist_stream_prefix = f'{settings.MANAGEMENT_URL}:{settings.EXTERNAL_MANAGEMENT_PORT}/manager/redirect/{playlist.pk}'
         self.playlist_filename = base64.b64encode(playlist.name.encode('utf-8')).decode('utf-8')
         self.playlist_filepath = f'{__downstream_playlist_dir__}/{self.playlist_filename}.m3u'
         self.playlist_filter = playlist.channel_filter
         self.playlist_filtermode = playlist.filter_mode
+        self.playlist_output_format = playlist.output_format
+
+    def stream_prefix(self, channel):
+        """
+        Where the playlist entry of channel points to, up to the stream action
+        """
+        if self.playlist_ring is None:
+            return self.playlist_stream_prefix
+        proxy = self.playlist_ring.get(channel.url)
+        return f'{proxy.url}:{proxy.port}/stream'
 
     def delete_playlist(self):
         logger.info(f'DOWNSTREAM {self.playlist.name}: Received delete request')
@@ -67,8 +87,13 @@ class DownstreamPlaylistHelper():
                     logo_url_encoded = base64.b64encode(channel.tvg_logo.url.encode('utf-8')).decode('utf-8') if channel.tvg_logo else None
                     proxy_logo_url = f'{settings.MANAGEMENT_URL}:{settings.EXTERNAL_MANAGEMENT_PORT}/manager/get/icon/{logo_url_encoded}' if logo_url_encoded else ''
 
-                    channel_url_encoded = base64.b64encode(channel.url.encode('utf-8')).decode('utf-8')
-                    proxy_channel_url = f'{self.playlist_proxy_url}:{self.playlist_proxy_port}/stream/start/{channel_url_encoded}'
+                    if self.playlist_output_format == 'H':
+                        # URL safe, as the proxy serves the segments below the channel's path
+                        channel_url_encoded = base64.urlsafe_b64encode(channel.url.encode('utf-8')).decode('utf-8').rstrip('=')
+                        proxy_channel_url = f'{self.stream_prefix(channel)}/live/{channel_url_encoded}/index.m3u8'
+                    else:
+                        channel_url_encoded = base64.b64encode(channel.url.encode('utf-8')).decode('utf-8')
+                        proxy_channel_url = f'{self.stream_prefix(channel)}/start/{channel_url_encoded}'
                     content += f'#EXTINF:-1 tvg-id="{channel.tvg_id}" tvg-name="{channel.tvg_name}" tvg-logo="{proxy_logo_url}" group-title="{channel.group_title}",{channel.name}\n'
                     content += f'{proxy_channel_url}\n'
 
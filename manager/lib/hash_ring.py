@@ -0,0 +1,33 @@
+import bisect
+import hashlib
+
+# Points per node on the ring, more spread the keys more evenly
+__virtual_nodes__ = 160
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing():
+    """
+    Consistent hashing of keys (e.g. channel URLs) onto nodes (e.g. proxies), nodes are identified by their name.
+    Adding or removing a node only moves the keys that map to it, about 1/n of them, all others keep their node.
+    """
+
+    points = None
+    nodes = None
+
+    def __init__(self, nodes):
+        self.nodes = {str(node): node for node in nodes}
+        self.points = sorted((_hash(f'{name}#{index}'), name) for name in self.nodes for index in range(__virtual_nodes__))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, key):
+        """
+        The node key maps to, the first point on the ring at or after the key's hash. None without any nodes.
+        """
+        if not self.points:
+            return None
+        index = bisect.bisect_left(self.points, (_hash(key), '')) % len(self.points)
+        return self.nodes[self.points[index][1]]
@@ -100,7 +100,7 @@ class UpstreamPlaylistHelper():
             fpath = self.playlist_filepath
 
         # Disable all channels prior to import to leave channels disabled that don't exist anymore
-        iptvChannel.objects.filter(upstream=self.playlist, protected=False).update(enabled=False)
+        iptvChannel.objects.filter(upstream=self.playlist, protected=False).update(enabled=False, modified=timezone.now())
 
         with open(fpath, 'r') as playlist:
             # Skip initial headers
@@ -228,7 +228,7 @@ class UpstreamPlaylistHelper():
                     # Otherwise check regular filters
                     else:
                         create_enabled = check_filters(url)
-                    asyncio.run(oldChan.aupdate(tvg_id = tvg_id, tvg_name = tvg_name, tvg_logo = fk_logo, extra_info = channel_extra, last_seen = timezone.now(), enabled = create_enabled))
+                    asyncio.run(oldChan.aupdate(tvg_id = tvg_id, tvg_name = tvg_name, tvg_logo = fk_logo, extra_info = channel_extra, last_seen = timezone.now(), modified = timezone.now(), enabled = create_enabled))
                     logger.info(f'UPSTREAM {self.playlist.name}: Updated channel "{name}"')
                 else:
                     create_enabled = check_filters(url)
@@ -1,10 +1,11 @@
-import base64
 import logging
 from enum import Enum
-from requests import get
+from requests import post
 
 from django.conf import settings
 from django.contrib import admin, messages
+from django.db.models import F
+from django.utils import timezone
 from django.utils.translation import ngettext
 
 from manager import views
@@ -57,11 +58,19 @@ def log_admin(level, instance, request, queryset, message):
         logger.critical(fstring)
 
 class iptvProxyAdmin(admin.ModelAdmin):
-    list_display = ('name', 'internal_url', 'internal_port', 'url', 'port')
+    def alive(self, obj):
+        return obj.is_alive()
+
+    alive.boolean = True
+    alive.short_description = 'Alive'
+
+    list_display = ('name', 'internal_url', 'internal_port', 'url', 'port', 'alive', 'draining', 'active_sessions', 'egress', 'cpu')
+    readonly_fields = ('last_heartbeat', 'draining', 'active_sessions', 'egress', 'egress_capacity', 'cpu')
     fieldsets = [
         ('Basic information', {'fields': ['name',]}),
         ('Session Control / Internal Network information', {'fields': ['internal_url', 'internal_port']}),
         ('Streaming Proxy / External Network information', {'fields': ['url', 'port']}),
+        ('Load', {'fields': ['last_heartbeat', 'draining', 'active_sessions', 'egress', 'egress_capacity', 'cpu']}),
     ]
     save_as = True
 
@@ -238,7 +247,7 @@ class iptvUpstreamPlaylistAdmin(admin.ModelAdmin):
     readonly_fields = ('last_update', 'num_filtered_groups')
     fieldsets = [
         ('Basic information', {'fields': ['enabled', 'name', 'is_local', 'update_interval', 'max_conns', 'in_use']}),
-        ('Network information', {'fields': ['path', 'user_agent']}),
+        ('Network information', {'fields': ['path', 'user_agent', 'mirrors']}),
         ('Filters', {'fields': ['group_filter']}),
     ]
     save_as = True
@@ -305,14 +314,16 @@ class iptvDownstreamPlaylistAdmin(admin.ModelAdmin):
     group_count.integer = True
     group_count.short_description = 'Included groups'
 
-    list_display = ('name', 'enabled', 'proxy', 'group_count', 'has_filters')
+    list_display = ('name', 'enabled', 'proxy', 'output_format', 'group_count', 'has_filters')
     actions = ['enable_downstream_playlists', 'disable_downstream_playlists', 'download_downstream_playlists']
     list_filter = ('enabled', 'proxy__name')
     search_fields = ['name', 'proxy__name', 'groups']
     fieldsets = [
-        ('Basic information', {'fields': ['enabled', 'name', 'proxy']}),
+        ('Basic information', {'fields': ['enabled', 'name', 'proxy', 'output_format']}),
+        ('Proxy pool', {'fields': ['proxy_pool', 'pool_routing']}),
         ('Channels', {'fields': ['groups', 'filter_mode', 'channel_filter']}),
     ]
+    filter_horizontal = ('proxy_pool', )
     save_as = True
 
 class iptvEPGAdmin(admin.ModelAdmin):
@@ -392,7 +403,7 @@ class iptvEPGAdmin(admin.ModelAdmin):
 class iptvChannelAdmin(admin.ModelAdmin):
     @admin.action(description='Enable channel(s)')
     def enable_channels(self, request, queryset):
-        count = queryset.update(enabled=True)
+        count = queryset.update(enabled=True, modified=timezone.now())
         self.message_user(request, ngettext(
             f'{count} channel enabled.',
             f'{count} channels enabled.',
@@ -402,7 +413,7 @@ class iptvChannelAdmin(admin.ModelAdmin):
 
     @admin.action(description='Disable channel(s)')
     def disable_channels(self, request, queryset):
-        count = queryset.update(enabled=False)
+        count = queryset.update(enabled=False, modified=timezone.now())
         self.message_user(request, ngettext(
             f'{count} channel disabled.',
             f'{count} channels disabled.',
@@ -608,22 +619,28 @@ class iptvSessionAdmin(admin.ModelAdmin):
         log_admin(LogLevel.INFO, self, request, queryset, 'Success')
 
     def delete_queryset(self, request, queryset):
-        for session in queryset:
+        # One bulk stop request per proxy instead of one request per session
+        sessions_by_proxy = {}
+        for session in queryset.select_related('proxy', 'channel'):
+            sessions_by_proxy.setdefault(session.proxy, []).append(session)
+        for proxy, sessions in sessions_by_proxy.items():
             # TODO: Static URL
-            stream_server_stop_endpoint = f'{session.proxy.internal_url}:{session.proxy.internal_port}/stream/stop/'
-
-            path = session.url
-            client = session.client_ip
-            ua_string = session.user_agent
-            upstream = session.channel.upstream
-            upstream.in_use = upstream.in_use - 1
-            upstream.save()
-            session_id = _session_id_string.format(path=path, client=client, ua_string=ua_string)
-            session_id_b64 = base64.b64encode(session_id.encode('utf-8')).decode('utf-8')
-            get(f'{stream_server_stop_endpoint}{session_id_b64}', allow_redirects=True, stream=True, timeout=settings.INTERNAL_TIMEOUT)
-            session.delete()
-            log_admin(LogLevel.DEBUG, self, request, queryset, f'Deleted session "{session}"')
+            stream_server_stop_endpoint = f'{proxy.internal_url}:{proxy.internal_port}/stream/stop/'
+            session_ids = [_session_id_string.format(path=session.url, client=session.client_ip) for session in sessions]
+            try:
+                result = post(stream_server_stop_endpoint, json={'sessions': session_ids}, allow_redirects=True, timeout=settings.INTERNAL_TIMEOUT).json()
+                stale = set(result['missing'])
+                log_admin(LogLevel.DEBUG, self, request, queryset, f'Stopped {len(result["stopped"])} session(s) on proxy "{proxy}"')
+            except Exception as err:
+                log_admin(LogLevel.WARNING, self, request, queryset, f'Could not stop sessions on proxy "{proxy}": {err}')
+                stale = set(session_ids)
+            for session, session_id in zip(sessions, session_ids):
+                # Stopped sessions free their line with the proxy's End report, sessions unknown to the proxy never will
+                if session_id in stale:
+                    iptvUpstreamPlaylist.objects.filter(pk=session.channel.upstream_id, in_use__gt=0).update(in_use=F('in_use') - 1)
+                    log_admin(LogLevel.WARNING, self, request, queryset, f'Session "{session}" was not running on proxy "{proxy}", released its line')
         log_admin(LogLevel.INFO, self, request, queryset, 'Success')
+        queryset.delete()
 
     list_display = ('client_ip', 'channel', 'user_agent', 'start_time', 'proxy')
     list_filter = ('client_ip', 'user_agent', 'proxy')
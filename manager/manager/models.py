@@ -1,12 +1,26 @@
+import datetime
+
+from django.conf import settings
 from django.db import models
 from django.utils import timezone
 
+# Load assumed per session of a proxy without any running yet
+_unknown_session_load = 0.01
+
 class iptvProxy(models.Model):
     name = models.CharField(primary_key=True, verbose_name='Proxy Name', max_length=255)
     internal_url = models.CharField(verbose_name='Internal URL', help_text='URI + hostname target to control the stream server, e.g. "http://myhost.mydomain.net"', max_length=255, default='http://localhost')
     internal_port = models.PositiveSmallIntegerField(verbose_name='Internal Port', default=8089)
     url = models.CharField(verbose_name='External URL', help_text='URI + hostname to use as prefix in playlists and EPGs, e.g. "http://myhost.mydomain.net"', max_length=255)
     port = models.PositiveSmallIntegerField(verbose_name='External Port', default=8089)
+    last_report_seq = models.BigIntegerField(verbose_name='Last report', help_text='Sequence number of the last session report applied', default=0, editable=False)
+    last_heartbeat = models.DateTimeField(verbose_name='Last heartbeat', blank=True, null=True, editable=False)
+    active_sessions = models.PositiveIntegerField(verbose_name='Sessions', help_text='Running sessions by the last heartbeat', default=0, editable=False)
+    egress = models.FloatField(verbose_name='Egress (Mbit/s)', help_text='Rate sent to clients by the last heartbeat', default=0, editable=False)
+    egress_capacity = models.FloatField(verbose_name='Egress capacity (Mbit/s)', help_text='Rate the proxy can send at most, 0 if unknown', default=0, editable=False)
+    cpu = models.FloatField(verbose_name='CPU (%)', help_text='CPU usage by the last heartbeat', default=0, editable=False)
+    draining = models.BooleanField(verbose_name='Draining', help_text='Shutting down, gets no new stream starts', default=False, editable=False)
+    redirected = models.PositiveIntegerField(verbose_name='Redirected', help_text='Stream starts redirected to the proxy since its last heartbeat', default=0, editable=False)
 
     class Meta:
         verbose_name = 'Upstream - Proxy Server'
@@ -15,6 +29,18 @@ class iptvProxy(models.Model):
     def __str__(self):
         return(self.name)
 
+    def is_alive(self):
+        return self.last_heartbeat is not None and self.last_heartbeat >= timezone.now() - datetime.timedelta(seconds=settings.HEARTBEAT_TIMEOUT)
+
+    def load(self):
+        """
+        Share of the proxy's capacity in use, by CPU or egress whichever is higher, as of its last heartbeat.
+        Streams redirected to it since are added at the load of its average session, so that a burst of starts is spread.
+        """
+        load = max(self.cpu / 100, self.egress / self.egress_capacity if self.egress_capacity > 0 else 0)
+        per_session = load / self.active_sessions if self.active_sessions > 0 else _unknown_session_load
+        return load + self.redirected * per_session
+
 class iptvUserAgent(models.Model):
     name = models.CharField(verbose_name='Name', max_length=255)
     ua_string = models.CharField(verbose_name='User Agent String', help_text='User agent string to send when requesting upstream resources', max_length=255, blank=True, default='')
@@ -37,6 +63,7 @@ class iptvUpstreamPlaylist(models.Model):
     last_update = models.DateTimeField(editable=False, blank=True, null=True)
     max_conns = models.SmallIntegerField(verbose_name='Max concurrent streams', default=0, null=False)
     in_use = models.SmallIntegerField(verbose_name='Active streams', default=0, null=False, editable=True)
+    mirrors = models.TextField(verbose_name='Mirrors', help_text='Alternative servers for the channels of this playlist, one "scheme://host:port" per line; the proxy fails over to them', blank=True, null=True)
     num_filtered_groups = models.SmallIntegerField(verbose_name='Filtered groups', help_text='Amount of filtered groups', null=False)
 
     class Meta:
@@ -70,7 +97,32 @@ class iptvDownstreamPlaylist(models.Model):
     name = models.CharField(max_length=255)
     groups = models.TextField(verbose_name='Playlist channel groups', help_text='Channel groups to include in this playlist', blank=True, null=True)
     channel_filter = models.TextField(verbose_name='Channel filters', help_text='Additionally filtered out channels', blank=True, null=True)
-    proxy = models.ForeignKey(iptvProxy, verbose_name='Proxy', help_text='Streaming proxy to use for playlist entries', on_delete=models.PROTECT, max_length=255, blank=False, null=False)
+    proxy = models.ForeignKey(iptvProxy, verbose_name='Proxy', help_text='Streaming proxy to use for playlist entries, or if none of the proxy pool is alive', on_delete=models.PROTECT, max_length=255, blank=False, null=False)
+    proxy_pool = models.ManyToManyField(iptvProxy, verbose_name='Proxy pool', help_text='Proxies to spread the streams of this playlist over, by the pool routing below', related_name='pool_playlists', blank=True)
+    POOL_ROUTING_CHOICES = [
+        ('L', 'Least loaded'),
+        ('C', 'Channel affinity'),
+    ]
+    pool_routing = models.CharField(
+        verbose_name='Pool routing',
+        help_text='Least loaded: entries point at the manager, which redirects each stream start to the least loaded proxy with a recent heartbeat. '
+                  'Channel affinity: each channel is assigned to one proxy with a recent heartbeat by consistent hashing, so that all its viewers share the upstream line of that proxy; '
+                  'proxies joining or leaving only move their share of the channels once players reload the playlist',
+        max_length=1,
+        choices=POOL_ROUTING_CHOICES,
+        default='L',
+    )
+    OUTPUT_FORMAT_CHOICES = [
+        ('T', 'MPEG-TS'),
+        ('H', 'HLS'),
+    ]
+    output_format = models.CharField(
+        verbose_name='Output format',
+        help_text='Stream format of the playlist entries; HLS needs the proxy to run in asyncio mode',
+        max_length=1,
+        choices=OUTPUT_FORMAT_CHOICES,
+        default='T',
+    )
 
     class Meta:
         verbose_name = 'Downstream - Playlist'
@@ -79,6 +131,12 @@ class iptvDownstreamPlaylist(models.Model):
     def __str__(self):
         return(self.name)
 
+    def alive_pool(self):
+        """
+        The proxies of the pool that sent a heartbeat within HEARTBEAT_TIMEOUT and aren't draining
+        """
+        return self.proxy_pool.filter(last_heartbeat__gte=timezone.now() - datetime.timedelta(seconds=settings.HEARTBEAT_TIMEOUT), draining=False)
+
 class iptvEPG(models.Model):
     enabled = models.BooleanField(verbose_name='Enabled', default=True)
     name = models.CharField(verbose_name='Name', max_length=255)
@@ -137,6 +195,7 @@ class iptvChannel(models.Model):
     added_on = models.DateTimeField(verbose_name='First import', auto_now_add=True, editable=False)
     extra_info = models.TextField(verbose_name='Additional info', max_length=255, blank=True, null=True)
     protected = models.BooleanField(verbose_name='Keep status', blank=False, default=False)
+    modified = models.DateTimeField(verbose_name='Last modified', help_text='Used by the proxies to replicate the channel catalog incrementally', auto_now=True, editable=False)
 
     class Meta:
         verbose_name = 'IPTV - Channel'
@@ -176,6 +235,7 @@ class iptvStat(models.Model):
     streamtime = models.CharField(verbose_name='Total stream time', max_length=15, editable=False)
     last_streamtime = models.CharField(verbose_name='Last stream duration', max_length=15, editable=False)
     last_access = models.DateTimeField(auto_now=True, verbose_name='Last streamed', editable=False)
+    hourly_streamtime = models.JSONField(verbose_name='Stream time per hour of day', help_text='Seconds watched per hour of the day, fading out over time; used by the proxies to pre-warm popular channels', default=list, editable=False)
 
     class Meta:
         verbose_name = 'Downstream - Stat'
@@ -1,3 +1,110 @@
-from django.test import TestCase
+import json
+import time
+import base64
 
-# Create your tests here.
+from django.test import TestCase, SimpleTestCase
+
+from lib.hash_ring import HashRing
+from manager.models import iptvProxy, iptvUpstreamPlaylist, iptvChannel, iptvSession, iptvStat
+
+_proxy = {'name': 'proxy-1', 'internal_url': 'http://proxy', 'internal_port': 8089, 'url': 'http://proxy', 'port': 8089}
+_channel_url = 'http://upstream/live.ts'
+
+class ReportBatchTests(TestCase):
+    """
+    Session report batches of the proxies, applied in sequence order and each event at most once
+    """
+
+    def setUp(self):
+        self.upstream = iptvUpstreamPlaylist.objects.create(name='Upstream', path='http://upstream/playlist.m3u', group_filter='', max_conns=2)
+        self.channel = iptvChannel.objects.create(name='Live', url=_channel_url, upstream=self.upstream)
+        self.stream_path = '/stream/start/' + base64.b64encode(_channel_url.encode('utf-8')).decode('ascii')
+
+    def event(self, seq, action, client='10.0.0.1', line=True, url=None):
+        return {'seq': seq, 'time': time.time(), 'action': action, 'client': client, 'user_agent': 'VLC', 'url': url or self.stream_path, 'line': line}
+
+    def post(self, *events):
+        return self.client.post('/manager/report/batch/', json.dumps({'proxy': _proxy, 'events': list(events)}), content_type='application/json')
+
+    def in_use(self):
+        return iptvUpstreamPlaylist.objects.get(pk=self.upstream.pk).in_use
+
+    def test_applies_events_in_sequence_order(self):
+        response = self.post(self.event(2, 'End'), self.event(1, 'Begin'))
+        self.assertEqual(response.json(), {'last_seq': 2, 'applied': 2})
+        self.assertEqual(self.in_use(), 0)
+        self.assertFalse(iptvSession.objects.exists())
+        self.assertTrue(iptvStat.objects.filter(channel=self.channel, client_ip='10.0.0.1').exists())
+        self.assertEqual(iptvProxy.objects.get(name='proxy-1').last_report_seq, 2)
+
+    def test_retried_batch_is_applied_once(self):
+        batch = [self.event(1, 'Begin'), self.event(2, 'Begin', client='10.0.0.2')]
+        self.assertEqual(self.post(*batch).json(), {'last_seq': 2, 'applied': 2})
+        # The proxy didn't get the answer and ships the same events again, followed by new ones
+        self.assertEqual(self.post(*batch, self.event(3, 'End')).json(), {'last_seq': 3, 'applied': 1})
+        self.assertEqual(self.in_use(), 1)
+        self.assertEqual(list(iptvSession.objects.values_list('client_ip', flat=True)), ['10.0.0.2'])
+
+    def test_shared_upstream_counts_one_line(self):
+        self.post(self.event(1, 'Begin'), self.event(2, 'Begin', client='10.0.0.2', line=False))
+        self.assertEqual(self.in_use(), 1)
+        self.assertEqual(iptvSession.objects.count(), 2)
+        self.post(self.event(3, 'End', line=False), self.event(4, 'End', client='10.0.0.2'))
+        self.assertEqual(self.in_use(), 0)
+        self.assertFalse(iptvSession.objects.exists())
+
+    def test_failing_event_does_not_roll_back_the_batch(self):
+        unknown = '/stream/start/' + base64.b64encode(b'http://upstream/deleted.ts').decode('ascii')
+        response = self.post(self.event(1, 'Begin'), self.event(2, 'Begin', url=unknown), self.event(3, 'Begin', client='10.0.0.2'))
+        # Skipped for good, a retry would fail the same way
+        self.assertEqual(response.json(), {'last_seq': 3, 'applied': 2})
+        self.assertEqual(self.in_use(), 2)
+
+    def test_sequence_numbers_are_per_proxy(self):
+        self.post(self.event(5, 'Begin'))
+        response = self.client.post('/manager/report/batch/', json.dumps({'proxy': dict(_proxy, name='proxy-2'), 'events': [self.event(1, 'Begin', client='10.0.0.2')]}), content_type='application/json')
+        self.assertEqual(response.json(), {'last_seq': 1, 'applied': 1})
+        self.assertEqual(self.in_use(), 2)
+
+    def test_malformed_batch_is_an_error(self):
+        response = self.client.post('/manager/report/batch/', json.dumps({'events': []}), content_type='application/json')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.client.get('/manager/report/batch/').status_code, 405)
+
+class HashRingTests(SimpleTestCase):
+    """
+    Routing of pooled playlist channels to proxies
+    """
+
+    keys = [f'http://upstream/{index}.ts' for index in range(2000)]
+
+    def test_without_nodes(self):
+        self.assertIsNone(HashRing([]).get('http://upstream/live.ts'))
+
+    def test_same_key_same_node(self):
+        ring = HashRing(['proxy-1', 'proxy-2', 'proxy-3'])
+        self.assertEqual([ring.get(key) for key in self.keys], [HashRing(['proxy-3', 'proxy-1', 'proxy-2']).get(key) for key in self.keys])
+
+    def test_keys_spread_over_the_nodes(self):
+        ring = HashRing(['proxy-1', 'proxy-2', 'proxy-3', 'proxy-4'])
+        counts = {}
+        for key in self.keys:
+            counts[ring.get(key)] = counts.get(ring.get(key), 0) + 1
+        self.assertEqual(len(counts), 4)
+        for count in counts.values():
+            self.assertGreater(count, len(self.keys) / 4 * 0.7)
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        before = HashRing(['proxy-1', 'proxy-2', 'proxy-3', 'proxy-4'])
+        after = HashRing(['proxy-1', 'proxy-2', 'proxy-4'])
+        for key in self.keys:
+            if before.get(key) != 'proxy-3':
+                self.assertEqual(after.get(key), before.get(key))
+            else:
+                self.assertNotEqual(after.get(key), 'proxy-3')
+
+    def test_nodes_are_returned_by_name(self):
+        proxies = [iptvProxy(name='proxy-1'), iptvProxy(name='proxy-2')]
+        node = HashRing(proxies).get('http://upstream/live.ts')
+        self.assertIn(node, proxies)
+        self.assertEqual(HashRing(list(reversed(proxies))).get('http://upstream/live.ts').name, node.name)
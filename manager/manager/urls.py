@@ -4,9 +4,14 @@ from manager import views
 
 urlpatterns = [
     path('report/', views.report_stream_session, name='report'),
+    path('report/batch/', views.report_stream_sessions, name='report_batch'), # ordered session report batches from the proxies
+    path('heartbeat/', views.proxy_heartbeat, name='heartbeat'), # load of the proxies, sent every few seconds
+    path('redirect/<int:playlist_id>/<path:target>', views.redirect_stream, name='redirect'), # stream start of a pooled playlist, redirected to /stream/<target> on the least loaded proxy
     path('get/icon/<str:name>', views.get_icon, name='get_icon'), # download icon (str is base64 encoded url of the icon)
     path('get/epg/<str:name>', views.get_epg, name='get_epg'), # download epg
     path('get/playlist/<str:name>', views.get_downstream_playlist, name='get_playlist'), # download playlist
     path('get/status/<str:url>', views.get_upstream_playlist_status, name='get_playlist_status'), # download playlist
     path('get/opts/<str:url>', views.get_channel_opts, name='get_channel_opts'), # get additional channel options
+    path('get/catalog/', views.get_catalog, name='get_catalog'), # bulk channel catalog for the proxies (?since=<version> for changes only)
+    path('get/popular/', views.get_popular_channels, name='get_popular_channels'), # channels most watched at this time of day, for pre-warming on the proxies (?count=<n>)
 ]
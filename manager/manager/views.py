@@ -1,3 +1,4 @@
+import json
 import base64
 import logging
 import datetime
@@ -5,7 +6,10 @@ import datetime
 import mimetypes
 from enum import Enum
 
-from django.http import HttpResponse, HttpResponseServerError, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseServerError, HttpResponseRedirect, HttpResponseNotAllowed, JsonResponse
+from django.db import transaction
+from django.db.models import Max, F
+from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 
 from .models import iptvUpstreamPlaylist, iptvDownstreamPlaylist, iptvEPG, iptvChannel, iptvIcon, iptvSession, iptvGroup, iptvUserAgent, iptvProxy, iptvStat
@@ -20,6 +24,7 @@ _session_id_string = '{path}' + _divider + '{client}'
 _status_string = '{current}' + _divider + '{pl_max}'
 _reportActionBegin = 'Begin'
 _reportActionEnd = 'End'
+_popularity_half_life = datetime.timedelta(days=7)
 
 logger = logging.getLogger(__name__)
 
@@ -74,24 +79,59 @@ def delete_icon(request, icon):
     log_view(LogLevel.INFO, request, f'Deleted icon {icon}')
     return HttpResponseRedirect(request.headers['Referer'])
 
-def report_stream_session(request):
-    url = request.headers['url'].removeprefix('/stream/').split('/')[1] # Remove leading "/stream/<action>/"
+def parse_streamtime(value):
+    """
+    Parses a stored streamtime (str() of a timedelta, e.g. "1 day, 2:03:04.500000") back into a timedelta
+    """
+    days = 0
+    if ',' in value:
+        day_part, value = value.split(',', 1)
+        days = int(day_part.split()[0])
+    hours, minutes, seconds = value.strip().split(':')
+    return datetime.timedelta(days=days, hours=int(hours), minutes=int(minutes), seconds=float(seconds))
+
+def popularity_decay(age):
+    """
+    Weight of viewing time that lies age in the past, halved every _popularity_half_life
+    """
+    return 0.5 ** (max(age.total_seconds(), 0) / _popularity_half_life.total_seconds())
+
+def add_hourly_streamtime(hourly, last_access, start, end):
+    """
+    Adds a session to the seconds watched per hour of the day (local time), after fading out the previous ones since last_access
+    """
+    decay = popularity_decay(end - last_access)
+    hourly = [seconds * decay for seconds in hourly] if len(hourly) == 24 else [0.0] * 24
+    current = timezone.localtime(start)
+    end = timezone.localtime(end)
+    while current < end:
+        next_hour = (current + datetime.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        hourly[current.hour] += (min(next_hour, end) - current).total_seconds()
+        current = next_hour
+    return hourly
+
+def register_proxy(request, name, internal_url, internal_port, url, port):
+    proxy_defaults = {
+        'internal_url':internal_url,
+        'internal_port':internal_port,
+        'url':url,
+        'port':port
+    }
+    proxy, created = iptvProxy.objects.update_or_create(name=name, defaults=proxy_defaults)
+    if created:
+        log_view(LogLevel.WARNING, request, f'Registered previously unknown proxy {name}')
+    return proxy
+
+def apply_session_report(request, proxy, action, url, client, ua_string, upstream_line, event_time):
+    url = url.removeprefix('/stream/').split('/')[1] # Remove leading "/stream/<action>/"
     log_view(LogLevel.INFO, request, f'URL: {url}')
     decoded = base64.b64decode(url.encode('utf-8') + b'==').decode('utf-8')
     log_view(LogLevel.INFO, request, f'Decoded: {decoded}')
     url = decoded.split(_divider)[0]
-    client = request.headers['client']
     session_id = _session_id_string.format(path=url, client=client)
 
-    ua_string = request.headers['user-agent']
     # TODO: add a prefix to the url that indicates the channel's parent upstream to allow for non-unique URLs
     channel = iptvChannel.objects.get(url=url)
-    action = request.headers['action']
-    proxy_name = request.headers['proxy-name']
-    proxy_url_internal = request.headers['proxy-url-internal']
-    proxy_port_internal = request.headers['proxy-port-internal']
-    proxy_url_external = request.headers['proxy-url-external']
-    proxy_port_external = request.headers['proxy-port-external']
 
     log_view(LogLevel.INFO, request, f'Received {action} report for session {session_id}')
     if iptvUserAgent.objects.filter(ua_string=ua_string).count() == 0:  # Create a User Agent entry on the fly if unknown
@@ -99,57 +139,154 @@ def report_stream_session(request):
         log_view(LogLevel.WARNING, request, f'Registered previously unknown user agent {ua_string}')
     user_agent = iptvUserAgent.objects.get(ua_string=ua_string)
 
-    proxy_defaults = {
-        'internal_url':proxy_url_internal,
-        'internal_port':proxy_port_internal,
-        'url':proxy_url_external,
-        'port':proxy_port_external
-    }
-    proxy, created = iptvProxy.objects.update_or_create(name=proxy_name, defaults=proxy_defaults)
-    if created:
-        log_view(LogLevel.WARNING, request, f'Registered previously unknown proxy {proxy_name}')
-
-    # This might fail if not ordered under heavy load, as we cannot guarantee that the create report is received before the creation on heavy channel zapping (need queue)
     if action == _reportActionBegin:
-        # increase usage counter
-        channel.upstream.in_use += 1
-        channel.upstream.save()
-        log_view(LogLevel.INFO, request, f'Increased connection count for {channel.upstream}, new value: {channel.upstream.in_use}')
-        #asyncio.run(iptvSession.objects.acreate(name=session_id, client_ip=client, user_agent=user_agent, start_time=datetime.datetime.now(), channel=channel, url=decoded, proxy=proxy))
-        iptvSession.objects.create(name=session_id, client_ip=client, user_agent=user_agent, start_time=datetime.datetime.now(), channel=channel, url=decoded, proxy=proxy)
+        # increase usage counter, viewers sharing an upstream connection on the proxy only count once against the playlist's lines
+        if upstream_line:
+            iptvUpstreamPlaylist.objects.filter(pk=channel.upstream_id).update(in_use=F('in_use') + 1)
+            log_view(LogLevel.INFO, request, f'Increased connection count for {channel.upstream}')
+        sess = iptvSession.objects.create(name=session_id, client_ip=client, user_agent=user_agent, channel=channel, url=decoded, proxy=proxy)
+        # start_time is set on creation, use the time the proxy saw the session start instead
+        iptvSession.objects.filter(pk=sess.pk).update(start_time=event_time)
         log_view(LogLevel.INFO, request, f'Added session {session_id}')
     if action == _reportActionEnd:
         # decrease usage counter
-        channel.upstream.in_use += - 1
-        channel.upstream.save()
-        log_view(LogLevel.INFO, request, f'Decreased connection count for {channel.upstream}, new value: {channel.upstream.in_use}')
+        if upstream_line:
+            iptvUpstreamPlaylist.objects.filter(pk=channel.upstream_id).update(in_use=F('in_use') - 1)
+            log_view(LogLevel.INFO, request, f'Decreased connection count for {channel.upstream}')
 
         sess = iptvSession.objects.filter(name=session_id, user_agent=user_agent, proxy=proxy)
+        if not sess:
+            log_view(LogLevel.WARNING, request, f'Tried removing non-existing session {session_id}')
+            return
         if iptvStat.objects.filter(channel=sess[0].channel, client_ip=sess[0].client_ip).exists():
             old_sess = iptvStat.objects.filter(channel=sess[0].channel, client_ip=sess[0].client_ip)
             prev_run_time = old_sess[0].streamtime
+            prev_hourly = old_sess[0].hourly_streamtime
+            prev_access = old_sess[0].last_access
         else:
             prev_run_time = '0:00:00.000000'
+            prev_hourly = []
+            prev_access = event_time
 
-        run_time = timezone.now() - sess[0].start_time
+        run_time = event_time - sess[0].start_time
 
-        t = datetime.datetime.strptime(prev_run_time, "%H:%M:%S.%f")
-        prev_run_time = datetime.timedelta(hours=t.hour, minutes=t.minute, seconds=t.second)
+        prev_run_time = parse_streamtime(prev_run_time)
         new_run_time = prev_run_time + run_time
 
         #stat, created = asyncio.run(iptvStat.objects.aupdate_or_create(channel=channel, client_ip=client))
         stat, created = iptvStat.objects.update_or_create(channel=channel, client_ip=client)
         stat.streamtime = str(new_run_time)
         stat.last_streamtime = run_time
+        stat.hourly_streamtime = add_hourly_streamtime(prev_hourly, prev_access, sess[0].start_time, event_time)
         stat.save()
-        if sess:
-            #asyncio.run(sess.adelete())
-            sess.delete()
-            log_view(LogLevel.INFO, request, f'Removed session {session_id}')
-        else:
-            log_view(LogLevel.WARNING, request, f'Tried removing non-existing session {session_id}')
+        #asyncio.run(sess.adelete())
+        sess.delete()
+        log_view(LogLevel.INFO, request, f'Removed session {session_id}')
+
+def report_stream_session(request):
+    proxy = register_proxy(request, request.headers['proxy-name'], request.headers['proxy-url-internal'], request.headers['proxy-port-internal'], request.headers['proxy-url-external'], request.headers['proxy-port-external'])
+    upstream_line = request.headers.get('upstream-line', 'True') == 'True'
+    # This might fail if not ordered under heavy load, as we cannot guarantee that the create report is received before the creation on heavy channel zapping (use report/batch/)
+    apply_session_report(request, proxy, request.headers['action'], request.headers['url'], request.headers['client'], request.headers['user-agent'], upstream_line, timezone.now())
     return HttpResponse()
 
+@csrf_exempt
+def report_stream_sessions(request):
+    """
+    Applies a batch of session reports from a proxy in a single transaction, ordered by the proxy's sequence numbers.
+    Events up to the proxy's last applied sequence number were already applied by an earlier attempt and are skipped.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        batch = json.loads(request.body)
+        with transaction.atomic():
+            proxy = register_proxy(request, **batch['proxy'])
+            last_seq = iptvProxy.objects.select_for_update().get(pk=proxy.pk).last_report_seq
+            applied = 0
+            for event in sorted(batch['events'], key=lambda event: event['seq']):
+                if event['seq'] <= last_seq:
+                    log_view(LogLevel.INFO, request, f'Skipping already applied report {event["seq"]} from {proxy}')
+                    continue
+                event_time = datetime.datetime.fromtimestamp(event['time'], tz=datetime.timezone.utc)
+                try:
+                    # A savepoint per event, so that a report for e.g. a deleted channel doesn't roll back the whole batch
+                    with transaction.atomic():
+                        apply_session_report(request, proxy, event['action'], event['url'], event['client'], event['user_agent'], event['line'], event_time)
+                    applied += 1
+                except Exception as err:
+                    log_view(LogLevel.WARNING, request, f'Report {event["seq"]} from {proxy} could not be applied:\n{err}')
+                last_seq = event['seq']
+            iptvProxy.objects.filter(pk=proxy.pk).update(last_report_seq=last_seq)
+        log_view(LogLevel.INFO, request, f'Applied {applied} of {len(batch["events"])} report(s) from {proxy}, last sequence number {last_seq}')
+        response = JsonResponse({'last_seq': last_seq, 'applied': applied})
+    except Exception as err:
+        response = HttpResponseServerError(f'Report batch error:\n{err}')
+        log_view(LogLevel.WARNING, request, f'Report batch error:\n{err}')
+    return response
+
+@csrf_exempt
+def proxy_heartbeat(request):
+    """
+    Registers a proxy and records its load sent every few seconds: running sessions, egress rate and capacity, CPU usage.
+    Proxies whose heartbeats stop are left out of the proxy pools after HEARTBEAT_TIMEOUT.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        heartbeat = json.loads(request.body)
+        proxy = register_proxy(request, **heartbeat['proxy'])
+        iptvProxy.objects.filter(pk=proxy.pk).update(last_heartbeat=timezone.now(), active_sessions=heartbeat['sessions'], egress=heartbeat['egress'],
+                                                     egress_capacity=heartbeat['egress_capacity'], cpu=heartbeat['cpu'], draining=heartbeat.get('draining', False), redirected=0)
+        if heartbeat.get('draining', False):
+            log_view(LogLevel.WARNING, request, f'Proxy {proxy} is draining, {heartbeat["sessions"]} session(s) left')
+        log_view(LogLevel.DEBUG, request, f'Heartbeat from {proxy}: {heartbeat["sessions"]} session(s), {heartbeat["egress"]:.1f} Mbit/s, {heartbeat["cpu"]:.1f}% CPU')
+        response = HttpResponse()
+    except Exception as err:
+        response = HttpResponseServerError(f'Heartbeat error:\n{err}')
+        log_view(LogLevel.WARNING, request, f'Heartbeat error:\n{err}')
+    return response
+
+def stream_target_url(target):
+    """
+    Channel URL of a proxy stream path below /stream/, i.e. start/<base64> or live/<URL safe base64>/<file>
+    """
+    action, encoded = target.split('/')[:2]
+    if action == 'live':
+        return base64.urlsafe_b64decode(encoded.encode('utf-8') + b'==').decode('utf-8').split(_divider)[0]
+    return base64.b64decode(encoded.encode('utf-8') + b'==').decode('utf-8').split(_divider)[0]
+
+def pick_proxy(playlist, client, target):
+    """
+    The proxy of the playlist's pool to send a stream start to: the one already streaming the channel to the client
+    (e.g. an HLS player reloading its playlist, or a reconnect), otherwise the least loaded one with a recent heartbeat.
+    Without any alive the playlist's own proxy.
+    """
+    alive = list(playlist.alive_pool())
+    if not alive:
+        return playlist.proxy
+    try:
+        session = iptvSession.objects.filter(client_ip=client, channel__url=stream_target_url(target), proxy__in=alive).first()
+    except ValueError:
+        session = None  # Not a channel path
+    if session is not None:
+        return session.proxy
+    return min(alive, key=lambda proxy: (proxy.load(), proxy.active_sessions + proxy.redirected))
+
+def redirect_stream(request, playlist_id, target):
+    try:
+        playlist = iptvDownstreamPlaylist.objects.get(pk=playlist_id, enabled=True)
+        client = request.headers.get('x-forwarded-for', request.META.get('REMOTE_ADDR', '')).split(',')[0].strip()
+        proxy = pick_proxy(playlist, client, target)
+        iptvProxy.objects.filter(pk=proxy.pk).update(redirected=F('redirected') + 1)
+        query = request.META.get('QUERY_STRING', '')
+        log_view(LogLevel.INFO, request, f'Redirecting {client} to {proxy} for {target}')
+        response = HttpResponseRedirect(f'{proxy.url}:{proxy.port}/stream/{target}' + (f'?{query}' if query else ''))
+    except Exception as err:
+        response = HttpResponseServerError(f'Redirect error:\n{err}')
+        log_view(LogLevel.WARNING, request, f'Redirect error:\n{err}')
+    return response
+
 def get_icon(request, name):
     try:
         decoded_url = base64.b64decode(name).decode('utf-8')
@@ -252,4 +389,56 @@ def get_channel_opts(request, url):
     except Exception as err:
         response = HttpResponseServerError(f'Upstream get opts error:\n{err}')
         log_view(LogLevel.WARNING, request, f'Upstream get opts error:\n{err}')
-    return response
\ No newline at end of file
+    return response
+
+def get_catalog(request):
+    """
+    Bulk channel catalog for the proxies' local admission checks and option lookups.
+    Upstreams and groups are always sent in full, channels only if modified since the "since" version when given.
+    """
+    try:
+        since = request.GET.get('since')
+        # Take the version before reading the channels so that concurrent modifications are sent again next time
+        latest = iptvChannel.objects.aggregate(latest=Max('modified'))['latest']
+        version = latest.timestamp() if latest is not None else 0
+        channels = iptvChannel.objects.all()
+        if since is not None:
+            channels = channels.filter(modified__gte=datetime.datetime.fromtimestamp(float(since), tz=datetime.timezone.utc))
+        catalog = {
+            'version': version,
+            'full': since is None,
+            'channel_count': iptvChannel.objects.values('url').distinct().count(),
+            'upstreams': list(iptvUpstreamPlaylist.objects.values('id', 'enabled', 'max_conns', 'in_use', 'mirrors')),
+            'groups': list(iptvGroup.objects.values('id', 'enabled')),
+            'channels': list(channels.values('url', 'name', 'extra_info', 'enabled', 'upstream_id', 'group_title_id', 'tvg_id')),
+        }
+        log_view(LogLevel.INFO, request, f'Transferred catalog version {version} with {len(catalog["channels"])} channel(s) (since: {since})')
+        response = JsonResponse(catalog)
+    except Exception as err:
+        response = HttpResponseServerError(f'Catalog get error:\n{err}')
+        log_view(LogLevel.WARNING, request, f'Catalog get error:\n{err}')
+    return response
+
+def get_popular_channels(request):
+    """
+    Channels ranked by recent viewing at the current hour of the day, the neighbouring hours counting half, for the proxies' pre-warming.
+    The list is limited to "count" channels (default 10).
+    """
+    try:
+        count = int(request.GET.get('count', 10))
+        now = timezone.now()
+        hour = timezone.localtime(now).hour
+        scores = {}
+        for stat in iptvStat.objects.filter(channel__enabled=True).values('channel__url', 'hourly_streamtime', 'last_access'):
+            hourly = stat['hourly_streamtime']
+            if len(hourly) != 24:
+                continue
+            score = (hourly[hour] + (hourly[hour - 1] + hourly[(hour + 1) % 24]) / 2) * popularity_decay(now - stat['last_access'])
+            scores[stat['channel__url']] = scores.get(stat['channel__url'], 0) + score
+        ranked = sorted(((score, url) for url, score in scores.items() if score > 0), reverse=True)[:count]
+        log_view(LogLevel.INFO, request, f'Transferred {len(ranked)} popular channel(s) for hour {hour}')
+        response = JsonResponse({'hour': hour, 'channels': [{'url': url, 'score': round(score)} for score, url in ranked]})
+    except Exception as err:
+        response = HttpResponseServerError(f'Popular channels get error:\n{err}')
+        log_view(LogLevel.WARNING, request, f'Popular channels get error:\n{err}')
+    return response
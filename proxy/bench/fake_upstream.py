@@ -0,0 +1,264 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+
+from urllib.parse import urlparse, parse_qs
+
+from lib.ts import TS_PACKET_SIZE, SYNC_BYTE, PAT_PID
+
+logger = logging.getLogger(__name__)
+
+_pmt_pid = 0x1000
+_video_pid = 0x100
+# Continuity counters wrap at 16, so a cycle of 16 seconds with one PAT/PMT per second repeats seamlessly
+_cycle_seconds = 16
+# Pieces a second of stream is written in
+_slices_per_second = 10
+
+def _crc32(data):
+    """
+    CRC-32/MPEG-2 of a PSI section
+    """
+    crc = 0xffffffff
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7) if crc & 0x80000000 else crc << 1
+            crc &= 0xffffffff
+    return crc
+
+def _section_packet(pid, continuity, section):
+    section += _crc32(section).to_bytes(4, 'big')
+    header = bytes((SYNC_BYTE, 0x40 | (pid >> 8), pid & 0xff, 0x10 | continuity, 0))  # Payload unit start, pointer field 0
+    return (header + section).ljust(TS_PACKET_SIZE, b'\xff')
+
+def _pat(continuity):
+    programs = (1).to_bytes(2, 'big') + (0xe000 | _pmt_pid).to_bytes(2, 'big')
+    section = bytes((0x00, 0xb0, 5 + len(programs) + 4, 0, 1, 0xc1, 0, 0)) + programs
+    return _section_packet(PAT_PID, continuity, section)
+
+def _pmt(continuity):
+    streams = bytes((0x1b, 0xe0 | (_video_pid >> 8), _video_pid & 0xff, 0xf0, 0))  # H.264 video, no descriptors
+    body = (0xe000 | _video_pid).to_bytes(2, 'big') + b'\xf0\x00' + streams  # PCR PID, no program info
+    section = bytes((0x02, 0xb0, 5 + len(body) + 4, 0, 1, 0xc1, 0, 0)) + body
+    return _section_packet(_pmt_pid, continuity, section)
+
+def _video(continuity, keyframe):
+    if keyframe:
+        # Adaptation field flagging the random access point, followed by the start of a PES packet
+        header = bytes((SYNC_BYTE, 0x40 | (_video_pid >> 8), _video_pid & 0xff, 0x30 | continuity, 1, 0x40))
+        payload = b'\x00\x00\x01\xe0\x00\x00\x80\x00\x00' + b'\x00\x00\x00\x01\x65'
+    else:
+        header = bytes((SYNC_BYTE, _video_pid >> 8, _video_pid & 0xff, 0x10 | continuity))
+        payload = b''
+    return (header + payload).ljust(TS_PACKET_SIZE, b'\xa5')
+
+def synthetic_ts(bitrate, gop=1):
+    """
+    _cycle_seconds of MPEG-TS at bitrate kbit/s as one second long blocks: PAT and PMT every second, a keyframe every gop seconds.
+    Played in a loop the continuity counters stay continuous.
+    """
+    packets = max(int(bitrate * 1000 / 8 / TS_PACKET_SIZE), 3)
+    video_count = 0
+    blocks = []
+    for second in range(_cycle_seconds):
+        block = [_pat(second % 16), _pmt(second % 16)]
+        for index in range(packets - 2):
+            block.append(_video(video_count % 16, index == 0 and second % gop == 0))
+            video_count += 1
+        blocks.append(b''.join(block))
+    return blocks
+
+class FakeUpstream():
+    """
+    Serves synthetic MPEG-TS in real time at any path, e.g. /channel/1.ts. Connections are answered after latency milliseconds;
+    error_rate of them are refused with 503 and drop_rate of them are cut off after a random time, as unreliable providers do.
+    """
+
+    blocks = None
+    latency = 0
+    error_rate = 0
+    drop_rate = 0
+    connections = 0
+
+    def __init__(self, bitrate, latency=0, error_rate=0, drop_rate=0, gop=1):
+        self.blocks = synthetic_ts(bitrate, gop)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            await read_request(reader)
+            if self.latency > 0:
+                await asyncio.sleep(self.latency / 1000)
+            roll = random.random()
+            if roll < self.error_rate:
+                writer.write(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+                return
+            drop_at = time.monotonic() + random.uniform(1, 30) if roll < self.error_rate + self.drop_rate else None
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: video/mp2t\r\nConnection: close\r\n\r\n')
+            await self.play(writer, drop_at)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def play(self, writer, drop_at):
+        started = time.monotonic()
+        sent = 0
+        # Start at a random second, so that channels don't all begin with a keyframe
+        offset = random.randrange(len(self.blocks))
+        while drop_at is None or time.monotonic() < drop_at:
+            block = self.blocks[(offset + sent // _slices_per_second) % len(self.blocks)]
+            piece = len(block) // TS_PACKET_SIZE // _slices_per_second * TS_PACKET_SIZE
+            index = sent % _slices_per_second
+            writer.write(block[index * piece:] if index == _slices_per_second - 1 else block[index * piece:(index + 1) * piece])
+            await writer.drain()
+            sent += 1
+            # Paced against the start time, so that slow writes don't lower the bitrate
+            delay = started + sent / _slices_per_second - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+class FakeManager():
+    """
+    Stands in for the manager endpoints the proxy calls: session reports, heartbeats, line status, channel options, the channel catalog
+    and the popular channels for pre-warming. Every line is available, the catalog lists the bench channels of one upstream playlist
+    without a connection limit and the popular channels are the first ones of the catalog.
+    """
+
+    channels = None
+    latency = 0
+    reports = 0
+    heartbeats = 0
+
+    def __init__(self, channels, latency=0):
+        self.channels = channels
+        self.latency = latency
+        self.reports = 0
+        self.heartbeats = 0
+
+    def catalog(self):
+        return {
+            'version': 1.0,
+            'full': True,
+            'channel_count': len(self.channels),
+            'upstreams': [{'id': 1, 'enabled': True, 'max_conns': 0, 'in_use': 0, 'mirrors': ''}],
+            'groups': [{'id': 1, 'enabled': True}],
+            'channels': [{'url': url, 'extra_info': '', 'enabled': True, 'upstream_id': 1, 'group_title_id': 1, 'tvg_id': ''} for url in self.channels],
+        }
+
+    def popular(self, count):
+        return {
+            'hour': time.localtime().tm_hour,
+            'channels': [{'url': url, 'score': len(self.channels) - rank} for rank, url in enumerate(self.channels[:count])],
+        }
+
+    def answer(self, method, target, body):
+        if target.startswith('/manager/report/batch/'):
+            events = json.loads(body)['events']
+            self.reports += len(events)
+            return 'application/json', json.dumps({'last_seq': max((event['seq'] for event in events), default=0), 'applied': len(events)})
+        if target.startswith('/manager/report/'):
+            self.reports += 1
+            return 'text/plain', ''
+        if target.startswith('/manager/heartbeat/'):
+            self.heartbeats += 1
+            return 'text/plain', ''
+        if target.startswith('/manager/get/popular/'):
+            count = parse_qs(urlparse(target).query).get('count', ['10'])[0]
+            return 'application/json', json.dumps(self.popular(int(count)))
+        if target.startswith('/manager/get/status/'):
+            return 'text/plain', 'True'
+        if target.startswith('/manager/get/opts/'):
+            return 'text/plain', ''
+        if target.startswith('/manager/get/catalog/'):
+            return 'application/json', json.dumps(self.catalog())
+        return None
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    return
+                method, target, body = request
+                if self.latency > 0:
+                    await asyncio.sleep(self.latency / 1000)
+                answer = self.answer(method, target, body)
+                if answer is None:
+                    writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                else:
+                    content_type, text = answer
+                    data = text.encode('utf-8')
+                    writer.write(f'HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(data)}\r\n\r\n'.encode('ascii') + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+async def read_request(reader):
+    """
+    Reads one HTTP request, returns (method, target, body) or None once the client closed the connection
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as err:
+        if not err.partial:
+            return None
+        raise
+    lines = head.decode('latin-1').split('\r\n')
+    method, target = lines[0].split(' ')[:2]
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    body = await reader.readexactly(length) if length else b''
+    return method, target, body
+
+def channel_urls(host, port, count):
+    return [f'http://{host}:{port}/channel/{number}.ts' for number in range(1, count + 1)]
+
+async def serve(args):
+    upstream = FakeUpstream(args.bitrate, args.latency, args.error_rate, args.drop_rate, args.gop)
+    manager = FakeManager(channel_urls(args.host, args.port, args.channels), args.manager_latency)
+    upstream_server = await asyncio.start_server(upstream.handle, args.host, args.port, backlog=4096)
+    manager_server = await asyncio.start_server(manager.handle, args.host, args.manager_port, backlog=4096)
+    logger.info(f'FAKE_UPSTREAM: Serving {args.channels} channel(s) at {args.bitrate} kbit/s on {args.host}:{args.port}, manager on {args.host}:{args.manager_port}')
+    async with upstream_server, manager_server:
+        await asyncio.gather(upstream_server.serve_forever(), manager_server.serve_forever())
+
+def add_arguments(parser):
+    parser.add_argument('--host', default='127.0.0.1', help='Address the fake upstream and manager listen on')
+    parser.add_argument('--port', type=int, default=18080, help='Port of the fake upstream')
+    parser.add_argument('--manager-port', type=int, default=18088, help='Port of the fake manager')
+    parser.add_argument('--channels', type=int, default=50, help='Number of channels in the fake catalog')
+    parser.add_argument('--bitrate', type=int, default=4000, help='Bitrate of every channel in kbit/s')
+    parser.add_argument('--gop', type=int, default=1, help='Seconds between keyframes')
+    parser.add_argument('--latency', type=int, default=0, help='Milliseconds before the upstream answers a request')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of upstream requests refused with 503')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Share of upstream connections cut off after 1-30 seconds')
+    parser.add_argument('--manager-latency', type=int, default=0, help='Milliseconds before the fake manager answers')
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake MPEG-TS upstream and manager for benchmarking the proxy')
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s]: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', stream=sys.stdout)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
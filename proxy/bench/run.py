@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+
+from bench.fake_upstream import add_arguments, channel_urls
+from bench.viewers import ViewerPool, ZAP_PATTERNS, percentile
+
+_proxy_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_ticks = os.sysconf('SC_CLK_TCK')
+_page_size = os.sysconf('SC_PAGE_SIZE')
+_startup_timeout = 15
+
+# Compared against a baseline, with whether a higher value is better
+_compared = (
+    ('throughput_mbit', True),
+    ('ttfb_p50_ms', False),
+    ('ttfb_p99_ms', False),
+    ('cpu_per_gbit', False),
+    ('memory_per_session_kib', False),
+    ('error_count', False),
+)
+
+class ProcessTree():
+    """
+    CPU time and memory of a process and all its descendants (e.g. proxy workers), read from /proc
+    """
+
+    pid = 0
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def _stats(self):
+        stats = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as stat_file:
+                    stat = stat_file.read()
+            except OSError:
+                continue  # Exited meanwhile
+            # The command name in parentheses may contain spaces
+            stats[int(entry)] = stat[stat.rindex(')') + 2:].split()
+        return stats
+
+    def sample(self):
+        """
+        Returns (CPU seconds, resident bytes) summed over the tree
+        """
+        stats = self._stats()
+        members = {self.pid}
+        grown = True
+        while grown:
+            children = {pid for pid, fields in stats.items() if int(fields[1]) in members} - members
+            members |= children
+            grown = bool(children)
+        cpu = sum(int(stats[pid][11]) + int(stats[pid][12]) for pid in members if pid in stats) / _ticks
+        rss = sum(int(stats[pid][21]) for pid in members if pid in stats) * _page_size
+        return cpu, rss
+
+def wait_port(host, port, process=None):
+    deadline = time.monotonic() + _startup_timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'{process.args} exited with {process.returncode}')
+        try:
+            socket.create_connection((host, port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Nothing listens on {host}:{port} after {_startup_timeout} seconds')
+
+def start_fake_upstream(args):
+    command = [sys.executable, '-m', 'bench.fake_upstream', '--host', args.host, '--port', str(args.port), '--manager-port', str(args.manager_port),
+               '--channels', str(args.channels), '--bitrate', str(args.bitrate), '--gop', str(args.gop), '--latency', str(args.latency),
+               '--error-rate', str(args.error_rate), '--drop-rate', str(args.drop_rate), '--manager-latency', str(args.manager_latency)]
+    process = subprocess.Popen(command, cwd=_proxy_dir, stdout=subprocess.DEVNULL)
+    wait_port(args.host, args.port, process)
+    wait_port(args.host, args.manager_port, process)
+    return process
+
+def start_proxy(args, log):
+    env = dict(os.environ)
+    env.update({
+        'DEBUG': 'False',  # No reloader process
+        'PROXY_MODE': args.mode,
+        'REPORTING_URL': f'http://{args.host}',
+        'REPORTING_PORT': str(args.manager_port),
+        'INTERNAL_PROXY_PORT': str(args.proxy_port),
+        'EXTERNAL_PROXY_PORT': str(args.proxy_port),
+    })
+    env.update(setting.split('=', 1) for setting in args.env)
+    process = subprocess.Popen([sys.executable, 'proxy.py'], cwd=_proxy_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wait_port(args.host, args.proxy_port, process)
+    return process
+
+def stop(process):
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def measure(args, tree):
+    """
+    Runs the viewers and samples the proxy while they watch, returns the results
+    """
+    idle = tree.sample() if tree is not None else None
+    start = time.time() + 1
+    window = (start, start + args.ramp, start + args.ramp + args.duration)
+    pool = ViewerPool()
+    pool.start(args.viewers, args.target, channel_urls(args.host, args.port, args.channels),
+               {'pattern': args.pattern, 'zipf': args.zipf, 'ramp': args.ramp}, window, args.processes)
+
+    samples = []
+    time.sleep(max(window[1] - time.time(), 0))
+    while tree is not None and time.time() < window[2]:
+        samples.append(tree.sample())
+        time.sleep(min(1, max(window[2] - time.time(), 0)))
+    if tree is not None:
+        samples.append(tree.sample())
+    seen = pool.collect()
+
+    ttfb = seen['ttfb']
+    gbits = seen['window_received'] * 8 / 1e9
+    results = {
+        'viewers': args.viewers,
+        'pattern': args.pattern,
+        'mode': args.mode if tree is not None else None,
+        'bitrate_kbit': args.bitrate,
+        'env': args.env,
+        'starts': seen['starts'],
+        'throughput_mbit': seen['window_received'] * 8 / args.duration / 1e6,
+        'expected_mbit': args.viewers * args.bitrate / 1000,
+        'ttfb_p50_ms': percentile(ttfb, 0.5) * 1000 if ttfb else None,
+        'ttfb_p99_ms': percentile(ttfb, 0.99) * 1000 if ttfb else None,
+        'errors': seen['errors'],
+        'error_count': sum(seen['errors'].values()),
+        'cpu_per_gbit': None,
+        'memory_per_session_kib': None,
+    }
+    if tree is not None and samples:
+        cpu = samples[-1][0] - samples[0][0]
+        peak = max(rss for _, rss in samples)
+        results.update({
+            'cpu_cores': cpu / args.duration,
+            # CPU seconds spent per Gbit sent, i.e. the cores it takes to serve 1 Gbit/s
+            'cpu_per_gbit': cpu / gbits if gbits else None,
+            'proxy_rss_idle_mib': idle[1] / 2 ** 20,
+            'proxy_rss_peak_mib': peak / 2 ** 20,
+            'memory_per_session_kib': (peak - idle[1]) / args.viewers / 1024,
+        })
+    return results
+
+def _format(value):
+    if value is None:
+        return '-'
+    return f'{value:.2f}' if isinstance(value, float) else str(value)
+
+def report(results, baseline=None):
+    lines = [
+        f'Viewers:            {results["viewers"]} ({results["pattern"]}), {results["starts"]} start(s)',
+        f'Throughput:         {_format(results["throughput_mbit"])} Mbit/s (expected {_format(results["expected_mbit"])})',
+        f'Time to first byte: p50 {_format(results["ttfb_p50_ms"])} ms, p99 {_format(results["ttfb_p99_ms"])} ms',
+        f'Errors:             {results["error_count"]} {results["errors"] or ""}',
+    ]
+    if results['cpu_per_gbit'] is not None or results['memory_per_session_kib'] is not None:
+        lines += [
+            f'CPU:                {_format(results.get("cpu_cores"))} core(s), {_format(results["cpu_per_gbit"])} CPU seconds per Gbit',
+            f'Memory:             {_format(results.get("proxy_rss_idle_mib"))} MiB idle, {_format(results.get("proxy_rss_peak_mib"))} MiB peak, {_format(results["memory_per_session_kib"])} KiB per session',
+        ]
+    if baseline is not None:
+        lines.append('Against baseline:')
+        for key, higher_is_better in _compared:
+            before, after = baseline.get(key), results.get(key)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before else 0
+            verdict = 'better' if (change > 0) == higher_is_better else 'worse'
+            lines.append(f'  {key:24} {_format(before):>10} -> {_format(after):>10} ({change:+.1f}%{", " + verdict if abs(change) >= 5 else ""})')
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the proxy with simulated viewers and a local fake TS upstream and manager')
+    add_arguments(parser)
+    parser.add_argument('--viewers', type=int, default=100, help='Number of concurrent viewers')
+    parser.add_argument('--pattern', choices=ZAP_PATTERNS, default='zap', help='How often viewers switch channels')
+    parser.add_argument('--zipf', type=float, default=1.0, help='Skew of channel popularity, 0 picks channels uniformly')
+    parser.add_argument('--ramp', type=float, default=10, help='Seconds over which the viewers start, not measured')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds measured after the ramp-up')
+    parser.add_argument('--processes', type=int, default=max((os.cpu_count() or 1) // 2, 1), help='Processes running the viewers')
+    parser.add_argument('--mode', choices=('flask', 'asyncio'), default='asyncio', help='PROXY_MODE of the proxy under test')
+    parser.add_argument('--proxy-port', type=int, default=18089, help='Port the proxy under test listens on')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='Further proxy setting, may be given several times')
+    parser.add_argument('--target', help='URL of an already running proxy to test instead, e.g. http://10.0.0.2:8089, which must reach --host (no CPU and memory figures)')
+    parser.add_argument('--proxy-log', default=os.devnull, help='File the proxy output is written to')
+    parser.add_argument('--json', help='File the results are written to, for use as a later baseline')
+    parser.add_argument('--baseline', help='Results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    upstream = proxy = None
+    try:
+        upstream = start_fake_upstream(args)
+        tree = None
+        if args.target is None:
+            with open(args.proxy_log, 'w') as log:
+                proxy = start_proxy(args, log)
+            args.target = f'http://{args.host}:{args.proxy_port}'
+            tree = ProcessTree(proxy.pid)
+            # Let the proxy pick up the catalog before the first viewer arrives
+            time.sleep(2)
+        results = measure(args, tree)
+    finally:
+        stop(proxy)
+        stop(upstream)
+
+    print(report(results, baseline))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import time
+import base64
+import random
+import asyncio
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+# Zap patterns: seconds a viewer stays on a channel before switching, as (minimum, maximum)
+ZAP_PATTERNS = {
+    'steady': None,  # Stays on the first channel for the whole run
+    'zap': (20, 60),
+    'surf': (1, 4),  # Flips through channels, e.g. a channel list on a remote
+}
+
+def stream_path(channel):
+    return f'/stream/start/{base64.b64encode(channel.encode("utf-8")).decode("ascii")}'
+
+def percentile(values, share):
+    """
+    Nearest-rank percentile of values, None without any
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(share * len(ordered)), len(ordered) - 1)]
+
+class ViewerStats():
+    """
+    What the viewers of one process saw: time to first byte of every start, bytes received and failures by kind
+    """
+
+    ttfb = None
+    errors = None
+    received = 0
+    window_received = 0
+    starts = 0
+
+    def __init__(self):
+        self.ttfb = []
+        self.errors = {}
+        self.received = 0
+        self.window_received = 0
+        self.starts = 0
+
+    def failed(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def as_dict(self):
+        return {'ttfb': self.ttfb, 'errors': self.errors, 'received': self.received, 'window_received': self.window_received, 'starts': self.starts}
+
+class Viewer():
+    """
+    A player watching channels through the proxy under its own client address, switching channels by its zap pattern.
+    Channels are picked by a Zipf distribution, a few popular channels draw most viewers as on a real proxy.
+    """
+
+    number = 0
+    host = ''
+    port = 0
+    channels = None
+    weights = None
+    pattern = None
+    stats = None
+
+    def __init__(self, number, proxy, channels, weights, pattern, stats):
+        self.number = number
+        self.host, self.port = proxy.removeprefix('http://').rsplit(':', 1)
+        self.channels = channels
+        self.weights = weights
+        self.pattern = ZAP_PATTERNS[pattern]
+        self.stats = stats
+
+    @property
+    def client(self):
+        return f'10.{(self.number >> 16) & 0xff}.{(self.number >> 8) & 0xff}.{self.number & 0xff}'
+
+    async def watch(self, until):
+        while time.monotonic() < until:
+            channel = random.choices(self.channels, self.weights)[0]
+            dwell = until - time.monotonic() if self.pattern is None else random.uniform(*self.pattern)
+            await self.play(channel, min(time.monotonic() + dwell, until))
+
+    async def play(self, channel, until):
+        started = time.monotonic()
+        self.stats.starts += 1
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, int(self.port)), 10)
+            writer.write(f'GET {stream_path(channel)} HTTP/1.1\r\nHost: {self.host}\r\nUser-Agent: iptv-proxy-bench\r\nX-Forwarded-For: {self.client}\r\n\r\n'.encode('ascii'))
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 30)
+            status = head.split(b' ', 2)[1].decode('ascii')
+            if status != '200':
+                self.stats.failed(f'http_{status}')
+                # Players retry after a moment
+                await asyncio.sleep(min(1, max(until - time.monotonic(), 0)))
+                return
+            first = True
+            while time.monotonic() < until:
+                data = await asyncio.wait_for(reader.read(262144), 30)
+                if not data:
+                    if time.monotonic() < until - 1:
+                        self.stats.failed('closed')
+                    return
+                if first:
+                    self.stats.ttfb.append(time.monotonic() - started)
+                    first = False
+                self.stats.received += len(data)
+        except asyncio.TimeoutError:
+            self.stats.failed('timeout')
+        except (ConnectionError, OSError, asyncio.IncompleteReadError) as err:
+            self.stats.failed(type(err).__name__)
+        finally:
+            if writer is not None:
+                writer.close()
+
+async def _run_viewers(numbers, proxy, channels, options, window):
+    stats = ViewerStats()
+    weights = [1 / rank ** options['zipf'] for rank in range(1, len(channels) + 1)]
+    start, window_start, window_end = window
+    # Wall clock times from the parent process, turned into this process' monotonic clock
+    offset = time.monotonic() - time.time()
+    until = window_end + offset
+    tasks = []
+    for index, number in enumerate(numbers):
+        # Spread over the ramp-up so that the proxy isn't hit by all starts at once
+        delay = start + offset + options['ramp'] * index / max(len(numbers), 1) - time.monotonic()
+        viewer = Viewer(number, proxy, channels, weights, options['pattern'], stats)
+        tasks.append(asyncio.create_task(_delayed(delay, viewer.watch(until))))
+
+    await asyncio.sleep(max(window_start + offset - time.monotonic(), 0))
+    received = stats.received
+    await asyncio.gather(*tasks)
+    stats.window_received = stats.received - received
+    return stats.as_dict()
+
+async def _delayed(delay, coroutine):
+    if delay > 0:
+        await asyncio.sleep(delay)
+    await coroutine
+
+def _viewer_process(numbers, proxy, channels, options, window, results):
+    results.put(asyncio.run(_run_viewers(numbers, proxy, channels, options, window)))
+
+class ViewerPool():
+    """
+    Runs the viewers in several processes, so that the client side doesn't become the bottleneck.
+    window holds the wall clock times of the first start, the begin of the measurement (after the ramp-up) and the end.
+    """
+
+    workers = None
+    results = None
+
+    def start(self, count, proxy, channels, options, window, processes=1):
+        context = multiprocessing.get_context('spawn')
+        self.results = context.Queue()
+        self.workers = []
+        for index in range(processes):
+            numbers = list(range(index + 1, count + 1, processes))
+            worker = context.Process(target=_viewer_process, args=(numbers, proxy, channels, options, window, self.results), name=f'bench-viewers-{index}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def collect(self):
+        """
+        Waits for all viewers to finish, returns what they saw as one merged ViewerStats dict
+        """
+        merged = ViewerStats().as_dict()
+        for _ in self.workers:
+            result = self.results.get()
+            merged['ttfb'] += result['ttfb']
+            merged['received'] += result['received']
+            merged['window_received'] += result['window_received']
+            merged['starts'] += result['starts']
+            for kind, number in result['errors'].items():
+                merged['errors'][kind] = merged['errors'].get(kind, 0) + number
+        for worker in self.workers:
+            worker.join()
+        return merged
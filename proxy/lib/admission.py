@@ -0,0 +1,155 @@
+import time
+import asyncio
+import logging
+import threading
+import collections
+
+import settings
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lines freed outside of this process (other workers or proxies, expired pre-warmed upstreams) are only noticed by checking again
+_recheck_interval = 1
+
+class AdmissionQueue():
+    """
+    Start requests waiting for a line of an upstream playlist instead of getting a 429 right away, admitted in arrival order.
+    Up to ADMISSION_QUEUE_SIZE requests per playlist wait at most ADMISSION_QUEUE_TIMEOUT seconds, a line released
+    in this process goes to the longest waiting one at once.
+    """
+
+    queues = None
+
+    def __init__(self):
+        # Upstream playlist ID -> deque of the waiters' events, the head is the next to be admitted
+        self.queues = {}
+
+    def register_metrics(self):
+        metrics.Gauge('iptv_proxy_admission_queue_depth', 'Stream starts waiting for an upstream line, by upstream playlist', lambda: {(str(upstream_id), ): len(queue) for upstream_id, queue in list(self.queues.items())}, ('upstream', ))
+
+    async def admit(self, upstream_id, reserve):
+        """
+        Returns True once the coroutine function reserve() got a line, in turn with the other requests for the playlist,
+        or False if the queue is full or the wait timed out
+        """
+        if not self.queues.get(upstream_id) and await reserve():
+            return True
+        if settings.admission_queue_size <= 0:
+            return False
+        # Other starts for the playlist may have queued up while reserve() was waiting
+        queue = self.queues.setdefault(upstream_id, collections.deque())
+        if len(queue) >= settings.admission_queue_size:
+            logger.warning(f'ADMISSION: Queue of upstream {upstream_id} is full ({len(queue)} waiting)')
+            metrics.admission_wait_seconds.observe(0, 'full')
+            return False
+
+        waiter = asyncio.Event()
+        queue.append(waiter)
+        logger.info(f'ADMISSION: Waiting for a line of upstream {upstream_id}, {len(queue)} waiting')
+        started = time.monotonic()
+        deadline = started + settings.admission_queue_timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f'ADMISSION: No line of upstream {upstream_id} within {settings.admission_queue_timeout}s')
+                    metrics.admission_wait_seconds.observe(time.monotonic() - started, 'timeout')
+                    return False
+                waiter.clear()
+                try:
+                    await asyncio.wait_for(waiter.wait(), min(remaining, _recheck_interval))
+                except asyncio.TimeoutError:
+                    pass
+                if queue[0] is waiter and await reserve():
+                    logger.info(f'ADMISSION: Got a line of upstream {upstream_id} after {time.monotonic() - started:.1f}s')
+                    metrics.admission_wait_seconds.observe(time.monotonic() - started, 'admitted')
+                    return True
+        finally:
+            queue.remove(waiter)
+            if queue:
+                # The next one may find a line as well
+                queue[0].set()
+            elif self.queues.get(upstream_id) is queue:
+                del self.queues[upstream_id]
+
+    def released(self, channel):
+        """
+        Wakes the longest waiting request for a line of the channel's playlist
+        """
+        queue = self.queues.get(channel['upstream_id']) if channel is not None else None
+        if queue:
+            queue[0].set()
+
+class ThreadedAdmissionQueue():
+    """
+    The AdmissionQueue of the Flask server, whose requests wait in their own threads
+    """
+
+    queues = None
+
+    def __init__(self):
+        # Upstream playlist ID -> deque of the waiters' events, the head is the next to be admitted
+        self.queues = {}
+        self._lock = threading.Lock()
+
+    def register_metrics(self):
+        metrics.Gauge('iptv_proxy_admission_queue_depth', 'Stream starts waiting for an upstream line, by upstream playlist', lambda: {(str(upstream_id), ): len(queue) for upstream_id, queue in list(self.queues.items())}, ('upstream', ))
+
+    def admit(self, upstream_id, reserve):
+        """
+        Returns True once reserve() got a line, in turn with the other requests for the playlist,
+        or False if the queue is full or the wait timed out
+        """
+        with self._lock:
+            waiting = bool(self.queues.get(upstream_id))
+        if not waiting and reserve():
+            return True
+        if settings.admission_queue_size <= 0:
+            return False
+        waiter = threading.Event()
+        with self._lock:
+            queue = self.queues.setdefault(upstream_id, collections.deque())
+            depth = len(queue)
+            if depth < settings.admission_queue_size:
+                queue.append(waiter)
+        if depth >= settings.admission_queue_size:
+            logger.warning(f'ADMISSION: Queue of upstream {upstream_id} is full ({depth} waiting)')
+            metrics.admission_wait_seconds.observe(0, 'full')
+            return False
+
+        logger.info(f'ADMISSION: Waiting for a line of upstream {upstream_id}, {depth + 1} waiting')
+        started = time.monotonic()
+        deadline = started + settings.admission_queue_timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f'ADMISSION: No line of upstream {upstream_id} within {settings.admission_queue_timeout}s')
+                    metrics.admission_wait_seconds.observe(time.monotonic() - started, 'timeout')
+                    return False
+                waiter.wait(min(remaining, _recheck_interval))
+                waiter.clear()
+                with self._lock:
+                    first = queue[0] is waiter
+                if first and reserve():
+                    logger.info(f'ADMISSION: Got a line of upstream {upstream_id} after {time.monotonic() - started:.1f}s')
+                    metrics.admission_wait_seconds.observe(time.monotonic() - started, 'admitted')
+                    return True
+        finally:
+            with self._lock:
+                queue.remove(waiter)
+                if queue:
+                    # The next one may find a line as well
+                    queue[0].set()
+                elif self.queues.get(upstream_id) is queue:
+                    del self.queues[upstream_id]
+
+    def released(self, channel):
+        """
+        Wakes the longest waiting request for a line of the channel's playlist
+        """
+        with self._lock:
+            queue = self.queues.get(channel['upstream_id']) if channel is not None else None
+            if queue:
+                queue[0].set()
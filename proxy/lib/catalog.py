@@ -0,0 +1,221 @@
+import time
+import logging
+import threading
+
+from urllib.parse import urlparse
+
+import settings
+from lib.manager_client import get_catalog, decode_stream_path, _reportActionBegin
+
+logger = logging.getLogger(__name__)
+
+class ChannelCatalog():
+    """
+    Local replica of the manager's channel catalog, so that starting a stream needs no manager round trips.
+    The snapshot is refreshed in the background, incrementally by version and in full every CATALOG_FULL_REFRESH_INTERVAL.
+    Lines reserved by this proxy are counted on top of the manager's in_use until a refresh fetched after the manager acknowledged their reports.
+    Held lines (pre-warmed or lingering upstreams without a viewer) are never reported and count on top until they are released or adopted.
+    """
+
+    version = None
+    channels = None
+    groups = None
+    upstreams = None
+    by_tvg_id = None
+    by_group = None
+    reserved = None
+    acknowledged = None
+    held = None
+    last_full_refresh = 0
+
+    def __init__(self):
+        self.version = None
+        self.channels = {}
+        self.groups = {}
+        self.upstreams = {}
+        self.by_tvg_id = {}
+        self.by_group = {}
+        self.reserved = {}
+        # Line changes of session reports the manager acknowledged since the last refresh, by upstream playlist ID
+        self.acknowledged = {}
+        self.held = {}
+        self.last_full_refresh = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._refresh_loop, name='catalog-refresh', daemon=True)
+        self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as err:
+                logger.warning(f'CATALOG: Refresh failed, keeping version {self.version}: {err}')
+            time.sleep(settings.catalog_refresh_interval)
+
+    def refresh(self):
+        # Reports acknowledged before the fetch are contained in the in_use it returns, later ones wait for the next refresh
+        with self._lock:
+            acknowledged, self.acknowledged = self.acknowledged, {}
+        try:
+            full, catalog, channels = self._fetch()
+        except Exception:
+            with self._lock:
+                for upstream_id, count in acknowledged.items():
+                    self.acknowledged[upstream_id] = self.acknowledged.get(upstream_id, 0) + count
+            raise
+
+        by_tvg_id = {}
+        by_group = {}
+        for channel in channels.values():
+            if channel.get('tvg_id'):
+                by_tvg_id.setdefault(channel['tvg_id'], []).append(channel['url'])
+            by_group.setdefault(channel['group_title_id'], []).append(channel)
+        # In playlist order, the downstream playlists sort a group's channels by name
+        by_group = {group_id: [channel['url'] for channel in sorted(members, key=lambda channel: (channel.get('name') or '', channel['url']))] for group_id, members in by_group.items()}
+
+        with self._lock:
+            self.channels = channels
+            self.by_tvg_id = by_tvg_id
+            self.by_group = by_group
+            self.groups = {group['id']: group['enabled'] for group in catalog['groups']}
+            self.upstreams = {upstream['id']: upstream for upstream in catalog['upstreams']}
+            # The manager's in_use now contains the acknowledged lines, those whose reports are still queued or in flight stay reserved
+            for upstream_id, count in acknowledged.items():
+                self.reserved[upstream_id] = self.reserved.get(upstream_id, 0) - count
+            self.version = catalog['version']
+        if full:
+            self.last_full_refresh = time.monotonic()
+        logger.info(f'CATALOG: Refreshed to version {self.version} ({"full" if full else "incremental"}, {len(catalog["channels"])} channel(s) received, {len(channels)} known)')
+
+    def snapshot(self, version=None):
+        """
+        The catalog for the local copies of worker processes, channels are left out if the copy has the current version
+        """
+        with self._lock:
+            current = version is not None and version == self.version
+            return {
+                'version': self.version,
+                'channels': None if current else self.channels,
+                'by_tvg_id': None if current else self.by_tvg_id,
+                'by_group': None if current else self.by_group,
+                'groups': self.groups,
+                'upstreams': self.upstreams,
+            }
+
+    def _fetch(self):
+        full = self.version is None or time.monotonic() - self.last_full_refresh >= settings.catalog_full_refresh_interval
+        catalog = get_catalog(None if full else self.version)
+        channels = dict(self.channels) if not full else {}
+        channels.update({channel['url']: channel for channel in catalog['channels']})
+        if not full and len(channels) != catalog['channel_count']:
+            # Deleted channels never show up in an incremental refresh, only a full snapshot drops them
+            logger.info(f'CATALOG: {len(channels)} local channel(s) but {catalog["channel_count"]} on the manager, fetching full catalog')
+            full = True
+            catalog = get_catalog()
+            channels = {channel['url']: channel for channel in catalog['channels']}
+        return full, catalog, channels
+
+    def acknowledge(self, events):
+        """
+        Called with the session reports the manager acknowledged, counts the lines they opened and closed on catalog channels
+        """
+        with self._lock:
+            for event in events:
+                if not event['line']:
+                    continue
+                channel = self.channels.get(decode_stream_path(event['url'].removeprefix('/stream/start/')))
+                if channel is None:
+                    continue
+                upstream_id = channel['upstream_id']
+                self.acknowledged[upstream_id] = self.acknowledged.get(upstream_id, 0) + (1 if event['action'] == _reportActionBegin else -1)
+
+    def lookup(self, path):
+        """
+        Returns the catalog entry for a channel URL, or None if the catalog doesn't know it (yet)
+        """
+        return self.channels.get(path)
+
+    def sources(self, channel):
+        """
+        The channel followed by its alternatives: the same channel on other upstreams (by tvg_id) and copies of these
+        pointing at their upstream's mirrors. Mirrors share the line accounting of their upstream.
+        """
+        with self._lock:
+            candidates = [channel] + [
+                self.channels[url] for url in self.by_tvg_id.get(channel.get('tvg_id'), [])
+                if url != channel['url'] and url in self.channels and self.channels[url]['upstream_id'] != channel['upstream_id']
+            ]
+            sources = []
+            for candidate in candidates:
+                sources.append(candidate)
+                upstream = self.upstreams.get(candidate['upstream_id']) or {}
+                parsed_url = urlparse(candidate['url'])
+                for mirror in (upstream.get('mirrors') or '').split():
+                    parsed_mirror = urlparse(mirror)
+                    sources.append(dict(candidate, url=parsed_url._replace(scheme=parsed_mirror.scheme, netloc=parsed_mirror.netloc).geturl()))
+        return sources
+
+    def neighbours(self, channel):
+        """
+        The channels before and after a catalog entry in its group, None at the ends
+        """
+        with self._lock:
+            members = self.by_group.get(channel['group_title_id'], [])
+            if channel['url'] not in members:
+                return None, None
+            index = members.index(channel['url'])
+            return (self.channels.get(members[index - 1]) if index > 0 else None,
+                    self.channels.get(members[index + 1]) if index + 1 < len(members) else None)
+
+    def reserve_line(self, channel, spare=0, held=False):
+        """
+        Runs the admission check for a catalog entry and reserves an upstream line if it passes and spare further lines remain free.
+        Held lines are kept apart from the reported ones.
+        """
+        upstream_id = channel['upstream_id']
+        with self._lock:
+            upstream = self.upstreams.get(upstream_id)
+            if upstream is None or not upstream['enabled'] or not channel['enabled'] or not self.groups.get(channel['group_title_id'], True):
+                logger.info(f'CATALOG: {channel["url"]} is disabled')
+                return False
+            in_use = upstream['in_use'] + self.reserved.get(upstream_id, 0) + self.held.get(upstream_id, 0)
+            if upstream['max_conns'] != 0 and in_use + spare >= upstream['max_conns']:
+                logger.info(f'CATALOG: No line available on upstream {upstream_id} ({in_use} / {upstream["max_conns"]}, {spare} to spare)')
+                return False
+            counts = self.held if held else self.reserved
+            counts[upstream_id] = counts.get(upstream_id, 0) + 1
+        return True
+
+    async def reserve_line_async(self, channel, spare=0, held=False):
+        """
+        reserve_line for the asyncio server, which a worker process' catalog runs in the supervisor
+        """
+        return self.reserve_line(channel, spare, held)
+
+    def release_line(self, channel, held=False):
+        if channel is None:
+            return
+        upstream_id = channel['upstream_id']
+        with self._lock:
+            counts = self.held if held else self.reserved
+            counts[upstream_id] = counts.get(upstream_id, 0) - 1
+
+    def adopt_line(self, channel):
+        """
+        Turns a held line into a reserved one, once a viewer took over the pre-warmed upstream and reports the line
+        """
+        upstream_id = channel['upstream_id']
+        with self._lock:
+            self.held[upstream_id] = self.held.get(upstream_id, 0) - 1
+            self.reserved[upstream_id] = self.reserved.get(upstream_id, 0) + 1
+
+    def hold_line(self, channel):
+        """
+        Counts a line as held without an admission check, for an upstream that stays open after its last viewer released the line
+        """
+        upstream_id = channel['upstream_id']
+        with self._lock:
+            self.held[upstream_id] = self.held.get(upstream_id, 0) + 1
@@ -0,0 +1,313 @@
+import os
+import mmap
+import time
+import bisect
+import asyncio
+import logging
+import tempfile
+
+import settings
+from lib.ts import TS_PACKET_SIZE, ProgramTables
+from lib.ts_analyzer import TsAnalyzer
+
+logger = logging.getLogger(__name__)
+
+_mark_interval = 1
+# Share of the ring kept free of new cursors behind the oldest data, which is the next to be overwritten
+_ring_margin = 16
+
+def _map_ring_file(size):
+    """
+    Maps a ring file of size bytes below TIMESHIFT_DIR. The file is unlinked right away, so it only lives as long as the mapping
+    and the kernel pages it in and out as needed instead of the process holding the whole buffer in memory.
+    """
+    fd, path = tempfile.mkstemp(prefix='timeshift-', suffix='.ts', dir=settings.timeshift_dir)
+    try:
+        os.unlink(path)
+        os.ftruncate(fd, size)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+class HubCursor():
+    """
+    A viewer's read position inside a ChannelHub's ring buffer
+    """
+
+    hub = None
+    position = 0
+    dropped = 0
+    prefix = b''
+
+    def __init__(self, hub, position, prefix=b''):
+        self.hub = hub
+        self.position = position
+        self.dropped = 0
+        self.prefix = prefix
+
+    async def read(self, size):
+        """
+        Returns a memoryview of up to size bytes of not yet seen data, or b'' once the upstream has ended
+        """
+        if self.prefix:
+            prefix, self.prefix = self.prefix, b''
+            return prefix
+        hub = self.hub
+        while self.position >= hub.write_pos:
+            if hub.ended:
+                return b''
+            await hub.data_event.wait()
+
+        lag = hub.write_pos - self.position
+        if lag > hub.ring_size:
+            # Viewer fell out of the ring, skip ahead to half a ring behind live while keeping packet alignment
+            skip = lag - hub.ring_size // 2
+            skip += -skip % TS_PACKET_SIZE
+            self.position += skip
+            self.dropped += skip
+            logger.warning(f'HUB {hub.key}: Slow viewer skipped {skip} bytes')
+
+        start = self.position % hub.ring_size
+        count = min(hub.write_pos - self.position, hub.ring_size - start, size)
+        self.position += count
+        return hub.view[start:start + count]
+
+class ChannelHub():
+    """
+    A single upstream reader per channel, feeding a ring buffer that all viewers of the channel read at their own cursor.
+    With TIMESHIFT_SIZE set the ring is a memory-mapped file, and viewers may start up to its length behind the live edge.
+    """
+
+    key = ''
+    ring_size = 0
+    ring = None
+    view = None
+    write_pos = 0
+    marks = None
+    tables = None
+    keyframe_pos = None
+    viewers = 0
+    headers = None
+    upstream = None
+    ended = False
+    # Opened ahead of viewers by the Prewarmer, its line is held until a viewer takes the hub over
+    warm = False
+    # Whether it was logged that the ring holds less than one GOP, so the start cache can't be used
+    short_ring = False
+    analyzer = None
+    ready = None
+    data_event = None
+
+    def __init__(self, key, ring_size, timeshift=False):
+        self.key = key
+        self.ring_size = ring_size
+        self.ring = _map_ring_file(ring_size) if timeshift else bytearray(ring_size)
+        self.view = memoryview(self.ring)
+        self.write_pos = 0
+        # (time, position) about every second, to find the position of "live minus N seconds"
+        self.marks = [] if timeshift else None
+        # Program tables and position of the latest keyframe, where new viewers start (START_CACHE)
+        self.tables = ProgramTables()
+        self.keyframe_pos = None
+        self.viewers = 0
+        self.headers = {}
+        self.ended = False
+        self.warm = False
+        self.short_ring = False
+        self.analyzer = TsAnalyzer(key) if settings.ts_analyzer_sample > 0 else None
+        self.ready = asyncio.get_running_loop().create_future()
+        self.data_event = asyncio.Event()
+        self._task = None
+
+    def attach(self, upstream):
+        self.upstream = upstream
+        self.headers = upstream.passthrough_headers()
+        self._task = asyncio.ensure_future(self._pump())
+
+    def join(self, offset=0):
+        """
+        Returns a cursor at the live edge, or offset seconds behind it as far as the time-shift ring reaches back
+        """
+        position = self.write_pos
+        # Oldest data a cursor may start at, short of the margin to the next data to be overwritten
+        oldest = self.write_pos - self.ring_size + self.ring_size // _ring_margin
+        if offset == 0 and settings.start_cache and self.keyframe_pos is not None:
+            if self.keyframe_pos >= oldest:
+                # Start at the latest keyframe behind the program tables, so that the client can render right away
+                logger.info(f'HUB {self.key}: Viewer starts {self.write_pos - self.keyframe_pos} bytes behind live at the latest keyframe')
+                return HubCursor(self, self.keyframe_pos, self.tables.packets())
+            if not self.short_ring:
+                self.short_ring = True
+                logger.warning(f'HUB {self.key}: Ring of {self.ring_size} bytes holds less than one GOP, viewers start at the live edge instead of a keyframe')
+        if offset > 0 and self.marks:
+            index = bisect.bisect_right(self.marks, time.monotonic() - offset, key=lambda mark: mark[0])
+            position = self.marks[max(index - 1, 0)][1]
+            position = max(position, oldest + (-oldest % TS_PACKET_SIZE), 0)
+        # Aligned to the packet grid of the stream
+        return HubCursor(self, position - (position % TS_PACKET_SIZE))
+
+    def mark(self):
+        now = time.monotonic()
+        if self.marks and now - self.marks[-1][0] < _mark_interval:
+            return
+        self.marks.append((now, self.write_pos))
+        overwritten = bisect.bisect_left(self.marks, self.write_pos - self.ring_size, key=lambda mark: mark[1])
+        if overwritten:
+            del self.marks[:overwritten]
+
+    def write(self, data):
+        if self.marks is not None:
+            self.mark()
+        if settings.start_cache:
+            self.index(data)
+        if self.analyzer is not None:
+            self.analyzer.feed(data)
+        size = len(data)
+        start = self.write_pos % self.ring_size
+        first = min(size, self.ring_size - start)
+        self.view[start:start + first] = data[:first]
+        if first < size:
+            self.view[0:size - first] = data[first:]
+        self.write_pos += size
+        # Wake every waiting viewer, the event is only used as a broadcast
+        self.data_event.set()
+        self.data_event.clear()
+
+    def index(self, data):
+        """
+        Scans the complete packets of a chunk about to be written for program tables and keyframes,
+        packets split across chunks are skipped as tables and keyframes come around again soon enough
+        """
+        skip = -self.write_pos % TS_PACKET_SIZE
+        end = skip + (len(data) - skip) // TS_PACKET_SIZE * TS_PACKET_SIZE
+        if end <= skip:
+            return
+        keyframe = self.tables.scan(memoryview(data)[skip:end])
+        if keyframe is not None and self.tables.pat is not None:
+            self.keyframe_pos = self.write_pos + skip + keyframe
+
+    async def _pump(self):
+        try:
+            while True:
+                chunk = await asyncio.wait_for(self.upstream.read(settings.relay_chunk_size), self.upstream.read_timeout)
+                if not chunk:
+                    logger.info(f'HUB {self.key}: Upstream ended')
+                    break
+                self.write(chunk)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.warning(f'HUB {self.key}: Upstream failed: {err!r}')
+        finally:
+            self.close()
+
+    def close(self):
+        self.ended = True
+        self.data_event.set()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        if self.upstream is not None:
+            self.upstream.close()
+
+    def discard(self):
+        """
+        Closes the hub for good once no viewer reads it anymore, lagging viewers may still read a closed hub's ring until then
+        """
+        self.close()
+        if isinstance(self.ring, mmap.mmap):
+            try:
+                self.view.release()
+                self.ring.close()
+            except BufferError:
+                pass  # Still referenced by a viewer's last chunk, unmapped once that is gone
+
+class HubRegistry():
+    """
+    Reference counted ChannelHubs by channel URL, the upstream is opened by the first viewer and closed by the last one.
+    Pre-warmed hubs are opened without a viewer; the first viewer joining one takes over its line and on_adopt(hub) is called.
+    When the last viewer leaves, on_idle(hub) may keep the hub open as a pre-warmed one instead, by returning True.
+    """
+
+    hubs = None
+    on_adopt = None
+    on_idle = None
+
+    def __init__(self):
+        self.hubs = {}
+
+    async def acquire(self, key, opener):
+        """
+        Joins the hub for key, opening it through opener() if necessary.
+        Returns the hub and whether this call opened a new upstream line.
+        """
+        hub = self.hubs.get(key)
+        if hub is not None and not hub.ended:
+            adopted = hub.warm
+            hub.warm = False
+            hub.viewers += 1
+            try:
+                await asyncio.shield(hub.ready)
+            except BaseException:
+                hub.viewers -= 1
+                hub.warm = adopted and hub.viewers == 0
+                raise
+            if adopted:
+                logger.info(f'HUB {key}: Viewer took over pre-warmed upstream')
+                if self.on_adopt is not None:
+                    self.on_adopt(hub)
+                return hub, True
+            logger.info(f'HUB {key}: Viewer joined, {hub.viewers} viewer(s)')
+            return hub, False
+
+        hub = self.create(key)
+        hub.viewers = 1
+        await self.open(hub, opener)
+        return hub, True
+
+    def create(self, key, warm=False):
+        hub = ChannelHub(key, settings.timeshift_size or settings.ring_buffer_size, timeshift=settings.timeshift_size > 0)
+        hub.warm = warm
+        self.hubs[key] = hub
+        return hub
+
+    async def open(self, hub, opener):
+        """
+        Connects a created hub to its upstream through opener(), viewers joining meanwhile wait for it
+        """
+        try:
+            hub.attach(await opener())
+        except BaseException as err:
+            if self.hubs.get(hub.key) is hub:
+                del self.hubs[hub.key]
+            hub.discard()
+            hub.ready.set_exception(err if isinstance(err, Exception) else ConnectionAbortedError(f'Opening viewer of {hub.key} went away'))
+            hub.ready.exception()  # Mark as retrieved, joined viewers receive it through shield()
+            raise
+        hub.ready.set_result(True)
+        logger.info(f'HUB {hub.key}: Opened upstream{" ahead of viewers" if hub.warm else ""}, {len(self.hubs)} active hub(s)')
+
+    def release(self, hub):
+        """
+        Leaves the hub, returns True if this closed the upstream line
+        """
+        hub.viewers -= 1
+        logger.info(f'HUB {hub.key}: Viewer left, {hub.viewers} viewer(s)')
+        if hub.viewers > 0:
+            return False
+        if self.on_idle is not None and not hub.ended and self.on_idle(hub):
+            # The viewers' line ends here, the hub's upstream goes on on a held one
+            return True
+        if self.hubs.get(hub.key) is hub:
+            del self.hubs[hub.key]
+        hub.discard()
+        logger.info(f'HUB {hub.key}: Closed upstream, {len(self.hubs)} active hub(s)')
+        return True
+
+    def drop(self, hub):
+        """
+        Closes a pre-warmed hub that no viewer took over
+        """
+        if self.hubs.get(hub.key) is hub:
+            del self.hubs[hub.key]
+        hub.discard()
+        logger.info(f'HUB {hub.key}: Closed pre-warmed upstream, {len(self.hubs)} active hub(s)')
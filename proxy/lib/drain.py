@@ -0,0 +1,68 @@
+import time
+import logging
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+_poll_interval = 0.5
+# Seconds stopped sessions get to end and report it
+_stop_grace = 5
+# Seconds the reporter gets to ship the last reports before the process exits anyway
+_flush_timeout = 30
+
+class DrainingError(Exception):
+    pass
+
+class Drain():
+    """
+    Graceful shutdown of a proxy process: new sessions are refused with 503 and the heartbeat tells the manager, so that
+    its proxy pools send stream starts elsewhere. Running sessions go on until they end or DRAIN_TIMEOUT passes, the rest
+    are stopped and their End reports are shipped before the process exits, which keeps the manager's line counts right.
+    stop_listening also closes the listening socket, for a reload where a new generation of workers took over the port.
+    """
+
+    draining = False
+    done = False
+    deadline = 0
+    callbacks = None
+
+    def __init__(self):
+        self.callbacks = []
+
+    def on_begin(self, callback):
+        """
+        Registers a callback(stop_listening) run when draining begins, possibly from another thread
+        """
+        self.callbacks.append(callback)
+
+    def begin(self, stop_listening=False):
+        if self.draining:
+            return
+        self.draining = True
+        self.deadline = time.monotonic() + settings.drain_timeout
+        logger.warning(f'DRAIN: Refusing new sessions, running ones get {settings.drain_timeout}s to end')
+        for callback in self.callbacks:
+            callback(stop_listening)
+
+    def expired(self):
+        return time.monotonic() >= self.deadline
+
+    def finish(self, sessions, reporter):
+        """
+        Waits until the running sessions ended or DRAIN_TIMEOUT passed, stops the rest and ships the reports
+        """
+        while len(sessions) > 0 and not self.expired():
+            time.sleep(_poll_interval)
+        if len(sessions) > 0:
+            logger.warning(f'DRAIN: Stopping {len(sessions)} session(s) still running')
+            sessions.cancel_all()
+            grace = time.monotonic() + _stop_grace
+            while len(sessions) > 0 and time.monotonic() < grace:
+                time.sleep(_poll_interval)
+        if not reporter.flush(_flush_timeout):
+            logger.error(f'DRAIN: Reports not shipped within {_flush_timeout}s, the manager\'s line counts may be off')
+        logger.warning('DRAIN: Done')
+        self.done = True
+
+drain = Drain()
@@ -0,0 +1,58 @@
+import os
+import time
+import logging
+import threading
+
+import settings
+from lib import metrics
+from lib.manager_client import send_heartbeat
+from lib.drain import drain
+
+logger = logging.getLogger(__name__)
+
+class Heartbeat():
+    """
+    Tells the manager every HEARTBEAT_INTERVAL seconds that the proxy is alive and how loaded it is, over all worker processes:
+    running sessions, the rate sent to clients and the CPU usage since the previous heartbeat, and whether it is draining.
+    The manager spreads the stream starts of downstream playlists with a proxy pool by it.
+    """
+
+    last_time = None
+    last_sent = 0
+    last_cpu = 0
+
+    def start(self):
+        self._wake = threading.Event()
+        # A draining proxy tells the manager right away, not only with the next heartbeat
+        drain.on_begin(lambda stop_listening: self._wake.set())
+        self._thread = threading.Thread(target=self._beat_loop, name='heartbeat', daemon=True)
+        self._thread.start()
+
+    def sample(self):
+        """
+        Returns (sessions, egress in Mbit/s, CPU in percent of all cores), rates since the previous sample
+        """
+        state = metrics.merged()
+        now = time.monotonic()
+        sessions = metrics.total('iptv_proxy_sessions_active', state)
+        sent = metrics.total(metrics.bytes_by_client.name, state)
+        cpu = metrics.total(metrics.cpu_seconds.name, state)
+        egress = cpu_share = 0
+        if self.last_time is not None and now > self.last_time:
+            elapsed = now - self.last_time
+            # Restarted workers make the totals drop, that interval counts as idle
+            egress = max(sent - self.last_sent, 0) * 8 / elapsed / 1e6
+            cpu_share = max(cpu - self.last_cpu, 0) / elapsed / (os.cpu_count() or 1) * 100
+        self.last_time, self.last_sent, self.last_cpu = now, sent, cpu
+        return int(sessions), egress, min(cpu_share, 100)
+
+    def _beat_loop(self):
+        while True:
+            try:
+                sessions, egress, cpu = self.sample()
+                send_heartbeat(sessions, egress, settings.egress_capacity, cpu, drain.draining)
+                logger.debug(f'HEARTBEAT: {sessions} session(s), {egress:.1f} Mbit/s, {cpu:.1f}% CPU{", draining" if drain.draining else ""}')
+            except Exception as err:
+                logger.warning(f'HEARTBEAT: Sending failed: {err!r}')
+            self._wake.wait(settings.heartbeat_interval)
+            self._wake.clear()
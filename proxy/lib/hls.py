@@ -0,0 +1,228 @@
+import re
+import time
+import base64
+import asyncio
+import logging
+
+from collections import OrderedDict
+from urllib.parse import urljoin, urlparse
+
+import settings
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+_hls_prefix = '/stream/hls/'
+_live_prefix = '/stream/live/'
+_uri_attribute = re.compile(r'URI="([^"]+)"')
+_playlist_types = ('mpegurl', )
+_playlist_suffixes = ('.m3u8', )
+
+def is_playlist(path, content_type=''):
+    """
+    Whether a URL or response is an HLS playlist, by path suffix or content type
+    """
+    return urlparse(path).path.lower().endswith(_playlist_suffixes) or any(name in content_type.lower() for name in _playlist_types)
+
+def _encode(value):
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode(value):
+    return base64.urlsafe_b64decode(value.encode('ascii') + b'=' * (-len(value) % 4)).decode('utf-8')
+
+def hls_url(channel_path, resource_url):
+    """
+    Proxy URL for a playlist or segment of an HLS channel, the original suffix is kept for players that look at it
+    """
+    name = urlparse(resource_url).path.rsplit('/', 1)[-1]
+    suffix = re.sub(r'[^A-Za-z0-9]', '', name.rsplit('.', 1)[1]) if '.' in name else ''
+    return f'{_hls_prefix}{_encode(channel_path)}/{_encode(resource_url)}{"." + suffix if suffix else ""}'
+
+def parse_hls_target(target):
+    """
+    Returns the channel path and the upstream resource URL of a /stream/hls/ request target
+    """
+    channel_token, resource_token = target.removeprefix(_hls_prefix).split('?', 1)[0].split('/', 1)
+    return _decode(channel_token), _decode(resource_token.split('.', 1)[0])
+
+def live_url(channel_path, name):
+    """
+    Proxy URL of the HLS output playlist (index.m3u8) or a segment (<sequence>.ts) of a TS channel
+    """
+    return f'{_live_prefix}{_encode(channel_path)}/{name}'
+
+def parse_live_target(target):
+    """
+    Returns the channel path and the requested file name of a /stream/live/ request target
+    """
+    channel_token, name = target.removeprefix(_live_prefix).split('?', 1)[0].split('/', 1)
+    return _decode(channel_token), name
+
+def rewrite_playlist(text, base_url, channel_path):
+    """
+    Points all URIs of a master or media playlist (segments, variants, keys, init sections) back at the proxy
+    """
+    def proxied(uri):
+        absolute = urljoin(base_url, uri)
+        return hls_url(channel_path, absolute) if urlparse(absolute).scheme in ('http', 'https') else uri
+
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            lines.append(line)
+        elif stripped.startswith('#'):
+            lines.append(_uri_attribute.sub(lambda match: f'URI="{proxied(match.group(1))}"', line))
+        else:
+            lines.append(proxied(stripped))
+    return '\n'.join(lines) + '\n'
+
+class CachedResource():
+    """
+    A fetched playlist or segment
+    """
+
+    url = ''
+    content_type = ''
+    body = b''
+    expires = 0
+
+    def __init__(self, url, content_type, body, max_age):
+        self.url = url
+        self.content_type = content_type
+        self.body = body
+        self.expires = time.monotonic() + max_age
+
+    @property
+    def playlist(self):
+        return is_playlist(self.url, self.content_type)
+
+class SegmentCache():
+    """
+    LRU cache of HLS playlists and segments by upstream URL, bounded by HLS_CACHE_SIZE bytes.
+    Segments live for HLS_SEGMENT_MAX_AGE, playlists only for HLS_PLAYLIST_MAX_AGE as they change with every segment.
+    Concurrent requests for a missing URL wait for the same download, so every resource is fetched once.
+    """
+
+    entries = None
+    size = 0
+    max_size = 0
+    pending = None
+
+    def __init__(self, max_size):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.max_size = max_size
+        self.pending = {}
+
+    async def get(self, url, loader):
+        """
+        Returns the CachedResource for url, loader() is awaited for (final URL, headers, body) on a miss
+        """
+        entry = self.entries.get(url)
+        if entry is not None and entry.expires > time.monotonic():
+            self.entries.move_to_end(url)
+            metrics.hls_cache_requests.inc(1, 'hit')
+            return entry
+        if url in self.pending:
+            metrics.hls_cache_requests.inc(1, 'hit')
+            return await asyncio.shield(self.pending[url])
+
+        metrics.hls_cache_requests.inc(1, 'miss')
+        future = asyncio.get_running_loop().create_future()
+        self.pending[url] = future
+        try:
+            final_url, headers, body = await loader()
+            content_type = headers.get('Content-Type', '')
+            max_age = settings.hls_playlist_max_age if is_playlist(final_url, content_type) or is_playlist(url) else settings.hls_segment_max_age
+            entry = CachedResource(final_url, content_type, body, max_age)
+            self._store(url, entry)
+            future.set_result(entry)
+            return entry
+        except BaseException as err:
+            future.set_exception(err if isinstance(err, Exception) else ConnectionAbortedError(f'Fetching {url} was cancelled'))
+            future.exception()  # Mark as retrieved, waiters receive it through shield()
+            raise
+        finally:
+            del self.pending[url]
+
+    def _store(self, url, entry):
+        replaced = self.entries.pop(url, None)
+        if replaced is not None:
+            self.size -= len(replaced.body)
+        if len(entry.body) > self.max_size:
+            return
+        self.entries[url] = entry
+        self.size += len(entry.body)
+        now = time.monotonic()
+        # Expired entries go first, then the least recently used ones
+        for expired in [key for key, cached in self.entries.items() if cached.expires <= now]:
+            self.size -= len(self.entries.pop(expired).body)
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.body)
+
+def byte_range(value, length):
+    """
+    Returns (start, end) of a single "bytes=" Range header within length, or None to send the whole body
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (value or '').strip())
+    if match is None or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        start, end = max(length - int(match.group(2)), 0), length
+    else:
+        start, end = int(match.group(1)), min(int(match.group(2)) + 1, length) if match.group(2) else length
+    return (start, end) if start < end else None
+
+class HlsLine():
+    """
+    The upstream line of an HLS channel, held while the channel has viewers.
+    For HLS output it is the channel's shared upstream, which may already be held by TS viewers (owns_line is False then).
+    """
+
+    viewers = 0
+    admitted = None
+    owns_line = False
+    hub = None
+    segmenter = None
+
+    def __init__(self, admitted):
+        self.viewers = 0
+        self.admitted = admitted
+        self.owns_line = False
+        self.hub = None
+        self.segmenter = None
+
+    @property
+    def ended(self):
+        return self.segmenter is not None and self.segmenter.ended
+
+class HlsViewer():
+    """
+    A client watching an HLS channel, there is no connection spanning the session so it ends after HLS_SESSION_TIMEOUT without requests
+    """
+
+    session = None
+    line_key = None
+    channel = None
+    request_headers = None
+    user_agent_string = ''
+    request_path = ''
+    last_seen = 0
+
+    def __init__(self, session, line_key, channel, request_headers, user_agent_string, request_path):
+        self.session = session
+        self.line_key = line_key
+        self.channel = channel
+        self.request_headers = request_headers
+        self.user_agent_string = user_agent_string
+        self.request_path = request_path
+        self.last_seen = time.monotonic()
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    @property
+    def idle(self):
+        return time.monotonic() - self.last_seen > settings.hls_session_timeout
@@ -0,0 +1,483 @@
+import re
+import ssl
+import time
+import socket
+import asyncio
+import logging
+
+from http import HTTPStatus
+from urllib.parse import urlparse, urljoin
+from requests.structures import CaseInsensitiveDict
+
+import settings
+from lib import metrics
+from lib.resolver import resolver
+
+logger = logging.getLogger(__name__)
+
+_max_redirects = 5
+_header_limit = 65536
+_pool_idle_timeout = 30
+_redirect_codes = (HTTPStatus.MOVED_PERMANENTLY, HTTPStatus.FOUND, HTTPStatus.SEE_OTHER, HTTPStatus.TEMPORARY_REDIRECT, HTTPStatus.PERMANENT_REDIRECT)
+_opts_re = re.compile(r'#([\S]+?):([\s\S]+?)=([^\n]*)')
+
+class UpstreamError(Exception):
+    pass
+
+def build_request_headers(extra_opts, user_agent_string):
+    """
+    Builds the upstream request headers, honouring channel specific #EXTVLCOPT options
+    """
+    referer = ''
+    for hit in _opts_re.findall(extra_opts or ''):
+        name = hit[1]
+        value = hit[2]
+        if name == 'http-user-agent':
+            logger.info(f'HTTP_CLIENT: Using channel specific user agent: {value}')
+            user_agent_string = value
+        if name == 'http-referrer':
+            logger.info(f'HTTP_CLIENT: Found channel specific referer: {value}')
+            referer = value
+
+    # TODO: Make customizable
+    request_headers = {
+        'User-Agent': user_agent_string,
+        'Accept': '*/*',
+        'Cache-Control': 'no-cache',
+        'Pragma': 'no-cache',
+        'Connection': 'keep-alive'
+    }
+    if referer != '':
+        request_headers['Referer'] = referer
+    return request_headers
+
+def parse_head(head):
+    """
+    Splits a raw HTTP message head into its start line and a case insensitive header dict
+    """
+    lines = head.decode('latin-1').split('\r\n')
+    headers = CaseInsensitiveDict()
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip()] = value.strip()
+    return lines[0], headers
+
+def passthrough_headers(headers):
+    """
+    Upstream headers that are safe to hand to the client (hop-by-hop headers removed)
+    """
+    headers = dict(headers)
+    for name in ('Transfer-Encoding', 'Connection', 'Keep-Alive'):
+        for key in [key for key in headers if key.lower() == name.lower()]:
+            del headers[key]
+    return headers
+
+class UpstreamResponse():
+    """
+    Body reader for a streamed upstream response, decoding chunked transfer encoding if necessary
+    """
+
+    reader = None
+    writer = None
+    url = ''
+    status = 0
+    headers = None
+    chunked = False
+    remaining = None
+    source = None
+
+    def __init__(self, url, reader, writer, status, headers):
+        self.url = url
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.headers = headers
+        self.chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        if not self.chunked and 'Content-Length' in headers:
+            self.remaining = int(headers['Content-Length'])
+        self._chunk_left = 0
+        self._chunks_done = False
+        self._unread = b''
+
+    def unread(self, data):
+        """
+        Puts data already read back in front of the body, e.g. the first chunk that was awaited to check the upstream
+        """
+        self._unread = data + self._unread
+
+    async def read(self, size):
+        if self._unread:
+            data, self._unread = self._unread[:size], self._unread[size:]
+            return data
+        if self.chunked:
+            return await self._read_chunked(size)
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                return b''
+            data = await self.reader.read(min(size, self.remaining))
+            self.remaining -= len(data)
+            return data
+        return await self.reader.read(size)
+
+    async def _read_chunked(self, size):
+        if self._chunks_done:
+            return b''
+        if self._chunk_left == 0:
+            line = await self.reader.readline()
+            chunk_size = int(line.split(b';', 1)[0].strip() or b'0', 16)
+            if chunk_size == 0:
+                # Skip the trailers, so that the connection is positioned at the next response
+                while (await self.reader.readline()).strip():
+                    pass
+                self._chunks_done = True
+                return b''
+            self._chunk_left = chunk_size
+        data = await self.reader.read(min(size, self._chunk_left))
+        if not data:
+            return b''
+        self._chunk_left -= len(data)
+        if self._chunk_left == 0:
+            await self.reader.readexactly(2)  # Trailing CRLF of the chunk
+        return data
+
+    @property
+    def read_timeout(self):
+        return settings.stream_timeout
+
+    def passthrough_headers(self):
+        return passthrough_headers(self.headers)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+def build_request(parsed_url, headers):
+    target = parsed_url.path or '/'
+    if parsed_url.query:
+        target = f'{target}?{parsed_url.query}'
+    host_header = parsed_url.hostname if parsed_url.port is None else f'{parsed_url.hostname}:{parsed_url.port}'
+    request_lines = [f'GET {target} HTTP/1.1', f'Host: {host_header}']
+    request_lines += [f'{name}: {value}' for name, value in headers.items()]
+    return ('\r\n'.join(request_lines) + '\r\n\r\n').encode('latin-1')
+
+def check_response(url, status, response_headers):
+    """
+    Returns the redirect target for redirects, raises UpstreamError for error responses and returns None otherwise
+    """
+    if status in _redirect_codes and 'Location' in response_headers:
+        url = urljoin(url, response_headers['Location'])
+        logger.info(f'HTTP_CLIENT: Following redirect to {url}')
+        return url
+    if status >= HTTPStatus.BAD_REQUEST:
+        raise UpstreamError(f'Upstream returned {status} for {url}')
+    return None
+
+class ResumingContext(ssl.SSLContext):
+    """
+    Client TLS context offering the last session of a host when connecting to it again, which saves a full handshake
+    """
+
+    sessions = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and settings.tls_session_cache:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side=server_side, server_hostname=server_hostname, session=session)
+
+    def remember(self, host, writer):
+        """
+        Keeps the session of an established connection, called once the response head arrived as TLS 1.3 sends its tickets after the handshake
+        """
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.session is not None and settings.tls_session_cache:
+            self.sessions[host] = ssl_object.session
+
+_tls_context = None
+
+def tls_context():
+    global _tls_context
+    if _tls_context is None:
+        # Shared by all connections, also because sessions can only be resumed with the context that created them
+        _tls_context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        _tls_context.load_default_certs()
+        _tls_context.sessions = {}
+    return _tls_context
+
+async def connect_socket(host, port):
+    """
+    Resolves host through the DNS cache and connects a non-blocking TCP socket to the first reachable address
+    """
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    addresses = await resolver.resolve(host, port)
+    connecting = time.monotonic()
+    metrics.upstream_phase_seconds.observe(connecting - started, host, 'dns')
+    error = None
+    for family, sock_type, proto, _, address in addresses:
+        sock = socket.socket(family, sock_type, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, address)
+        except OSError as err:
+            sock.close()
+            error = err
+            continue
+        except BaseException:
+            sock.close()
+            raise
+        metrics.upstream_phase_seconds.observe(time.monotonic() - connecting, host, 'tcp')
+        return sock
+    # The addresses may be outdated, look them up again next time
+    resolver.forget(host, port)
+    raise error or UpstreamError(f'No address found for {host}')
+
+async def _open_connection(host, port, use_tls):
+    sock = await connect_socket(host, port)
+    if not use_tls:
+        return await asyncio.open_connection(sock=sock, limit=_header_limit)
+    handshake = time.monotonic()
+    try:
+        reader, writer = await asyncio.open_connection(sock=sock, ssl=tls_context(), server_hostname=host, limit=_header_limit)
+    except BaseException:
+        sock.close()
+        raise
+    metrics.upstream_phase_seconds.observe(time.monotonic() - handshake, host, 'tls')
+    metrics.tls_handshakes.inc(1, str(writer.get_extra_info('ssl_object').session_reused).lower())
+    return reader, writer
+
+async def _connect(parsed_url, timeout):
+    if parsed_url.scheme not in ('http', 'https'):
+        raise UpstreamError(f'Unsupported URL scheme "{parsed_url.scheme}"')
+    use_tls = parsed_url.scheme == 'https'
+    port = parsed_url.port or (443 if use_tls else 80)
+    return await asyncio.wait_for(_open_connection(parsed_url.hostname, port, use_tls), timeout)
+
+async def _receive_head(parsed_url, reader, writer, timeout):
+    """
+    Waits for the response head of a request just written, timing the upstream's first byte
+    """
+    sent = time.monotonic()
+    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+    metrics.upstream_phase_seconds.observe(time.monotonic() - sent, parsed_url.hostname, 'first_byte')
+    if parsed_url.scheme == 'https':
+        tls_context().remember(parsed_url.hostname, writer)
+    return head
+
+async def open_stream(url, headers, timeout=None):
+    """
+    Opens a streamed GET request to url and returns the UpstreamResponse once the response head has been received
+    """
+    timeout = timeout if timeout is not None else settings.stream_timeout
+    for _ in range(_max_redirects + 1):
+        parsed_url = urlparse(url)
+        reader, writer = await _connect(parsed_url, timeout)
+        try:
+            writer.write(build_request(parsed_url, headers))
+            await writer.drain()
+
+            head = await _receive_head(parsed_url, reader, writer, timeout)
+            status_line, response_headers = parse_head(head)
+            status = int(status_line.split(' ', 2)[1])
+            redirect = check_response(url, status, response_headers)
+        except BaseException:
+            writer.close()
+            raise
+
+        if redirect is not None:
+            writer.close()
+            url = redirect
+            continue
+        return UpstreamResponse(url, reader, writer, status, response_headers)
+    raise UpstreamError(f'Too many redirects for {url}')
+
+class ConnectionPool():
+    """
+    Idle keep-alive upstream connections by scheme, host and port, reused for consecutive requests like HLS segments
+    """
+
+    idle = None
+    max_idle = 0
+
+    def __init__(self, max_idle):
+        self.idle = {}
+        self.max_idle = max_idle
+
+    def _take(self, key):
+        connections = self.idle.get(key, [])
+        while connections:
+            reader, writer, since = connections.pop()
+            if writer.is_closing() or reader.at_eof() or time.monotonic() - since > _pool_idle_timeout:
+                writer.close()
+                continue
+            return reader, writer
+        return None
+
+    def _put(self, key, reader, writer):
+        connections = self.idle.setdefault(key, [])
+        if len(connections) >= self.max_idle:
+            writer.close()
+            return
+        connections.append((reader, writer, time.monotonic()))
+
+    async def _send(self, key, parsed_url, headers, timeout):
+        """
+        Sends the request on an idle connection if there is one, returns the connection and the response head
+        """
+        while True:
+            connection = self._take(key)
+            reused = connection is not None
+            reader, writer = connection if reused else await _connect(parsed_url, timeout)
+            try:
+                writer.write(build_request(parsed_url, headers))
+                await writer.drain()
+                head = await _receive_head(parsed_url, reader, writer, timeout)
+                return reader, writer, head
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+                # The upstream closed the idle connection meanwhile, try the next one
+            except BaseException:
+                writer.close()
+                raise
+
+    async def fetch(self, url, headers, timeout=None):
+        """
+        GETs url and returns the final URL after redirects, the response headers and the complete body
+        """
+        timeout = timeout if timeout is not None else settings.stream_timeout
+        for _ in range(_max_redirects + 1):
+            parsed_url = urlparse(url)
+            key = (parsed_url.scheme, parsed_url.hostname, parsed_url.port)
+            reader, writer, head = await self._send(key, parsed_url, headers, timeout)
+            try:
+                status_line, response_headers = parse_head(head)
+                status = int(status_line.split(' ', 2)[1])
+                redirect = check_response(url, status, response_headers)
+                response = UpstreamResponse(url, reader, writer, status, response_headers)
+                chunks = []
+                if redirect is None and status not in (HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED):
+                    while True:
+                        data = await asyncio.wait_for(response.read(settings.relay_chunk_size), timeout)
+                        if not data:
+                            break
+                        chunks.append(data)
+            except BaseException:
+                writer.close()
+                raise
+
+            # Only connections with a delimited body are positioned at the next response
+            delimited = response.chunked or response.remaining is not None
+            if redirect is None and delimited and 'close' not in response_headers.get('Connection', '').lower():
+                self._put(key, reader, writer)
+            else:
+                writer.close()
+            if redirect is not None:
+                url = redirect
+                continue
+            return url, response_headers, b''.join(chunks)
+        raise UpstreamError(f'Too many redirects for {url}')
+
+class RawUpstreamResponse():
+    """
+    A plain HTTP upstream response whose body has not been read from the socket yet, used by the zero-copy relay
+    """
+
+    url = ''
+    sock = None
+    status = 0
+    headers = None
+    chunked = False
+    remaining = None
+    source = None
+
+    def __init__(self, url, sock, status, headers):
+        self.url = url
+        self.sock = sock
+        self.status = status
+        self.headers = headers
+        self.chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        if not self.chunked and 'Content-Length' in headers:
+            self.remaining = int(headers['Content-Length'])
+
+    def passthrough_headers(self):
+        return passthrough_headers(self.headers)
+
+    async def to_stream(self):
+        """
+        Hands the socket over to asyncio streams for the userspace relay
+        """
+        reader, writer = await asyncio.open_connection(sock=self.sock, limit=_header_limit)
+        self.sock = None
+        upstream = UpstreamResponse(self.url, reader, writer, self.status, self.headers)
+        upstream.source = self.source
+        return upstream
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+async def wait_fd(loop, fd, writable=False):
+    waiter = loop.create_future()
+    add, remove = (loop.add_writer, loop.remove_writer) if writable else (loop.add_reader, loop.remove_reader)
+    add(fd, lambda: waiter.done() or waiter.set_result(None))
+    try:
+        await waiter
+    finally:
+        remove(fd)
+
+async def _recv_head(loop, sock):
+    """
+    Reads exactly the response head, peeking so that no body bytes are taken out of the socket
+    """
+    head = b''
+    while True:
+        await wait_fd(loop, sock.fileno())
+        peeked = sock.recv(_header_limit, socket.MSG_PEEK)
+        if not peeked:
+            raise UpstreamError('Upstream closed the connection before sending a response')
+        # Look across the boundary to the already consumed part of the head
+        overlap = head[-3:]
+        end = (overlap + peeked).find(b'\r\n\r\n')
+        if end >= 0:
+            head += sock.recv(end + 4 - len(overlap))
+            return head
+        head += sock.recv(len(peeked))
+        if len(head) > _header_limit:
+            raise UpstreamError('Upstream response head too large')
+
+async def open_raw_stream(url, headers, timeout=None):
+    """
+    Like open_stream, but for plain HTTP upstreams only and leaving the response body inside the kernel's socket buffer
+    """
+    loop = asyncio.get_running_loop()
+    timeout = timeout if timeout is not None else settings.stream_timeout
+    for _ in range(_max_redirects + 1):
+        parsed_url = urlparse(url)
+        if parsed_url.scheme != 'http':
+            raise UpstreamError(f'Unsupported URL scheme "{parsed_url.scheme}" for raw streams')
+        host = parsed_url.hostname
+        port = parsed_url.port or 80
+
+        sock = await asyncio.wait_for(connect_socket(host, port), timeout)
+        try:
+            await loop.sock_sendall(sock, build_request(parsed_url, headers))
+            sent = time.monotonic()
+            head = await asyncio.wait_for(_recv_head(loop, sock), timeout)
+            metrics.upstream_phase_seconds.observe(time.monotonic() - sent, host, 'first_byte')
+            status_line, response_headers = parse_head(head)
+            status = int(status_line.split(' ', 2)[1])
+            redirect = check_response(url, status, response_headers)
+        except BaseException:
+            sock.close()
+            raise
+
+        if redirect is not None:
+            sock.close()
+            url = redirect
+            continue
+        return RawUpstreamResponse(url, sock, status, response_headers)
+    raise UpstreamError(f'Too many redirects for {url}')
@@ -0,0 +1,96 @@
+import time
+import base64
+import logging
+
+from requests import get, post
+
+import settings
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+_reportActionBegin = 'Begin'
+_reportActionEnd = 'End'
+_divider = '|'
+_session_id_string = '{path}' + _divider + '{client}'
+
+def decode_stream_path(url):
+    """
+    Decodes the base64 encoded channel URL used in /stream/<action>/<url>
+    """
+    return base64.b64decode(url.encode('utf-8') + b'==========').decode('utf-8')
+
+def _call_manager(call, method, endpoint, **kwargs):
+    """
+    Runs a request against the manager, recording its duration and failures per call type
+    """
+    started = time.monotonic()
+    try:
+        response = method(f'{settings.reporting_url}:{settings.reporting_port}/{endpoint}', allow_redirects=True, timeout=settings.reporting_timeout, **kwargs)
+        response.raise_for_status()
+        return response
+    except Exception:
+        metrics.manager_call_errors.inc(1, call)
+        raise
+    finally:
+        metrics.manager_call_seconds.observe(time.monotonic() - started, call)
+
+def _proxy_info():
+    """
+    The proxy's registration as sent along with reports and heartbeats
+    """
+    return {
+        'name': settings.proxy_name,
+        'internal_url': settings.internal_proxy_url,
+        'internal_port': str(settings.internal_proxy_port),
+        'url': settings.external_proxy_url,
+        'port': str(settings.external_proxy_port),
+    }
+
+def send_report_batch(events):
+    """
+    Ships a batch of session events to the manager, raises if the manager didn't apply it
+    """
+    batch = {
+        'proxy': _proxy_info(),
+        'events': events,
+    }
+    return _call_manager('report', post, 'manager/report/batch/', json=batch).json()
+
+def send_heartbeat(sessions, egress, egress_capacity, cpu, draining=False):
+    """
+    Tells the manager that the proxy is alive and how loaded it is, egress in Mbit/s and CPU in percent of all cores.
+    A draining proxy gets no new stream starts from the manager.
+    """
+    heartbeat = {
+        'proxy': _proxy_info(),
+        'sessions': sessions,
+        'egress': egress,
+        'egress_capacity': egress_capacity,
+        'cpu': cpu,
+        'draining': draining,
+    }
+    _call_manager('heartbeat', post, 'manager/heartbeat/', json=heartbeat)
+
+def get_catalog(since=None):
+    params = {} if since is None else {'since': since}
+    return _call_manager('catalog', get, 'manager/get/catalog/', params=params).json()
+
+def get_popular_channels(count):
+    return _call_manager('popular', get, 'manager/get/popular/', params={'count': count}).json()
+
+def is_line_available(url):
+    result = False
+    try:
+        result = _call_manager('status', get, f'manager/get/status/{url}').text
+    except Exception as err:
+        logger.exception(f'IS_LINE_AVAILABLE: Error checking status of {url}: {err}')
+    return(result)
+
+def get_channel_opts(url):
+    result = False
+    try:
+        result = _call_manager('opts', get, f'manager/get/opts/{url}').text
+    except Exception as err:
+        logger.exception(f'GET_CHANNEL_OPTS: Error checking status of {url}: {err}')
+    return(result)
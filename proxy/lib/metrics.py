@@ -0,0 +1,248 @@
+import os
+import bisect
+import weakref
+import threading
+
+_shards = []
+_shards_lock = threading.Lock()
+_retired = {}
+_local = threading.local()
+_metrics = []
+_collectors = []
+_peers = []
+
+def _shard():
+    """
+    The calling thread's own counter storage, only ever written by that thread and therefore lock-free
+    """
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = {}
+        with _shards_lock:
+            _shards.append((weakref.ref(threading.current_thread()), shard))
+        _local.shard = shard
+        return shard
+
+def _merge(totals, shard):
+    for key, value in shard.items():
+        if isinstance(value, list):
+            merged = totals.setdefault(key, [0] * len(value))
+            for index, item in enumerate(value):
+                merged[index] += item
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+def _aggregate():
+    """
+    Sums up all thread shards, shards of finished threads are folded into the retired totals
+    """
+    totals = {}
+    with _shards_lock:
+        alive = []
+        for thread, shard in _shards:
+            if thread() is None or not thread().is_alive():
+                _merge(_retired, shard.copy())
+            else:
+                alive.append((thread, shard))
+        _shards[:] = alive
+        _merge(totals, _retired)
+    for _, shard in alive:
+        _merge(totals, shard.copy())
+    return totals
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+class Counter():
+    """
+    Monotonic counter, inc() only touches the calling thread's shard
+    """
+
+    kind = 'counter'
+    name = ''
+    description = ''
+    labels = ()
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        _metrics.append(self)
+
+    def inc(self, value=1, *label_values):
+        shard = _shard()
+        key = (self.name, label_values)
+        shard[key] = shard.get(key, 0) + value
+
+    def samples(self, totals, extra, gauges):
+        values = {key[1]: value for key, value in totals.items() if key[0] == self.name}
+        for label_values, value in extra.get(self.name, {}).items():
+            values[label_values] = values.get(label_values, 0) + value
+        return [f'{self.name}{_format_labels(self.labels, label_values)} {value}' for label_values, value in sorted(values.items())]
+
+class Gauge():
+    """
+    Point in time value, read from a callback returning {label values: value} on scrape.
+    merge combines the values of the same labels from several worker processes.
+    """
+
+    kind = 'gauge'
+    name = ''
+    description = ''
+    labels = ()
+    callback = None
+    merge = None
+
+    def __init__(self, name, description, callback, labels=(), merge=sum):
+        self.name = name
+        self.description = description
+        self.callback = callback
+        self.labels = tuple(labels)
+        self.merge = merge
+        _metrics.append(self)
+
+    def samples(self, totals, extra, gauges):
+        return [f'{self.name}{_format_labels(self.labels, label_values)} {self.merge(values)}' for label_values, values in sorted(gauges.get(self.name, {}).items())]
+
+class Histogram():
+    """
+    Cumulative histogram with fixed buckets, observe() only touches the calling thread's shard
+    """
+
+    kind = 'histogram'
+    name = ''
+    description = ''
+    labels = ()
+    buckets = ()
+
+    def __init__(self, name, description, buckets, labels=()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        shard = _shard()
+        key = (self.name, label_values)
+        counts = shard.get(key)
+        if counts is None:
+            # One slot per bucket, +Inf, sum
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self, totals, extra, gauges):
+        lines = []
+        for key, counts in sorted((key, value) for key, value in totals.items() if key[0] == self.name):
+            label_values = key[1]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, label_values, [("le", le)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, label_values)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}')
+        return lines
+
+def add_collector(collector):
+    """
+    Registers a callback returning {counter name: {label values: value}} that is added to the counters on scrape,
+    used for values that are tracked elsewhere anyway (e.g. bytes of running sessions)
+    """
+    _collectors.append(collector)
+
+def add_peers(peers):
+    """
+    Registers a callback returning the collect() results of the other processes of a multi-worker proxy, merged in on scrape
+    """
+    _peers.append(peers)
+
+def collect():
+    """
+    This process' counter totals, collector values and gauge values, for render() here or in another worker process
+    """
+    extra = {}
+    for collector in _collectors:
+        for name, values in collector().items():
+            target = extra.setdefault(name, {})
+            for label_values, value in values.items():
+                target[label_values] = target.get(label_values, 0) + value
+    gauges = {metric.name: metric.callback() for metric in _metrics if metric.kind == 'gauge'}
+    return _aggregate(), extra, gauges
+
+def merged():
+    """
+    The collect() results of this and all other worker processes combined, gauges as lists of the per process values
+    """
+    states = [collect()]
+    for peers in _peers:
+        states += peers()
+    totals = {}
+    extra = {}
+    gauges = {}
+    for state_totals, state_extra, state_gauges in states:
+        _merge(totals, state_totals)
+        for name, values in state_extra.items():
+            target = extra.setdefault(name, {})
+            for label_values, value in values.items():
+                target[label_values] = target.get(label_values, 0) + value
+        for name, values in state_gauges.items():
+            target = gauges.setdefault(name, {})
+            for label_values, value in values.items():
+                target.setdefault(label_values, []).append(value)
+    return totals, extra, gauges
+
+def total(name, state):
+    """
+    A counter or gauge of a merged() state summed over all its labels and processes
+    """
+    totals, extra, gauges = state
+    counted = sum(value for key, value in totals.items() if key[0] == name) + sum(extra.get(name, {}).values())
+    return counted + sum(sum(values) for values in gauges.get(name, {}).values())
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format
+    """
+    totals, extra, gauges = merged()
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines += metric.samples(totals, extra, gauges)
+    return '\n'.join(lines) + '\n'
+
+_latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_wait_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+bytes_by_client = Counter('iptv_proxy_client_bytes_total', 'Bytes relayed to a client', ('client', ))
+bytes_by_upstream = Counter('iptv_proxy_upstream_bytes_total', 'Bytes relayed from an upstream host to clients', ('upstream', ))
+sessions_total = Counter('iptv_proxy_sessions_total', 'Stream sessions started')
+admission_rejects = Counter('iptv_proxy_admission_rejects_total', 'Stream starts rejected because no upstream line was available (429)')
+upstream_errors = Counter('iptv_proxy_upstream_errors_total', 'Stream starts failed because the upstream could not be opened (504)')
+upstream_connect_seconds = Histogram('iptv_proxy_upstream_connect_seconds', 'Time until the upstream response head was received', _latency_buckets, ('upstream', ))
+time_to_first_byte_seconds = Histogram('iptv_proxy_time_to_first_byte_seconds', 'Time from the stream start request until the first byte was sent to the client', _latency_buckets)
+manager_call_seconds = Histogram('iptv_proxy_manager_call_seconds', 'Duration of calls to the manager', _latency_buckets, ('call', ))
+manager_call_errors = Counter('iptv_proxy_manager_call_errors_total', 'Failed calls to the manager', ('call', ))
+hls_cache_requests = Counter('iptv_proxy_hls_cache_requests_total', 'HLS playlist and segment requests by cache result', ('result', ))
+source_starts = Counter('iptv_proxy_source_starts_total', 'Raced upstream starts by the source that delivered first', ('source', ))
+upstream_phase_seconds = Histogram('iptv_proxy_upstream_phase_seconds', 'Duration of the upstream connect phases (dns, tcp, tls, first_byte)', _latency_buckets, ('upstream', 'phase'))
+dns_lookups = Counter('iptv_proxy_dns_lookups_total', 'Upstream host name lookups by DNS cache result', ('result', ))
+tls_handshakes = Counter('iptv_proxy_tls_handshakes_total', 'Upstream TLS handshakes by whether a cached session was resumed', ('resumed', ))
+shaping_delay_seconds = Counter('iptv_proxy_shaping_delay_seconds_total', 'Seconds relays waited for a rate limit, by the limit that applied (global, client, upstream)', ('scope', ))
+upstream_reconnects = Counter('iptv_proxy_upstream_reconnects_total', 'Upstreams reopened mid-stream, by cause (stall, closed, error) and result', ('reason', 'result'))
+prewarm_results = Counter('iptv_proxy_prewarm_total', 'Pre-warmed upstreams by reason (popular, neighbour, linger) and outcome: hit when a viewer took it over, miss when it was closed unused, evicted for a viewer of another channel, failed', ('reason', 'result'))
+multicast_datagrams = Counter('iptv_proxy_multicast_datagrams_total', 'Datagrams of udp:// and rtp:// upstreams by group and result: received, lost and reordered (RTP sequence gaps and late arrivals), duplicate', ('group', 'result'))
+admission_wait_seconds = Histogram('iptv_proxy_admission_wait_seconds', 'Time stream starts waited for an upstream line, by result: admitted, timeout, or full when the queue was', _wait_buckets, ('result', ))
+ts_errors = Counter('iptv_proxy_ts_errors_total', 'MPEG-TS errors found in the analyzed share of a channel (TS_ANALYZER_SAMPLE), by channel and error: continuity, sync', ('channel', 'error'))
+cpu_seconds = Counter('iptv_proxy_cpu_seconds_total', 'CPU time used by the proxy processes')
+
+add_collector(lambda: {cpu_seconds.name: {(): sum(os.times()[:2])}})
@@ -0,0 +1,205 @@
+import socket
+import asyncio
+import logging
+import ipaddress
+
+from urllib.parse import urlparse
+
+import settings
+from lib import metrics
+from lib.ts import SYNC_BYTE, PacketAligner
+from lib.http_client import UpstreamError, wait_fd
+
+logger = logging.getLogger(__name__)
+
+_schemes = ('udp', 'rtp')
+_max_datagram = 65536
+_rtp_header_size = 12
+_rtp_version = 2
+# Fallbacks for Python builds that don't expose the Linux constants
+_SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+_IP_ADD_SOURCE_MEMBERSHIP = getattr(socket, 'IP_ADD_SOURCE_MEMBERSHIP', 39)
+_IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)
+
+def is_multicast(url):
+    return urlparse(url).scheme in _schemes
+
+def parse_multicast_url(url):
+    """
+    Group, port and source of a udp:// or rtp:// URL in the usual forms: udp://@239.1.1.1:1234, rtp://239.1.1.1:5000,
+    or udp://10.0.0.1@232.1.1.1:1234 for a source-specific group
+    """
+    parsed_url = urlparse(url)
+    try:
+        group = ipaddress.IPv4Address(parsed_url.hostname or '0.0.0.0')
+        source = ipaddress.IPv4Address(parsed_url.username) if parsed_url.username else None
+        port = parsed_url.port
+    except ValueError as err:
+        raise UpstreamError(f'Invalid multicast URL {url}: {err}')
+    if not port:
+        raise UpstreamError(f'Invalid multicast URL {url}: No port')
+    return group, port, source
+
+def rtp_payload(datagram):
+    """
+    The payload of an RTP datagram, without header, CSRC list, header extension and padding
+    """
+    offset = _rtp_header_size + 4 * (datagram[0] & 0x0f)
+    if datagram[0] & 0x10:
+        if len(datagram) < offset + 4:
+            return b''
+        offset += 4 + 4 * ((datagram[offset + 2] << 8) | datagram[offset + 3])
+    end = len(datagram)
+    if datagram[0] & 0x20:
+        end -= datagram[end - 1]
+    return datagram[offset:end] if offset < end else b''
+
+class SequenceTracker():
+    """
+    Counts lost and reordered RTP datagrams by their 16 bit sequence numbers. Late datagrams are passed on as they arrive,
+    the gap they left was already counted as lost by then.
+    """
+
+    label = ''
+    expected = None
+
+    def __init__(self, label):
+        self.label = label
+        self.expected = None
+
+    def observe(self, sequence):
+        if self.expected is None:
+            self.expected = (sequence + 1) & 0xffff
+            return
+        gap = (sequence - self.expected) & 0xffff
+        if gap == 0:
+            self.expected = (sequence + 1) & 0xffff
+        elif gap < 0x8000:
+            metrics.multicast_datagrams.inc(gap, self.label, 'lost')
+            self.expected = (sequence + 1) & 0xffff
+        else:
+            metrics.multicast_datagrams.inc(1, self.label, 'reordered' if gap != 0xffff else 'duplicate')
+
+class MulticastUpstream():
+    """
+    A UDP (multicast) TS source read like an upstream HTTP response: the group is joined on open, RTP headers are stripped
+    and every read returns all datagrams received by then as one TS packet aligned chunk, up to the requested size.
+    """
+
+    url = ''
+    source = None
+    status = 200
+    headers = None
+    chunked = False
+    remaining = None
+    sock = None
+    label = ''
+    buffer = None
+    view = None
+    aligner = None
+    tracker = None
+
+    def __init__(self, url, sock, label):
+        self.url = url
+        self.sock = sock
+        self.label = label
+        self.headers = {'Content-Type': 'video/mp2t'}
+        self.buffer = bytearray(_max_datagram)
+        self.view = memoryview(self.buffer)
+        self.aligner = PacketAligner()
+        self.tracker = SequenceTracker(label)
+        self._unread = b''
+
+    def unread(self, data):
+        self._unread = data + self._unread
+
+    async def read(self, size):
+        if self._unread:
+            data, self._unread = self._unread[:size], self._unread[size:]
+            return data
+        loop = asyncio.get_running_loop()
+        while self.sock is not None:
+            data = self.receive(size)
+            if data:
+                return data
+            await wait_fd(loop, self.sock.fileno())
+        return b''
+
+    def receive(self, size):
+        """
+        Drains the socket's receive queue without blocking, until it's empty or about size bytes were collected
+        """
+        chunk = bytearray()
+        datagrams = 0
+        while len(chunk) < size:
+            try:
+                count = self.sock.recv_into(self.buffer)
+            except BlockingIOError:
+                break
+            datagrams += 1
+            datagram = self.view[:count]
+            if count > _rtp_header_size and datagram[0] != SYNC_BYTE and datagram[0] >> 6 == _rtp_version:
+                self.tracker.observe((datagram[2] << 8) | datagram[3])
+                datagram = rtp_payload(datagram)
+            chunk += datagram
+        if datagrams:
+            metrics.multicast_datagrams.inc(datagrams, self.label, 'received')
+        return self.aligner.feed(bytes(chunk)) if chunk else b''
+
+    @property
+    def read_timeout(self):
+        return settings.stream_timeout
+
+    def passthrough_headers(self):
+        return dict(self.headers)
+
+    def close(self):
+        if self.sock is not None:
+            # Closing the socket leaves the group
+            self.sock.close()
+            self.sock = None
+
+def _receive_buffer(sock):
+    """
+    Sets the socket's receive buffer to MULTICAST_RECEIVE_BUFFER, beyond net.core.rmem_max where the process may do so
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, _SO_RCVBUFFORCE, settings.multicast_receive_buffer)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, settings.multicast_receive_buffer)
+    # Linux reports twice the size set, for its bookkeeping
+    granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+    if granted < settings.multicast_receive_buffer:
+        logger.warning(f'MULTICAST: Receive buffer limited to {granted} bytes, raise net.core.rmem_max to avoid losses at high bitrates')
+
+async def open_multicast(url):
+    """
+    Joins the group of a udp:// or rtp:// URL on MULTICAST_INTERFACE and returns the MulticastUpstream receiving it
+    """
+    group, port, source = parse_multicast_url(url)
+    interface = ipaddress.IPv4Address(settings.multicast_interface or '0.0.0.0')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        _receive_buffer(sock)
+        if group.is_multicast:
+            # Bound to the group, so that other groups on the same port joined by this process don't arrive here as well
+            try:
+                sock.setsockopt(socket.IPPROTO_IP, _IP_MULTICAST_ALL, 0)
+            except OSError:
+                pass  # Linux only
+            sock.bind((str(group), port))
+            if source is not None:
+                sock.setsockopt(socket.IPPROTO_IP, _IP_ADD_SOURCE_MEMBERSHIP, group.packed + interface.packed + source.packed)
+            else:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, group.packed + interface.packed)
+        else:
+            # Unicast UDP sent to this host
+            sock.bind((str(group), port))
+        sock.setblocking(False)
+    except OSError as err:
+        sock.close()
+        raise UpstreamError(f'Could not join {url}: {err}')
+    label = f'{group}:{port}'
+    logger.info(f'MULTICAST: Joined {label}{f" from {source}" if source is not None else ""}')
+    return MulticastUpstream(url, sock, label)
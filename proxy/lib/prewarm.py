@@ -0,0 +1,168 @@
+import time
+import asyncio
+import logging
+
+import settings
+from lib import metrics
+from lib.drain import drain
+from lib.manager_client import get_popular_channels
+
+logger = logging.getLogger(__name__)
+
+_check_interval = 5
+# Seconds a client's last channel is remembered to tell the direction it zaps in
+_zap_memory = 60
+
+class Prewarmer():
+    """
+    Keeps shared upstreams open ahead of viewers, so that starting them needs no upstream connect:
+    the PREWARM_CHANNELS channels most watched at this time of day by the manager's stats, and for PREWARM_NEIGHBOURS
+    the channel a client is likely to zap to next, i.e. the neighbour in the group in the direction it zapped.
+    Warm lines are only taken while their upstream keeps PREWARM_SPARE_LINES free and are given up as soon as a viewer needs one.
+    With LINGER_TIMEOUT, a channel's upstream stays open for that long after its last viewer left, for viewers zapping back,
+    on a held line that is given up just the same.
+    """
+
+    hubs = None
+    catalog = None
+    opener = None
+    warm = None
+    popular = None
+    last_popular_refresh = 0
+    last_channels = None
+
+    def __init__(self, hubs, catalog, opener):
+        self.hubs = hubs
+        self.catalog = catalog
+        self.opener = opener
+        # Hub key -> (hub, channel, reason, expiry or None)
+        self.warm = {}
+        self.popular = []
+        self.last_popular_refresh = 0
+        # Client -> (channel URL, time)
+        self.last_channels = {}
+        hubs.on_adopt = self.adopted
+        if settings.linger_timeout > 0:
+            hubs.on_idle = self.linger
+
+    def register_metrics(self):
+        metrics.Gauge('iptv_proxy_prewarmed_upstreams', 'Upstreams kept open without a viewer, by reason (popular, neighbour, linger)', self.counts, ('reason', ))
+
+    def counts(self):
+        counts = {('popular', ): 0, ('neighbour', ): 0, ('linger', ): 0}
+        for _, _, reason, _ in list(self.warm.values()):
+            counts[(reason, )] += 1
+        return counts
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if settings.prewarm_channels > 0 and time.monotonic() - self.last_popular_refresh >= settings.prewarm_interval:
+                    self.last_popular_refresh = time.monotonic()
+                    popular = await loop.run_in_executor(None, get_popular_channels, settings.prewarm_channels)
+                    self.popular = [channel['url'] for channel in popular['channels']]
+                    logger.info(f'PREWARM: {len(self.popular)} popular channel(s) for hour {popular["hour"]}')
+                self.expire()
+                for url in self.popular:
+                    channel = self.catalog.lookup(url)
+                    if channel is not None:
+                        await self.warm_up(channel, 'popular')
+            except Exception as err:
+                logger.warning(f'PREWARM: Update failed: {err!r}')
+            await asyncio.sleep(_check_interval)
+
+    async def warm_up(self, channel, reason, timeout=None):
+        key = channel['url']
+        entry = self.warm.get(key)
+        if entry is not None:
+            if timeout is not None and entry[3] is not None:
+                self.warm[key] = entry[:3] + (time.monotonic() + timeout, )
+            return
+        active = self.hubs.hubs.get(key)
+        if active is not None and not active.ended:
+            return  # Watched already
+        if not await self.catalog.reserve_line_async(channel, settings.prewarm_spare_lines, held=True):
+            return
+        hub = self.hubs.create(key, warm=True)
+        self.warm[key] = (hub, channel, reason, time.monotonic() + timeout if timeout is not None else None)
+        try:
+            await self.hubs.open(hub, lambda: self.opener(channel))
+        except Exception as err:
+            logger.warning(f'PREWARM: Opening {key} failed: {err!r}')
+            if key in self.warm and self.warm[key][0] is hub:
+                del self.warm[key]
+            self.catalog.release_line(channel, held=True)
+            metrics.prewarm_results.inc(1, reason, 'failed')
+            return
+        logger.info(f'PREWARM: Opened {key} ({reason})')
+
+    def linger(self, hub):
+        """
+        Keeps the upstream of a hub whose last viewer left open for LINGER_TIMEOUT seconds, returns whether it does.
+        The hub goes on filling its ring buffer, so that a viewer coming back starts at the latest keyframe right away.
+        """
+        channel = hub.upstream.source if hub.upstream is not None else None
+        if channel is None or drain.draining or hub.key in self.warm:
+            return False
+        self.catalog.hold_line(channel)
+        hub.warm = True
+        self.warm[hub.key] = (hub, channel, 'linger', time.monotonic() + settings.linger_timeout)
+        asyncio.get_running_loop().call_later(settings.linger_timeout, self.expire)
+        logger.info(f'PREWARM: Keeping {hub.key} open for {settings.linger_timeout}s after its last viewer left')
+        return True
+
+    def adopted(self, hub):
+        entry = self.warm.get(hub.key)
+        if entry is None or entry[0] is not hub:
+            return
+        del self.warm[hub.key]
+        _, channel, reason, _ = entry
+        self.catalog.adopt_line(channel)
+        metrics.prewarm_results.inc(1, reason, 'hit')
+
+    def drop(self, key, result):
+        hub, channel, reason, _ = self.warm.pop(key)
+        self.hubs.drop(hub)
+        self.catalog.release_line(channel, held=True)
+        metrics.prewarm_results.inc(1, reason, result)
+
+    def expire(self):
+        now = time.monotonic()
+        for key, (hub, _, reason, expiry) in list(self.warm.items()):
+            if not hub.ready.done() or not hub.warm:
+                continue  # Still opening, or being taken over by a viewer
+            if hub.ended:
+                self.drop(key, 'failed')
+            elif (reason == 'popular' and key not in self.popular) or (expiry is not None and now >= expiry):
+                self.drop(key, 'miss')
+        self.last_channels = {client: last for client, last in self.last_channels.items() if now - last[1] < _zap_memory}
+
+    def evict(self, upstream_id):
+        """
+        Gives a held line of the upstream back for a viewer, returns whether there was one
+        """
+        for key, (hub, channel, _, _) in list(self.warm.items()):
+            if channel['upstream_id'] == upstream_id and hub.ready.done() and hub.warm:
+                logger.info(f'PREWARM: Closing {key}, a viewer needs its line')
+                self.drop(key, 'evicted')
+                return True
+        return False
+
+    def zapped(self, client, channel):
+        """
+        Warms the channels a client may zap to next from channel: the neighbour in the direction it zapped, or both neighbours
+        """
+        if not settings.prewarm_neighbours:
+            return
+        previous = self.last_channels.get(client)
+        self.last_channels[client] = (channel['url'], time.monotonic())
+        before, after = self.catalog.neighbours(channel)
+        candidates = [before, after]
+        if previous is not None and before is not None and previous[0] == before['url']:
+            candidates = [after]
+        elif previous is not None and after is not None and previous[0] == after['url']:
+            candidates = [before]
+        for candidate in candidates:
+            if candidate is not None:
+                asyncio.ensure_future(self.warm_up(candidate, 'neighbour', settings.prewarm_neighbour_timeout))
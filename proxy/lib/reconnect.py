@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+import settings
+from lib import metrics
+from lib.ts import PacketAligner
+
+logger = logging.getLogger(__name__)
+
+class ResilientUpstream():
+    """
+    An upstream stream that outlives stalls: when no data arrived for STALL_TIMEOUT seconds or the connection broke,
+    reopen() connects to the source again on the same line and the new stream continues at the next TS packet boundary.
+    The client connection stays open meanwhile. Gives up after STALL_RECONNECTS failed attempts in a row.
+    """
+
+    # Reads bound their own waiting time
+    read_timeout = None
+    upstream = None
+    reopen = None
+    aligner = None
+    attempts = 0
+
+    def __init__(self, upstream, reopen):
+        self.upstream = upstream
+        self.reopen = reopen
+        self.aligner = PacketAligner()
+        self.attempts = 0
+
+    @property
+    def url(self):
+        return self.upstream.url
+
+    @property
+    def source(self):
+        return self.upstream.source
+
+    def passthrough_headers(self):
+        return self.upstream.passthrough_headers()
+
+    async def read(self, size):
+        while True:
+            try:
+                # Until the first data arrived the source may take its usual time to start
+                data = await asyncio.wait_for(self.upstream.read(size), settings.stall_timeout if self.aligner.ts is not None else settings.stream_timeout)
+                # A delimited body that ended is complete, only endless live streams are picked up again
+                reason = None if data or self.upstream.chunked or self.upstream.remaining is not None else 'closed'
+            except asyncio.TimeoutError as err:
+                reason, error = 'stall', err
+            except (ConnectionError, asyncio.IncompleteReadError) as err:
+                reason, error = 'error', err
+            else:
+                error = None
+            if reason is None:
+                if not data:
+                    return data
+                aligned = self.aligner.feed(data)
+                if aligned:
+                    self.attempts = 0
+                    return aligned
+                continue  # Only part of a packet so far
+            if not self.aligner.ts:
+                # Not a TS stream, which can't be continued from another connection
+                if error is not None:
+                    raise error
+                return data
+            await self._reconnect(reason, error)
+
+    async def _reconnect(self, reason, error):
+        while True:
+            if self.attempts >= settings.stall_reconnects:
+                logger.warning(f'RECONNECT: Giving up on {self.url} after {self.attempts} attempt(s)')
+                if error is not None:
+                    raise error
+                raise ConnectionAbortedError(f'{self.url} closed the connection')
+            self.attempts += 1
+            logger.warning(f'RECONNECT: {self.url} {"stalled" if reason == "stall" else "broke off"}, reconnecting (attempt {self.attempts})')
+            self.upstream.close()
+            try:
+                upstream = await self.reopen()
+            except Exception as err:
+                logger.warning(f'RECONNECT: Reopening {self.url} failed: {err!r}')
+                metrics.upstream_reconnects.inc(1, reason, 'failed')
+                error = err
+                continue
+            upstream.source = self.upstream.source
+            self.upstream = upstream
+            self.aligner.restart()
+            metrics.upstream_reconnects.inc(1, reason, 'reconnected')
+            return
+
+    def close(self):
+        self.upstream.close()
@@ -0,0 +1,88 @@
+import time
+import queue
+import logging
+import threading
+
+import settings
+from lib.manager_client import send_report_batch, decode_stream_path, _session_id_string
+
+logger = logging.getLogger(__name__)
+
+class SessionReporter():
+    """
+    Reports session Begin/End events to the manager from a background thread, so that reporting never blocks a stream.
+    Events carry sequence numbers that keep increasing across restarts and are shipped in order, in batches of up to
+    REPORT_BATCH_SIZE. A failed batch is retried until the manager accepts it, the manager skips events it already applied.
+    """
+
+    events = None
+    seq = 0
+    # Called with every batch the manager acknowledged, e.g. ChannelCatalog.acknowledge
+    on_acknowledged = None
+
+    def __init__(self):
+        self.events = queue.Queue(maxsize=settings.report_queue_size)
+        # Microseconds since the epoch, so a restarted proxy continues above its previous sequence numbers
+        self.seq = time.time_ns() // 1000
+        self._seq_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._ship_loop, name='session-reporter', daemon=True)
+        self._thread.start()
+
+    def report(self, action, client, ua_string, url, line=True):
+        """
+        Queues a session Begin/End, line tells the manager whether the session opened/closed an upstream connection
+        """
+        with self._seq_lock:
+            self.seq += 1
+            event = {
+                'seq': self.seq,
+                'time': time.time(),
+                'action': action,
+                'client': client,
+                'user_agent': ua_string,
+                'url': url,
+                'line': line,
+            }
+            try:
+                # Queued under the lock as well, so the queue stays in sequence order
+                self.events.put_nowait(event)
+            except queue.Full:
+                logger.error(f'REPORT: Queue full, dropping {action} report for {url}')
+                return
+        path = decode_stream_path(url.removeprefix('/stream/start/'))
+        logger.info(f'REPORT: Queued {action} {_session_id_string.format(path=path, client=client)}')
+
+    def flush(self, timeout):
+        """
+        Waits until all queued reports are shipped, returns whether they were within timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        while self.events.unfinished_tasks > 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        return self.events.unfinished_tasks == 0
+
+    def _ship_loop(self):
+        while True:
+            batch = [self.events.get()]
+            # Give events that are close together a chance to share the request
+            deadline = time.monotonic() + settings.report_batch_delay / 1000
+            while len(batch) < settings.report_batch_size:
+                try:
+                    batch.append(self.events.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            while True:
+                try:
+                    result = send_report_batch(batch)
+                    logger.info(f'REPORT: Shipped {len(batch)} report(s), {result["applied"]} applied, last sequence number {result["last_seq"]}')
+                    if self.on_acknowledged is not None:
+                        self.on_acknowledged(batch)
+                    for _ in batch:
+                        self.events.task_done()
+                    break
+                except Exception as err:
+                    logger.warning(f'REPORT: Shipping {len(batch)} report(s) failed, retrying in {settings.report_retry_interval}s: {err}')
+                    time.sleep(settings.report_retry_interval)
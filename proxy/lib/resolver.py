@@ -0,0 +1,90 @@
+import time
+import socket
+import asyncio
+import logging
+
+import settings
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+# Cached addresses are served for this many TTLs while refreshes keep failing, e.g. during a resolver outage
+_stale_ttls = 10
+
+class ResolvedHost():
+    """
+    The cached addresses of a host and port
+    """
+
+    addresses = None
+    resolved = 0
+    refreshing = None
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.resolved = time.monotonic()
+        self.refreshing = None
+
+    @property
+    def age(self):
+        return time.monotonic() - self.resolved
+
+class Resolver():
+    """
+    Cache of upstream host name lookups. Entries are fresh for DNS_CACHE_TTL seconds, the system resolver doesn't expose record TTLs.
+    Once expired they are still used while a lookup refreshes them in the background, so that only the first connection to a host waits for DNS.
+    Concurrent lookups of the same host share one query.
+    """
+
+    entries = None
+    pending = None
+
+    def __init__(self):
+        self.entries = {}
+        self.pending = {}
+
+    async def resolve(self, host, port):
+        """
+        Returns the getaddrinfo() results for a TCP connection to host and port
+        """
+        if settings.dns_cache_ttl <= 0:
+            return await self._lookup(host, port)
+        key = (host, port)
+        entry = self.entries.get(key)
+        if entry is not None and entry.age < settings.dns_cache_ttl:
+            metrics.dns_lookups.inc(1, 'hit')
+            return entry.addresses
+        if entry is not None and entry.age < _stale_ttls * settings.dns_cache_ttl:
+            metrics.dns_lookups.inc(1, 'stale')
+            if entry.refreshing is None:
+                entry.refreshing = asyncio.ensure_future(self._refresh(key, entry))
+            return entry.addresses
+        metrics.dns_lookups.inc(1, 'miss')
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self._lookup(host, port))
+            self.pending[key].add_done_callback(lambda task: self._store(key, task))
+        return await asyncio.shield(self.pending[key])
+
+    async def _lookup(self, host, port):
+        return await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+
+    def _store(self, key, task):
+        del self.pending[key]
+        if not task.cancelled() and task.exception() is None:
+            self.entries[key] = ResolvedHost(task.result())
+
+    async def _refresh(self, key, entry):
+        try:
+            self.entries[key] = ResolvedHost(await self._lookup(*key))
+        except Exception as err:
+            logger.warning(f'RESOLVER: Refreshing {key[0]} failed, keeping the cached addresses: {err!r}')
+        finally:
+            entry.refreshing = None
+
+    def forget(self, host, port):
+        """
+        Drops a host whose cached addresses could not be connected to
+        """
+        self.entries.pop((host, port), None)
+
+resolver = Resolver()
@@ -0,0 +1,134 @@
+import math
+import time
+import asyncio
+import logging
+
+from collections import deque
+
+import settings
+from lib.ts import TS_PACKET_SIZE, ProgramTables, find_random_access
+
+logger = logging.getLogger(__name__)
+
+class LiveSegment():
+    """
+    A finished HLS segment, immutable once published
+    """
+
+    sequence = 0
+    duration = 0
+    data = b''
+
+    def __init__(self, sequence, duration, data):
+        self.sequence = sequence
+        self.duration = duration
+        self.data = data
+
+class TsSegmenter():
+    """
+    Cuts a channel's shared upstream into HLS segments of about HLS_OUTPUT_SEGMENT_DURATION seconds at TS packet boundaries,
+    preferably at keyframes, and keeps the last HLS_OUTPUT_WINDOW of them. Every segment starts with the PAT and PMT.
+    """
+
+    key = ''
+    hub = None
+    cursor = None
+    segments = None
+    sequence = 0
+    ended = False
+    published = None
+
+    def __init__(self, key, hub):
+        self.key = key
+        self.hub = hub
+        self.cursor = hub.join()
+        self.segments = deque(maxlen=settings.hls_output_window)
+        self.sequence = 0
+        self.ended = False
+        self.published = asyncio.Event()
+        self._tables = ProgramTables()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        target = settings.hls_output_segment_duration
+        buffer = bytearray()
+        carry = b''
+        started = False
+        segment_start = time.monotonic()
+        try:
+            while True:
+                data = await self.cursor.read(settings.relay_chunk_size)
+                if not data:
+                    break
+                data = carry + bytes(data)
+                aligned = len(data) - len(data) % TS_PACKET_SIZE
+                data, carry = data[:aligned], data[aligned:]
+                self._tables.scan(data)
+
+                elapsed = time.monotonic() - segment_start
+                if not started or elapsed >= target:
+                    # Cut at the first keyframe, or anywhere once no keyframe showed up for twice the target duration
+                    cut = find_random_access(data)
+                    if cut is None and elapsed >= 2 * target:
+                        cut = 0
+                    if cut is not None:
+                        if started:
+                            buffer += data[:cut]
+                            self.publish(time.monotonic() - segment_start, bytes(buffer))
+                        started = True
+                        segment_start = time.monotonic()
+                        buffer = bytearray(self._tables.packets())
+                        data = data[cut:]
+                    elif not started:
+                        continue
+                buffer += data
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.warning(f'SEGMENTER {self.key}: Failed: {err!r}')
+        finally:
+            self.ended = True
+            self.published.set()
+            logger.info(f'SEGMENTER {self.key}: Ended after {self.sequence} segment(s)')
+
+    def publish(self, duration, data):
+        self.segments.append(LiveSegment(self.sequence, duration, data))
+        self.sequence += 1
+        # Wake every waiting playlist request, the event is only used as a broadcast
+        self.published.set()
+        self.published.clear()
+
+    async def wait_ready(self, timeout):
+        """
+        Waits until the first segment has been published, returns False if the upstream ended before
+        """
+        while not self.segments and not self.ended:
+            await asyncio.wait_for(self.published.wait(), timeout)
+        return bool(self.segments)
+
+    def segment(self, sequence):
+        for segment in self.segments:
+            if segment.sequence == sequence:
+                return segment
+        return None
+
+    def playlist(self, segment_url):
+        """
+        Live media playlist of the current window, segment_url(sequence) returns the URI of a segment
+        """
+        segments = list(self.segments)
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            f'#EXT-X-TARGETDURATION:{math.ceil(max(segment.duration for segment in segments))}',
+            f'#EXT-X-MEDIA-SEQUENCE:{segments[0].sequence}',
+        ]
+        for segment in segments:
+            lines.append(f'#EXTINF:{segment.duration:.3f},')
+            lines.append(segment_url(segment.sequence))
+        if self.ended:
+            lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self._task.cancel()
@@ -0,0 +1,179 @@
+import os
+import time
+import socket
+import logging
+import threading
+
+from urllib.parse import urlparse
+
+from lib import metrics
+from lib.manager_client import _session_id_string
+
+logger = logging.getLogger(__name__)
+
+def shutdown_socket(fd):
+    """
+    Shuts a socket down through a duplicate of its descriptor, so that its owner can still close it normally
+    """
+    sock = socket.socket(fileno=os.dup(fd))
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # Already disconnected
+    finally:
+        sock.close()
+
+class StreamSession():
+    """
+    A running stream session, cancel() tears down both its client and upstream leg
+    """
+
+    session_id = ''
+    path = ''
+    client = ''
+    upstream = ''
+    start_time = 0
+    request_time = 0
+    bytes_relayed = 0
+    cancel_handle = None
+    shaping = None
+    quality = None
+
+    def __init__(self, path, client, cancel_handle, request_time):
+        self.session_id = _session_id_string.format(path=path, client=client)
+        self.path = path
+        self.client = client
+        self.upstream = urlparse(path).hostname or ''
+        self.start_time = time.time()
+        self.request_time = request_time
+        self.bytes_relayed = 0
+        self.cancel_handle = cancel_handle
+        self.shaping = None
+        # AnalyzerView of the session's channel with TS_ANALYZER_SAMPLE
+        self.quality = None
+
+    def relayed(self, count):
+        """
+        Accounts count bytes sent to the client, called for every chunk on the relay path
+        """
+        if self.bytes_relayed == 0:
+            metrics.time_to_first_byte_seconds.observe(time.monotonic() - self.request_time)
+        self.bytes_relayed += count
+
+    def throttle(self, count):
+        """
+        Seconds to wait after sending count bytes to stay within the session's rate limits
+        """
+        return self.shaping.take(count) if self.shaping is not None else 0
+
+    def cancel(self):
+        self.cancel_handle()
+
+    def to_dict(self):
+        session = {
+            'session': self.session_id,
+            'path': self.path,
+            'client': self.client,
+            'start_time': self.start_time,
+            'bytes_relayed': self.bytes_relayed,
+        }
+        if self.quality is not None:
+            session['stream_quality'] = self.quality.summary()
+        return session
+
+class SessionRegistry():
+    """
+    Running stream sessions by session ID
+    """
+
+    sessions = None
+    finished_bytes_by_client = None
+    finished_bytes_by_upstream = None
+
+    def __init__(self):
+        self.sessions = {}
+        self.finished_bytes_by_client = {}
+        self.finished_bytes_by_upstream = {}
+        self._lock = threading.Lock()
+
+    def register_metrics(self):
+        metrics.Gauge('iptv_proxy_sessions_active', 'Running stream sessions', lambda: {(): len(self.sessions)})
+        metrics.Gauge('iptv_proxy_session_bytes', 'Bytes relayed in a running stream session', self.bytes_by_session, ('session', ))
+        metrics.add_collector(self.relayed_bytes)
+
+    def bytes_by_session(self):
+        with self._lock:
+            return {(session.session_id, ): session.bytes_relayed for session in self.sessions.values()}
+
+    def relayed_bytes(self):
+        """
+        Bytes relayed per client and upstream host, of finished and running sessions.
+        Taken under the lock that moves a session's bytes to the finished totals, so the counters never go backwards.
+        """
+        with self._lock:
+            by_client = dict(self.finished_bytes_by_client)
+            by_upstream = dict(self.finished_bytes_by_upstream)
+            for session in self.sessions.values():
+                by_client[(session.client, )] = by_client.get((session.client, ), 0) + session.bytes_relayed
+                by_upstream[(session.upstream, )] = by_upstream.get((session.upstream, ), 0) + session.bytes_relayed
+        return {metrics.bytes_by_client.name: by_client, metrics.bytes_by_upstream.name: by_upstream}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, session):
+        metrics.sessions_total.inc()
+        with self._lock:
+            replaced = self.sessions.get(session.session_id)
+            if replaced is not None:
+                self._finish(replaced)
+            self.sessions[session.session_id] = session
+            count = len(self.sessions)
+        logger.info(f'SESSIONS: Added {session.session_id}, {count} active session(s)')
+
+    def remove(self, session):
+        with self._lock:
+            # The same client may have restarted the channel meanwhile, keep the newer session
+            if self.sessions.get(session.session_id) is session:
+                del self.sessions[session.session_id]
+                self._finish(session)
+            count = len(self.sessions)
+        logger.info(f'SESSIONS: Removed {session.session_id} after {session.bytes_relayed} bytes, {count} active session(s)')
+
+    def _finish(self, session):
+        client_key = (session.client, )
+        upstream_key = (session.upstream, )
+        self.finished_bytes_by_client[client_key] = self.finished_bytes_by_client.get(client_key, 0) + session.bytes_relayed
+        self.finished_bytes_by_upstream[upstream_key] = self.finished_bytes_by_upstream.get(upstream_key, 0) + session.bytes_relayed
+
+    def cancel(self, session_ids, log_missing=True):
+        """
+        Cancels the given sessions, returns the IDs of the stopped and of the unknown sessions
+        """
+        stopped = []
+        missing = []
+        with self._lock:
+            found = [(session_id, self.sessions.get(session_id)) for session_id in session_ids]
+        for session_id, session in found:
+            if session is None:
+                if log_missing:
+                    logger.error(f'SESSIONS: Session {session_id} was not found')
+                missing.append(session_id)
+                continue
+            session.cancel()
+            logger.info(f'SESSIONS: Session {session_id} cancelled')
+            stopped.append(session_id)
+        return stopped, missing
+
+    def cancel_all(self):
+        with self._lock:
+            session_ids = list(self.sessions)
+        return self.cancel(session_ids, log_missing=False)
+
+    def snapshot(self):
+        with self._lock:
+            return [session.to_dict() for session in self.sessions.values()]
+
+    def evict_warm(self, upstream_id):
+        # A single process holds no warm lines but its own
+        return False
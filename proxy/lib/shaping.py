@@ -0,0 +1,136 @@
+import math
+import time
+import logging
+import threading
+
+from urllib.parse import urlparse
+
+import settings
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds the exposed rates are averaged over
+_rate_window = 5
+# Buckets without traffic for this long are dropped, a returning client starts with a full burst again
+_idle_timeout = 60
+
+def _bytes_per_second(kbits):
+    return kbits * 1000 / 8
+
+class TokenBucket():
+    """
+    Allows rate bytes per second on average and bursts of up to burst bytes.
+    Chunks are never split: taking more than the tokens left is allowed and the debt is paid back by waiting.
+    """
+
+    rate = 0
+    burst = 0
+    tokens = 0
+    updated = 0
+    recent = 0
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.recent = 0
+        self._lock = threading.Lock()
+
+    def take(self, count, now):
+        """
+        Takes count bytes worth of tokens, returns the seconds to wait before sending more
+        """
+        with self._lock:
+            elapsed = max(now - self.updated, 0)
+            self.updated = now
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate) - count
+            self.recent = self.recent * math.exp(-elapsed / _rate_window) + count
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def current_rate(self, now):
+        """
+        Bytes per second taken recently, an exponentially weighted average over about _rate_window seconds
+        """
+        return self.recent * math.exp(-max(now - self.updated, 0) / _rate_window) / _rate_window
+
+class ShapedFlow():
+    """
+    The buckets a session's data passes through, as (scope, bucket) pairs
+    """
+
+    buckets = ()
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+
+    def take(self, count):
+        """
+        Charges count bytes to all buckets, returns the seconds to wait for the most limiting one
+        """
+        now = time.monotonic()
+        delay = 0
+        limiting = None
+        for scope, bucket in self.buckets:
+            wait = bucket.take(count, now)
+            if wait > delay:
+                delay = wait
+                limiting = scope
+        if limiting is not None:
+            metrics.shaping_delay_seconds.inc(delay, limiting)
+        return delay
+
+class Shaper():
+    """
+    Token buckets limiting the rate data is sent to clients: per client address, per upstream playlist and in total
+    (RATE_LIMIT_CLIENT, RATE_LIMIT_UPSTREAM, RATE_LIMIT_GLOBAL). Every bucket starts full, so that a channel start can
+    fill the player's buffer at up to RATE_LIMIT_BURST seconds worth of data before the limit applies.
+    """
+
+    buckets = None
+    last_sweep = 0
+
+    def __init__(self):
+        self.buckets = {}
+        self.last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def register_metrics(self):
+        metrics.Gauge('iptv_proxy_shaped_rate_bytes', 'Bytes per second currently sent through a rate limit, averaged over a few seconds', self.rates, ('scope', 'key'))
+
+    def rates(self):
+        now = time.monotonic()
+        with self._lock:
+            return {key: bucket.current_rate(now) for key, bucket in self.buckets.items()}
+
+    def _bucket(self, scope, key, kbits):
+        bucket = self.buckets.get((scope, key))
+        if bucket is None:
+            rate = _bytes_per_second(kbits)
+            bucket = self.buckets[(scope, key)] = TokenBucket(rate, rate * settings.rate_limit_burst)
+        return bucket
+
+    def flow(self, client, channel, path):
+        """
+        Returns the ShapedFlow for a session of client watching path, or None if no rate limit is configured.
+        Channels of the catalog are limited per upstream playlist, unknown ones per upstream host.
+        """
+        limits = (
+            ('global', '', settings.rate_limit_global / settings.workers),  # Every worker process gets its share
+            ('client', client, settings.rate_limit_client),
+            ('upstream', str(channel['upstream_id']) if channel is not None else urlparse(path).hostname or '', settings.rate_limit_upstream),
+        )
+        if not any(kbits > 0 for _, _, kbits in limits):
+            return None
+        with self._lock:
+            self._sweep()
+            return ShapedFlow((scope, self._bucket(scope, key, kbits)) for scope, key, kbits in limits if kbits > 0)
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self.last_sweep < _idle_timeout:
+            return
+        self.last_sweep = now
+        for key in [key for key, bucket in self.buckets.items() if now - bucket.updated > _idle_timeout]:
+            del self.buckets[key]
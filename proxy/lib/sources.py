@@ -0,0 +1,75 @@
+import asyncio
+import logging
+
+from urllib.parse import urlparse
+
+import settings
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+_latency_weight = 0.3
+
+class SourceStats():
+    """
+    Moving average of the time until a source host delivered its first stream data, failures count as STREAM_TIMEOUT
+    """
+
+    latencies = None
+
+    def __init__(self):
+        self.latencies = {}
+
+    def register_metrics(self):
+        metrics.Gauge('iptv_proxy_source_latency_seconds', 'Moving average of the time until a source host delivered the first stream data', lambda: {(host, ): latency for host, latency in self.latencies.items()}, ('source', ), merge=max)
+
+    def observe(self, url, latency):
+        host = urlparse(url).netloc
+        previous = self.latencies.get(host)
+        self.latencies[host] = latency if previous is None else previous + _latency_weight * (latency - previous)
+
+    def failed(self, url):
+        self.observe(url, settings.stream_timeout)
+
+    def score(self, url):
+        # Unknown sources rank like one answering right at the hedge delay
+        return self.latencies.get(urlparse(url).netloc, settings.hedge_delay / 1000)
+
+    def order(self, sources):
+        """
+        Sources by their latency, the channel's own source stays first among equals
+        """
+        return sorted(sources, key=lambda source: self.score(source['url']))
+
+async def race(sources, attempt, discard):
+    """
+    Starts attempt(source) for the first source, and for the next one whenever the running attempts produced nothing within
+    HEDGE_DELAY or all of them failed. Returns the result of the first successful attempt, the others are cancelled
+    and results that arrived anyway are handed to discard().
+    """
+    pending = set()
+    error = None
+    try:
+        for index, source in enumerate(sources):
+            pending.add(asyncio.ensure_future(attempt(source)))
+            last = index == len(sources) - 1
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=None if last else settings.hedge_delay / 1000, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info(f'SOURCES: No data within {settings.hedge_delay} ms, starting {sources[index + 1]["url"]}')
+                    break
+                winners = [task.result() for task in done if task.exception() is None]
+                error = next((task.exception() for task in done if task.exception() is not None), error)
+                if winners:
+                    for extra in winners[1:]:
+                        discard(extra)
+                    return winners[0]
+                if not last:
+                    break  # A source failed, don't wait for the hedge delay to try the next one
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if not isinstance(result, BaseException):
+                discard(result)  # Finished while being cancelled
@@ -0,0 +1,750 @@
+import json
+import time
+import base64
+import signal
+import asyncio
+import logging
+import concurrent.futures
+
+from http import HTTPStatus
+from functools import partial
+from urllib.parse import urlparse, parse_qs
+
+import settings
+from lib.http_client import open_stream, open_raw_stream, parse_head, build_request_headers, ConnectionPool, RawUpstreamResponse, UpstreamError
+from lib.channel_hub import HubRegistry
+from lib.hls import SegmentCache, HlsViewer, HlsLine, is_playlist, parse_hls_target, parse_live_target, live_url, rewrite_playlist, byte_range
+from lib.segmenter import TsSegmenter
+from lib.sources import SourceStats, race
+from lib.reconnect import ResilientUpstream
+from lib.prewarm import Prewarmer
+from lib.admission import AdmissionQueue
+from lib.multicast import is_multicast, open_multicast
+from lib.drain import drain, DrainingError
+from lib.sessions import StreamSession
+from lib import metrics, ts_analyzer
+from lib.zero_copy import splice_supported, splice_relay, tune_client_socket
+from lib.manager_client import is_line_available, get_channel_opts, decode_stream_path, _reportActionBegin, _reportActionEnd, _divider, _session_id_string
+
+logger = logging.getLogger(__name__)
+
+_request_timeout = 10
+_evict_timeout = 1
+
+class AdmissionError(Exception):
+    pass
+
+def open_source(url, headers):
+    """
+    Opens a streamed request to url, or joins its group for udp:// and rtp:// URLs
+    """
+    if is_multicast(url):
+        return open_multicast(url)
+    return open_stream(url, headers)
+
+class AsyncStreamServer():
+    """
+    Event loop based streaming proxy serving the same /stream/start and /stream/stop contract as the Flask app.
+    Viewers of the same channel share one upstream connection through a ChannelHub (SHARED_UPSTREAMS), otherwise
+    every session runs as an upstream reader task and a client writer task connected through a bounded queue.
+    Admission checks and channel options come from the ChannelCatalog, falling back to the manager for unknown channels.
+    Catalog channels with alternative sources are opened as a race, hedged by HEDGE_DELAY.
+    udp:// and rtp:// channels are received from their (multicast) group, joined once per channel with SHARED_UPSTREAMS.
+    HLS channels are served from a SegmentCache shared by all viewers, with their playlists rewritten to point at /stream/hls/.
+    /stream/live/ serves TS channels as HLS, cut into segments by a TsSegmenter reading the channel's shared upstream.
+    """
+
+    host = ''
+    port = 0
+    server = None
+    sessions = None
+    hubs = None
+    catalog = None
+    reporter = None
+    segment_cache = None
+    upstream_pool = None
+    hls_viewers = None
+    hls_lines = None
+    source_stats = None
+    shaper = None
+    prewarmer = None
+    admission = None
+    reuse_port = False
+    listening = None
+    stopped = None
+
+    def __init__(self, host, port, catalog, reporter, sessions, shaper, reuse_port=False, listening=None):
+        self.host = host
+        self.port = int(port)
+        self.reuse_port = reuse_port
+        self.listening = listening
+        self.sessions = sessions
+        self.hubs = HubRegistry()
+        self.catalog = catalog
+        self.reporter = reporter
+        self.segment_cache = SegmentCache(settings.hls_cache_size)
+        self.upstream_pool = ConnectionPool(settings.upstream_pool_size)
+        self.hls_viewers = {}
+        self.hls_lines = {}
+        self.source_stats = SourceStats()
+        self.source_stats.register_metrics()
+        self.shaper = shaper
+        self.prewarmer = Prewarmer(self.hubs, catalog, self.open_prewarmed)
+        self.prewarmer.register_metrics()
+        self.admission = AdmissionQueue()
+        self.admission.register_metrics()
+        if settings.ts_analyzer_sample > 0:
+            ts_analyzer.register_metrics()
+
+    async def serve_forever(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=settings.listen_backlog, reuse_port=self.reuse_port)
+        logger.info(f'ASYNC_SERVER: Listening on {self.host}:{self.port}')
+        asyncio.ensure_future(self.expire_hls_viewers())
+        if settings.shared_upstreams and (settings.prewarm_channels > 0 or settings.prewarm_neighbours):
+            asyncio.ensure_future(self.prewarmer.run())
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        self.sessions.on_evict = lambda upstream_id: self.evict_threadsafe(loop, upstream_id)
+        drain.on_begin(lambda stop_listening: loop.call_soon_threadsafe(self.drain, stop_listening))
+        loop.add_signal_handler(signal.SIGTERM, drain.begin)
+        if self.listening is not None:
+            await loop.run_in_executor(None, self.listening)
+        async with self.server:
+            await self.stopped
+
+    def evict_threadsafe(self, loop, upstream_id):
+        """
+        Closes a warm upstream of the playlist for a viewer of another worker, from that worker's call thread
+        """
+        future = concurrent.futures.Future()
+        loop.call_soon_threadsafe(lambda: future.set_result(self.prewarmer.evict(upstream_id)))
+        # Two workers evicting from each other at once wait for each other's loop, until this gives up
+        return future.result(_evict_timeout)
+
+    def drain(self, stop_listening):
+        """
+        Refuses new sessions from now on, the server stops once the running ones ended or DRAIN_TIMEOUT passed
+        """
+        if stop_listening:
+            self.server.close()
+            logger.info(f'ASYNC_SERVER: Stopped listening on {self.host}:{self.port}')
+        future = asyncio.get_running_loop().run_in_executor(None, drain.finish, self.sessions, self.reporter)
+        future.add_done_callback(lambda _: self.stopped.set_result(None))
+
+    async def handle_connection(self, reader, writer):
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), _request_timeout)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                return
+            request_line, headers = parse_head(head)
+            try:
+                method, target, _ = request_line.split(' ', 2)
+            except ValueError:
+                await self.send_status(writer, HTTPStatus.BAD_REQUEST)
+                return
+
+            if method == 'POST' and target == '/stream/stop/':
+                await self.stop_many(reader, writer, headers)
+            elif method != 'GET':
+                await self.send_status(writer, HTTPStatus.METHOD_NOT_ALLOWED)
+            elif target.startswith('/stream/start/'):
+                tune_client_socket(writer.get_extra_info('socket'))
+                await self.start(reader, writer, target, headers)
+            elif target.startswith('/stream/hls/'):
+                await self.hls(writer, target, headers)
+            elif target.startswith('/stream/live/'):
+                await self.live(writer, target, headers)
+            elif target.startswith('/stream/stop/'):
+                await self.stop(writer, target)
+            elif target == '/stream/sessions/':
+                # Both may ask the other worker processes, which must not block the loop
+                sessions = await asyncio.get_running_loop().run_in_executor(None, self.sessions.snapshot)
+                await self.send_json(writer, {'sessions': sessions})
+            elif target == '/metrics':
+                text = await asyncio.get_running_loop().run_in_executor(None, metrics.render)
+                await self.send_body(writer, text.encode('utf-8'), 'text/plain; version=0.0.4')
+            else:
+                await self.send_status(writer, HTTPStatus.NOT_FOUND)
+        except asyncio.CancelledError:
+            pass  # Session stopped, its task ends here
+        except Exception as err:
+            logger.exception(f'ASYNC_SERVER: Error while handling connection: {err}')
+        finally:
+            writer.close()
+
+    async def send_head(self, writer, status, headers):
+        lines = [f'HTTP/1.1 {status.value} {status.phrase}']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def send_status(self, writer, status):
+        try:
+            await self.send_head(writer, status, {'Content-Length': '0', 'Connection': 'close'})
+        except ConnectionError:
+            pass
+
+    async def send_shaped(self, writer, body, session):
+        """
+        Sends a response body of a session, in chunks of RELAY_CHUNK_SIZE if the session is rate limited
+        """
+        if session.shaping is None:
+            writer.write(body)
+            await writer.drain()
+            session.relayed(len(body))
+            return
+        view = memoryview(body)
+        for offset in range(0, len(view), settings.relay_chunk_size):
+            chunk = view[offset:offset + settings.relay_chunk_size]
+            writer.write(chunk)
+            await writer.drain()
+            session.relayed(len(chunk))
+            delay = session.throttle(len(chunk))
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def send_body(self, writer, body, content_type):
+        await self.send_head(writer, HTTPStatus.OK, {'Content-Type': content_type, 'Content-Length': str(len(body)), 'Connection': 'close'})
+        writer.write(body)
+        await writer.drain()
+
+    async def send_json(self, writer, content):
+        await self.send_body(writer, json.dumps(content).encode('utf-8'), 'application/json')
+
+    async def admit(self, url, path, channel):
+        """
+        Runs the admission check for the channel, raises AdmissionError if no upstream line is available.
+        Catalog channels wait in the playlist's AdmissionQueue for a line to become free.
+        """
+        loop = asyncio.get_running_loop()
+        if channel is not None:
+            available = await self.admission.admit(channel['upstream_id'], lambda: self.reserve_line(channel))
+        else:
+            available = await loop.run_in_executor(None, is_line_available, url) != 'False'
+        if not available:
+            raise AdmissionError(f'No line available for {path}')
+
+    async def reserve_line(self, channel):
+        """
+        Reserves a line for a viewer of a catalog channel, closing a pre-warmed or lingering upstream of the same playlist if that frees one,
+        in this worker or another one
+        """
+        if await self.catalog.reserve_line_async(channel):
+            return True
+        # Asking the other workers waits for their loops
+        evicted = self.prewarmer.evict(channel['upstream_id']) or await asyncio.get_running_loop().run_in_executor(None, self.sessions.evict_warm, channel['upstream_id'])
+        return evicted and await self.catalog.reserve_line_async(channel)
+
+    def release_line(self, channel):
+        """
+        Gives a viewer's line back, a start request waiting for a line of the same playlist gets it next
+        """
+        self.catalog.release_line(channel)
+        self.admission.released(channel)
+
+    async def open_prewarmed(self, channel):
+        headers = build_request_headers(channel['extra_info'], settings.user_agent_string)
+        upstream = await open_source(channel['url'], headers)
+        upstream.source = channel
+        return self.resilient(upstream, channel['url'], headers, settings.user_agent_string)
+
+    async def open_upstream(self, url, path, channel, request_headers, user_agent_string='', raw=False):
+        """
+        Runs the admission check for the channel and connects to the upstream once a line is reserved.
+        The returned upstream's source is the catalog entry whose line it holds, which differs from channel if an alternative won.
+        """
+        sources = self.catalog.sources(channel) if channel is not None and settings.hedge_delay > 0 and not raw else []
+        if len(sources) > 1:
+            upstream = await self.open_hedged(path, sources, request_headers, user_agent_string)
+            if upstream is not None:
+                return self.resilient(upstream, path, request_headers, user_agent_string)
+            # None of the sources had a free line, wait in the queue of the channel's own playlist
+        await self.admit(url, path, channel)
+        try:
+            started = time.monotonic()
+            upstream = await (open_raw_stream if raw else open_source)(path, request_headers)
+            metrics.upstream_connect_seconds.observe(time.monotonic() - started, urlparse(path).hostname or '')
+            upstream.source = channel
+            return upstream if raw else self.resilient(upstream, path, request_headers, user_agent_string)
+        except BaseException:
+            self.release_line(channel)
+            raise
+
+    def resilient(self, upstream, path, request_headers, user_agent_string):
+        """
+        Wraps an upstream so that it is reopened on the same line when it stalls, unless STALL_TIMEOUT is 0
+        """
+        if settings.stall_timeout <= 0:
+            return upstream
+        url = upstream.source['url'] if upstream.source is not None else path
+        headers = request_headers if url == path else build_request_headers(upstream.source['extra_info'], user_agent_string)
+        return ResilientUpstream(upstream, lambda: open_source(url, headers))
+
+    async def open_hedged(self, path, sources, request_headers, user_agent_string):
+        """
+        Races the channel's sources, the first one delivering stream data wins. Returns None if none of them had a free line.
+        """
+        lineless = []
+
+        async def attempt(source):
+            # Starts waiting in the playlist's admission queue come first
+            if self.admission.queues.get(source['upstream_id']) or not await self.reserve_line(source):
+                lineless.append(source)
+                raise AdmissionError(f'No line available for {source["url"]}')
+            upstream = None
+            started = time.monotonic()
+            try:
+                headers = request_headers if source['url'] == path else build_request_headers(source['extra_info'], user_agent_string)
+                upstream = await open_source(source['url'], headers)
+                metrics.upstream_connect_seconds.observe(time.monotonic() - started, urlparse(source['url']).hostname or '')
+                data = await asyncio.wait_for(upstream.read(settings.relay_chunk_size), settings.stream_timeout)
+                if not data:
+                    raise UpstreamError(f'{source["url"]} ended without data')
+                self.source_stats.observe(source['url'], time.monotonic() - started)
+                upstream.unread(data)
+                upstream.source = source
+                return upstream
+            except BaseException as err:
+                if upstream is not None:
+                    upstream.close()
+                self.release_line(source)
+                if isinstance(err, Exception) and not isinstance(err, AdmissionError):
+                    logger.warning(f'ASYNC_START: Source {source["url"]} failed: {err!r}')
+                    self.source_stats.failed(source['url'])
+                raise
+
+        def discard(upstream):
+            upstream.close()
+            self.release_line(upstream.source)
+
+        try:
+            upstream = await race(self.source_stats.order(sources), attempt, discard)
+        except AdmissionError:
+            if len(lineless) == len(sources):
+                return None
+            raise
+        metrics.source_starts.inc(1, 'primary' if upstream.source['url'] == path else 'alternative')
+        if upstream.source['url'] != path:
+            logger.info(f'ASYNC_START: Serving {path} from alternative source {upstream.source["url"]}')
+        return upstream
+
+    def report_path(self, source, target):
+        """
+        Stream path reported to the manager, which accounts the line to the source that is actually used
+        """
+        if source is None or source['url'] == decode_stream_path(target.removeprefix('/stream/start/').split('?', 1)[0]):
+            return target.split('?', 1)[0]
+        return '/stream/start/' + base64.b64encode(source['url'].encode('utf-8')).decode('ascii')
+
+    async def start(self, reader, writer, target, headers):
+        loop = asyncio.get_running_loop()
+        request_time = time.monotonic()
+        url, _, query = target.removeprefix('/stream/start/').partition('?')
+        path = decode_stream_path(url)
+        peer = writer.get_extra_info('peername')
+        client = headers['X-Forwarded-For'] if 'X-Forwarded-For' in headers else peer[0]
+        user_agent_string = headers.get('User-Agent', '')
+        logger.info(f'ASYNC_START: Received stream start request for {path} from {client}')
+        if is_playlist(path):
+            await self.serve_hls(writer, url, path, path, client, user_agent_string, headers.get('Range'), request_time)
+            return
+        if drain.draining:
+            logger.warning(f'ASYNC_START: Draining, refusing {path}')
+            await self.send_status(writer, HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+
+        channel = self.catalog.lookup(path)
+        extra_opts = channel['extra_info'] if channel is not None else await loop.run_in_executor(None, get_channel_opts, url)
+        request_headers = build_request_headers(extra_opts, user_agent_string)
+        hub = None
+        upstream = None
+        try:
+            if settings.shared_upstreams:
+                hub, opened_line = await self.hubs.acquire(path, lambda: self.open_upstream(url, path, channel, request_headers, user_agent_string))
+                source = hub.upstream.source
+                response_headers = dict(hub.headers)
+                if channel is not None:
+                    self.prewarmer.zapped(client, channel)
+            else:
+                # The zero-copy relay only applies to plain HTTP, anything else uses the userspace relay
+                zero_copy = settings.zero_copy and splice_supported() and urlparse(path).scheme == 'http'
+                upstream = await self.open_upstream(url, path, channel, request_headers, user_agent_string, raw=zero_copy)
+                source = upstream.source
+                opened_line = True
+                response_headers = upstream.passthrough_headers()
+        except AdmissionError:
+            logger.warning(f'ASYNC_START: No line available for {path}, sending error')
+            metrics.admission_rejects.inc()
+            await self.send_status(writer, HTTPStatus.TOO_MANY_REQUESTS)
+            return
+        except Exception as err:
+            logger.warning(f'ASYNC_START: Error starting stream session {path}: {err}')
+            metrics.upstream_errors.inc()
+            await self.send_status(writer, HTTPStatus.GATEWAY_TIMEOUT)
+            return
+
+        closed_line = True
+        try:
+            # Cancelling the session's task unwinds both legs, the finally blocks below close the upstream.
+            # Stop requests may come from another thread in multi-worker mode.
+            session = StreamSession(path, client, partial(loop.call_soon_threadsafe, asyncio.current_task().cancel), request_time)
+            session.shaping = self.shaper.flow(client, source, path)
+            self.sessions.add(session)
+
+            # TODO: Implement header filtering(?)
+            response_headers.setdefault('Cache-Control', 'no-cache')
+            response_headers.setdefault('Pragma', 'no-cache')
+            response_headers['Connection'] = 'close'
+
+            request_path = self.report_path(source, target)
+            try:
+                self.reporter.report(_reportActionBegin, client, user_agent_string, request_path, opened_line)
+                logger.info(f'ASYNC_START: Returning stream for {path} to {client}')
+                await self.send_head(writer, HTTPStatus.OK, response_headers)
+                if hub is not None:
+                    cursor = hub.join(self.timeshift_offset(query))
+                    if hub.analyzer is not None:
+                        session.quality = hub.analyzer.view(lambda: cursor.dropped)
+                    await self.relay_hub(reader, writer, cursor, session)
+                elif isinstance(upstream, RawUpstreamResponse) and not upstream.chunked:
+                    await self.relay_zero_copy(reader, writer, upstream, session)
+                else:
+                    if isinstance(upstream, RawUpstreamResponse):
+                        upstream = await upstream.to_stream()
+                    await self.relay(reader, writer, upstream, session)
+            except ConnectionError:
+                pass
+            finally:
+                self.sessions.remove(session)
+                if hub is not None:
+                    closed_line = self.hubs.release(hub)
+                    if closed_line:
+                        self.release_line(source)
+                    hub = None
+                logger.info(f'ASYNC_START.ON_CLOSE: Ended {session.session_id}')
+                self.reporter.report(_reportActionEnd, client, user_agent_string, request_path, closed_line)
+        finally:
+            if hub is not None and self.hubs.release(hub):
+                self.release_line(source)
+            if upstream is not None:
+                upstream.close()
+                self.release_line(source)
+
+    async def hls(self, writer, target, headers):
+        request_time = time.monotonic()
+        try:
+            path, resource_url = parse_hls_target(target)
+        except ValueError:
+            await self.send_status(writer, HTTPStatus.BAD_REQUEST)
+            return
+        peer = writer.get_extra_info('peername')
+        client = headers['X-Forwarded-For'] if 'X-Forwarded-For' in headers else peer[0]
+        url = base64.b64encode(path.encode('utf-8')).decode('ascii')
+        await self.serve_hls(writer, url, path, resource_url, client, headers.get('User-Agent', ''), headers.get('Range'), request_time)
+
+    async def serve_hls(self, writer, url, path, resource_url, client, user_agent_string, range_header, request_time):
+        """
+        Serves a playlist or segment of an HLS channel from the segment cache, playlists are rewritten on the way out
+        """
+        try:
+            viewer = await self.join_hls(url, path, client, user_agent_string, request_time)
+            resource = await self.segment_cache.get(resource_url, lambda: self.upstream_pool.fetch(resource_url, viewer.request_headers))
+        except AdmissionError:
+            logger.warning(f'ASYNC_HLS: No line available for {path}, sending error')
+            metrics.admission_rejects.inc()
+            await self.send_status(writer, HTTPStatus.TOO_MANY_REQUESTS)
+            return
+        except DrainingError as err:
+            logger.warning(f'ASYNC_HLS: {err}')
+            await self.send_status(writer, HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+        except Exception as err:
+            logger.warning(f'ASYNC_HLS: Error fetching {resource_url} of {path}: {err}')
+            metrics.upstream_errors.inc()
+            await self.send_status(writer, HTTPStatus.GATEWAY_TIMEOUT)
+            return
+
+        if resource.playlist:
+            body = rewrite_playlist(resource.body.decode('utf-8', 'replace'), resource.url, path).encode('utf-8')
+            await self.send_head(writer, HTTPStatus.OK, {'Content-Type': 'application/vnd.apple.mpegurl', 'Content-Length': str(len(body)), 'Cache-Control': 'no-cache', 'Connection': 'close'})
+        else:
+            body = resource.body
+            response_headers = {'Content-Type': resource.content_type or 'video/mp2t', 'Accept-Ranges': 'bytes', 'Connection': 'close'}
+            requested = byte_range(range_header, len(body))
+            if requested is not None:
+                start, end = requested
+                response_headers['Content-Range'] = f'bytes {start}-{end - 1}/{len(body)}'
+                body = body[start:end]
+            response_headers['Content-Length'] = str(len(body))
+            await self.send_head(writer, HTTPStatus.PARTIAL_CONTENT if requested is not None else HTTPStatus.OK, response_headers)
+        await self.send_shaped(writer, body, viewer.session)
+        viewer.touch()
+
+    async def join_hls(self, url, path, client, user_agent_string, request_time, live=False):
+        """
+        Returns the client's HlsViewer of the channel, the channel's first viewer opens the line for all of them:
+        an admission check for HLS upstreams, a shared upstream feeding a TsSegmenter for HLS output (live)
+        """
+        line_key = (path, live)
+        session_id = _session_id_string.format(path=path, client=client)
+        viewer = self.hls_viewers.get(session_id)
+        if viewer is not None:
+            if viewer.line_key == line_key:
+                viewer.touch()
+                return viewer
+            self.leave_hls(session_id)
+
+        if drain.draining:
+            raise DrainingError(f'Draining, refusing {path}')
+        loop = asyncio.get_running_loop()
+        channel = self.catalog.lookup(path)
+        extra_opts = channel['extra_info'] if channel is not None else await loop.run_in_executor(None, get_channel_opts, url)
+        request_headers = build_request_headers(extra_opts, user_agent_string)
+        line = self.hls_lines.get(line_key)
+        opened_line = line is None
+        if opened_line:
+            line = self.hls_lines[line_key] = HlsLine(loop.create_future())
+            admitted = False
+            try:
+                if live:
+                    line.hub, line.owns_line = await self.hubs.acquire(path, lambda: self.open_upstream(url, path, channel, request_headers, user_agent_string))
+                    line.segmenter = TsSegmenter(path, line.hub)
+                else:
+                    await self.admit(url, path, channel)
+                    line.owns_line = True
+                admitted = True
+            finally:
+                line.admitted.set_result(admitted)
+                if not admitted:
+                    del self.hls_lines[line_key]
+        elif not await asyncio.shield(line.admitted):
+            raise AdmissionError(f'No line available for {path}')
+
+        # Another request of the same client may have joined meanwhile
+        viewer = self.hls_viewers.get(session_id)
+        if viewer is not None:
+            viewer.touch()
+            return viewer
+        line.viewers += 1
+        session = StreamSession(path, client, partial(loop.call_soon_threadsafe, self.leave_hls, session_id), request_time)
+        # HLS output holds the line of whichever source won the shared upstream
+        source = line.hub.upstream.source if line.hub is not None else channel
+        session.shaping = self.shaper.flow(client, source, path)
+        viewer = HlsViewer(session, line_key, source, request_headers, user_agent_string, self.report_path(source, f'/stream/start/{url}'))
+        self.hls_viewers[session_id] = viewer
+        self.sessions.add(session)
+        logger.info(f'ASYNC_HLS: Returning {"HLS output" if live else "stream"} for {path} to {client}')
+        self.reporter.report(_reportActionBegin, client, user_agent_string, viewer.request_path, opened_line and line.owns_line)
+        return viewer
+
+    def leave_hls(self, session_id):
+        """
+        Ends an HLS viewer's session, the channel's line is released with its last viewer
+        """
+        viewer = self.hls_viewers.pop(session_id, None)
+        if viewer is None:
+            return
+        session = viewer.session
+        self.sessions.remove(session)
+        line = self.hls_lines[viewer.line_key]
+        line.viewers -= 1
+        closed_line = False
+        if line.viewers == 0:
+            del self.hls_lines[viewer.line_key]
+            if line.segmenter is not None:
+                line.segmenter.close()
+                closed_line = self.hubs.release(line.hub)
+            else:
+                closed_line = line.owns_line
+            if closed_line:
+                self.release_line(viewer.channel)
+        logger.info(f'ASYNC_HLS: Ended {session.session_id}')
+        self.reporter.report(_reportActionEnd, session.client, viewer.user_agent_string, viewer.request_path, closed_line)
+
+    def end_hls_line(self, line_key):
+        for session_id in [session_id for session_id, viewer in self.hls_viewers.items() if viewer.line_key == line_key]:
+            self.leave_hls(session_id)
+
+    async def expire_hls_viewers(self):
+        while True:
+            await asyncio.sleep(1)
+            for session_id in [session_id for session_id, viewer in self.hls_viewers.items() if viewer.idle or self.hls_lines[viewer.line_key].ended]:
+                self.leave_hls(session_id)
+
+    async def live(self, writer, target, headers):
+        """
+        Serves a TS channel as HLS output, /stream/live/<token>/index.m3u8 lists the segments of the channel's TsSegmenter
+        """
+        request_time = time.monotonic()
+        try:
+            path, name = parse_live_target(target)
+        except ValueError:
+            await self.send_status(writer, HTTPStatus.BAD_REQUEST)
+            return
+        peer = writer.get_extra_info('peername')
+        client = headers['X-Forwarded-For'] if 'X-Forwarded-For' in headers else peer[0]
+        user_agent_string = headers.get('User-Agent', '')
+        url = base64.b64encode(path.encode('utf-8')).decode('ascii')
+        if is_playlist(path):
+            # HLS upstreams already are HLS, pass them through
+            await self.serve_hls(writer, url, path, path, client, user_agent_string, headers.get('Range'), request_time)
+            return
+
+        try:
+            viewer = await self.join_hls(url, path, client, user_agent_string, request_time, live=True)
+            if self.hls_lines[viewer.line_key].ended:
+                # The shared upstream went away, start over with a new one
+                self.end_hls_line(viewer.line_key)
+                viewer = await self.join_hls(url, path, client, user_agent_string, request_time, live=True)
+            segmenter = self.hls_lines[viewer.line_key].segmenter
+            ready = await segmenter.wait_ready(settings.stream_timeout)
+        except AdmissionError:
+            logger.warning(f'ASYNC_LIVE: No line available for {path}, sending error')
+            metrics.admission_rejects.inc()
+            await self.send_status(writer, HTTPStatus.TOO_MANY_REQUESTS)
+            return
+        except DrainingError as err:
+            logger.warning(f'ASYNC_LIVE: {err}')
+            await self.send_status(writer, HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+        except Exception as err:
+            logger.warning(f'ASYNC_LIVE: Error starting HLS output of {path}: {err!r}')
+            metrics.upstream_errors.inc()
+            await self.send_status(writer, HTTPStatus.GATEWAY_TIMEOUT)
+            return
+        if not ready:
+            logger.warning(f'ASYNC_LIVE: Upstream of {path} ended before the first segment')
+            await self.send_status(writer, HTTPStatus.GATEWAY_TIMEOUT)
+            return
+
+        if name == 'index.m3u8':
+            body = segmenter.playlist(lambda sequence: live_url(path, f'{sequence}.ts')).encode('utf-8')
+            response_headers = {'Content-Type': 'application/vnd.apple.mpegurl', 'Cache-Control': 'max-age=1'}
+        else:
+            segment = segmenter.segment(int(name.removesuffix('.ts'))) if name.removesuffix('.ts').isdigit() else None
+            if segment is None:
+                await self.send_status(writer, HTTPStatus.NOT_FOUND)
+                return
+            body = segment.data
+            # Segments never change, any cache may keep them for as long as they are listed
+            response_headers = {'Content-Type': 'video/mp2t', 'Cache-Control': f'public, max-age={settings.hls_output_window * settings.hls_output_segment_duration}'}
+        response_headers.update({'Content-Length': str(len(body)), 'Connection': 'close'})
+        await self.send_head(writer, HTTPStatus.OK, response_headers)
+        await self.send_shaped(writer, body, viewer.session)
+        viewer.touch()
+
+    def timeshift_offset(self, query):
+        """
+        Seconds behind live requested through ?offset=<seconds>, only honoured with a time-shift ring
+        """
+        try:
+            return max(int(parse_qs(query).get('offset', ['0'])[0]), 0) if settings.timeshift_size > 0 else 0
+        except ValueError:
+            return 0
+
+    async def relay(self, reader, writer, upstream, session):
+        """
+        Copies upstream data to the client until either side closes, with at most SESSION_BUFFER_CHUNKS chunks in flight
+        """
+        queue = asyncio.Queue(maxsize=settings.session_buffer_chunks)
+        analyzer = ts_analyzer.TsAnalyzer(session.path) if settings.ts_analyzer_sample > 0 else None
+        if analyzer is not None:
+            session.quality = analyzer.view()
+
+        async def pump_upstream():
+            try:
+                while True:
+                    chunk = await asyncio.wait_for(upstream.read(settings.relay_chunk_size), upstream.read_timeout)
+                    if not chunk:
+                        break
+                    if analyzer is not None:
+                        analyzer.feed(chunk)
+                    await queue.put(chunk)
+            except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError) as err:
+                logger.warning(f'ASYNC_RELAY: Upstream {upstream.url} failed: {err!r}')
+            await queue.put(None)
+
+        async def pump_client():
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+                session.relayed(len(chunk))
+                delay = session.throttle(len(chunk))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+        tasks = [asyncio.ensure_future(pump_upstream()), asyncio.ensure_future(pump_client()), asyncio.ensure_future(self.watch_client(reader))]
+        try:
+            await asyncio.wait(tasks[1:], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def relay_hub(self, reader, writer, cursor, session):
+        """
+        Copies data from the viewer's hub cursor to the client until either side closes
+        """
+        async def pump_client():
+            while True:
+                data = await cursor.read(settings.relay_chunk_size)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+                session.relayed(len(data))
+                delay = session.throttle(len(data))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+        tasks = [asyncio.ensure_future(pump_client()), asyncio.ensure_future(self.watch_client(reader))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def relay_zero_copy(self, reader, writer, upstream, session):
+        """
+        Splices the upstream body straight into the client socket until either side closes
+        """
+        # The response head must have left the transport completely, otherwise body bytes would overtake it on the socket
+        writer.transport.set_write_buffer_limits(0)
+        await writer.drain()
+        tasks = [asyncio.ensure_future(splice_relay(upstream.sock, writer.get_extra_info('socket'), upstream.remaining, session)), asyncio.ensure_future(self.watch_client(reader))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if not tasks[0].cancelled() and tasks[0].exception() is not None:
+            logger.warning(f'ASYNC_RELAY: Zero-copy relay of {upstream.url} failed: {tasks[0].exception()!r}')
+
+    async def watch_client(self, reader):
+        # The client never sends a body, so any EOF means it went away
+        while await reader.read(1024):
+            pass
+
+    async def stop(self, writer, target):
+        saved_session_decoded = base64.b64decode(target.removeprefix('/stream/stop/')).decode('utf-8')
+        path, client = saved_session_decoded.split(_divider)
+        session_id = _session_id_string.format(path=path, client=client)
+        logger.info(f'ASYNC_STOP: Drop stream {session_id}')
+        await asyncio.get_running_loop().run_in_executor(None, self.sessions.cancel, [session_id])
+        await self.send_status(writer, HTTPStatus.OK)
+
+    async def stop_many(self, reader, writer, headers):
+        """
+        Cancels all sessions listed in the JSON body ({"sessions": [<session ID>, ...]}) at once
+        """
+        body = await asyncio.wait_for(reader.readexactly(int(headers.get('Content-Length', 0))), _request_timeout)
+        session_ids = json.loads(body)['sessions']
+        logger.info(f'ASYNC_STOP: Drop {len(session_ids)} stream(s)')
+        stopped, missing = await asyncio.get_running_loop().run_in_executor(None, self.sessions.cancel, session_ids)
+        await self.send_json(writer, {'stopped': stopped, 'missing': missing})
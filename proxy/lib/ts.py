@@ -0,0 +1,149 @@
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PAT_PID = 0
+
+_unit_start_flags = bytes(1 if value & 0x40 else 0 for value in range(256))
+
+def packet_pid(packet):
+    return ((packet[1] & 0x1f) << 8) | packet[2]
+
+def payload_unit_start(packet):
+    return bool(packet[1] & 0x40)
+
+def random_access(packet):
+    """
+    Whether the packet's adaptation field flags a random access point, i.e. the start of a keyframe
+    """
+    return bool(packet[3] & 0x20) and packet[4] > 0 and bool(packet[5] & 0x40)
+
+def _payload(packet):
+    offset = 4
+    if packet[3] & 0x20:
+        offset += 1 + packet[4]
+    return packet[offset:] if packet[3] & 0x10 else b''
+
+def pmt_pids(packet):
+    """
+    PIDs of the program map tables listed in a PAT packet
+    """
+    payload = _payload(packet)
+    if not payload_unit_start(packet) or not payload:
+        return set()
+    section = payload[1 + payload[0]:]
+    if len(section) < 8:
+        return set()
+    section_length = ((section[1] & 0x0f) << 8) | section[2]
+    # Programs run from the end of the fixed header to the CRC
+    programs = section[8:min(3 + section_length - 4, len(section))]
+    pids = set()
+    for offset in range(0, len(programs) - 3, 4):
+        program_number = (programs[offset] << 8) | programs[offset + 1]
+        if program_number != 0:
+            pids.add(((programs[offset + 2] & 0x1f) << 8) | programs[offset + 3])
+    return pids
+
+def unit_starts(data):
+    """
+    Offsets of the packets starting a PES packet or table section in packet aligned data.
+    Only these can be tables or keyframes, and finding them runs in C, so the Python code only ever looks at a few packets per chunk.
+    """
+    flags = bytes(data[1::TS_PACKET_SIZE]).translate(_unit_start_flags)
+    index = flags.find(1)
+    while index != -1:
+        offset = index * TS_PACKET_SIZE
+        if data[offset] == SYNC_BYTE and offset + TS_PACKET_SIZE <= len(data):
+            yield offset
+        index = flags.find(1, index + 1)
+
+def find_random_access(data):
+    """
+    Offset of the first packet in packet aligned data that begins a keyframe, or None
+    """
+    for offset in unit_starts(data):
+        if random_access(data[offset:offset + 6]):
+            return offset
+    return None
+
+class ProgramTables():
+    """
+    The latest PAT and PMT packets of a stream, prepended to every cut so that each part decodes on its own
+    """
+
+    pat = None
+    pmts = None
+
+    def __init__(self):
+        self.pat = None
+        self.pmts = {}
+
+    def scan(self, data):
+        """
+        Picks PAT and PMT packets out of packet aligned data, returns the offset of the last keyframe in it or None
+        """
+        keyframe = None
+        for offset in unit_starts(data):
+            pid = packet_pid(data[offset:offset + 3])
+            if pid == PAT_PID:
+                packet = bytes(data[offset:offset + TS_PACKET_SIZE])
+                self.pat = packet
+                self.pmts = {pmt_pid: self.pmts.get(pmt_pid) for pmt_pid in pmt_pids(packet)}
+            elif pid in self.pmts:
+                self.pmts[pid] = bytes(data[offset:offset + TS_PACKET_SIZE])
+            elif random_access(data[offset:offset + 6]):
+                keyframe = offset
+        return keyframe
+
+    def packets(self):
+        if self.pat is None:
+            return b''
+        return self.pat + b''.join(packet for packet in self.pmts.values() if packet is not None)
+
+def find_sync(data):
+    """
+    Offset of the first sync byte in data that is followed by another one a packet later, or None
+    """
+    offset = data.find(SYNC_BYTE)
+    while offset != -1:
+        if offset + TS_PACKET_SIZE >= len(data) or data[offset + TS_PACKET_SIZE] == SYNC_BYTE:
+            return offset
+        offset = data.find(SYNC_BYTE, offset + 1)
+    return None
+
+class PacketAligner():
+    """
+    Passes a TS stream on in whole packets only, so that it can be continued from a new connection at a packet boundary.
+    Streams that don't start with a sync byte are passed on untouched.
+    """
+
+    carry = b''
+    ts = None
+    synced = True
+
+    def __init__(self):
+        self.carry = b''
+        self.ts = None
+        self.synced = True
+
+    def feed(self, data):
+        if self.ts is None and data:
+            self.ts = data[0] == SYNC_BYTE
+        if not self.ts:
+            return data
+        if not self.synced:
+            offset = find_sync(data)
+            if offset is None:
+                return b''
+            data = data[offset:]
+            self.synced = True
+        if self.carry:
+            data = self.carry + data
+        end = len(data) - len(data) % TS_PACKET_SIZE
+        self.carry = bytes(data[end:])
+        return memoryview(data)[:end] if end < len(data) else data
+
+    def restart(self):
+        """
+        Called before the data of a new connection: the partial packet of the old one is dropped and the new one joins at its first packet
+        """
+        self.carry = b''
+        self.synced = False
@@ -0,0 +1,247 @@
+import time
+import weakref
+import logging
+
+import numpy as np
+
+import settings
+from lib import metrics
+from lib.ts import TS_PACKET_SIZE, SYNC_BYTE, find_sync
+
+logger = logging.getLogger(__name__)
+
+NULL_PID = 0x1fff
+# 27 MHz ticks of the 33 bit PCR base times 300 plus the 9 bit extension, after which the PCR wraps around
+_pcr_clock = 27000000
+_pcr_wrap = (1 << 33) * 300
+# PCR steps beyond this many seconds off the arrival time are a new timeline (e.g. a reconnect), not jitter
+_pcr_max_step = 1
+# Smoothing of the jitter estimate, as for RTP interarrival jitter (RFC 3550)
+_jitter_gain = 1 / 16
+_rate_window = 10
+
+_analyzers = weakref.WeakSet()
+
+def register_metrics():
+    metrics.Gauge('iptv_proxy_ts_pcr_jitter_seconds', 'Smoothed jitter between the PCR clock and the arrival of the stream data, by channel and PCR PID, the highest of the channel\'s analyzers', _jitters, ('channel', 'pid'), merge=max)
+    metrics.Gauge('iptv_proxy_ts_pid_bitrate', 'Bits per second by channel and PID, estimated from the analyzed share of the stream, averaged over the channel\'s analyzers', _bitrates, ('channel', 'pid'), merge=_mean)
+
+def _mean(values):
+    return sum(values) / len(values)
+
+def _jitters():
+    # Sessions with their own upstream of the same channel have an analyzer each
+    jitters = {}
+    for analyzer in list(_analyzers):
+        for pid, jitter in list(analyzer.pcr_jitter.items()):
+            labels = (analyzer.key, str(pid))
+            jitters[labels] = max(jitters.get(labels, 0), jitter)
+    return jitters
+
+def _bitrates():
+    bitrates = {}
+    for analyzer in list(_analyzers):
+        for pid, bitrate in list(analyzer.bitrates.items()):
+            bitrates.setdefault((analyzer.key, str(pid)), []).append(bitrate)
+    return {labels: _mean(values) for labels, values in bitrates.items()}
+
+class TsAnalyzer():
+    """
+    Checks a channel's MPEG-TS data for continuity counter errors, sync byte losses and PCR jitter, and measures the bitrate of each PID.
+    Chunks are looked at as NumPy arrays of 188 byte packets, so the work per chunk doesn't grow with Python code per packet.
+    Only TS_ANALYZER_SAMPLE percent of the chunks are analyzed, continuity counters are followed again from scratch after skipped ones
+    while PCRs are compared across them, as the PCR clock and the arrival time both keep running.
+    """
+
+    key = ''
+    carry = b''
+    synced = False
+    credit = 0
+    errors = None
+    last_cc = None
+    pcr = None
+    pcr_jitter = None
+    bitrates = None
+
+    def __init__(self, key):
+        self.key = key
+        self.carry = b''
+        # Whether the stream was followed up to the previous chunk, otherwise the next one is picked up at its first packet without
+        # counting a loss: at the start, which may be mid-packet (time-shift offsets, reconnects), and after skipped chunks
+        self.synced = False
+        self.credit = 0
+        self.errors = {'continuity': 0, 'sync': 0}
+        # PID -> continuity counter of its last packet with payload
+        self.last_cc = {}
+        # PCR PID -> (PCR, arrival time) of its last PCR
+        self.pcr = {}
+        self.pcr_jitter = {}
+        self.bitrates = {}
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_pid_packets = np.zeros(NULL_PID + 1, dtype=np.int64)
+        _analyzers.add(self)
+
+    def view(self, dropped=None):
+        return AnalyzerView(self, dropped)
+
+    def feed(self, data):
+        """
+        Called with every chunk of the channel, analyzes it if it falls into the sample
+        """
+        now = time.monotonic()
+        self.window_bytes += len(data)
+        self.credit += settings.ts_analyzer_sample
+        if self.credit < 100:
+            self.carry = b''
+            self.synced = False
+            self.last_cc.clear()
+        else:
+            self.credit -= 100
+            self.analyze(self.carry + data if self.carry else bytes(data), now)
+        if now - self.window_start >= _rate_window:
+            self.update_bitrates(now)
+
+    def analyze(self, data, now):
+        offset = 0
+        if not self.synced or data[0] != SYNC_BYTE:
+            offset = find_sync(data)
+            if offset is None:
+                self.carry = bytes(data[-(TS_PACKET_SIZE - 1):])
+                return
+            if self.synced:
+                self.lost_sync()
+            self.synced = True
+        while True:
+            count = (len(data) - offset) // TS_PACKET_SIZE
+            packets = np.frombuffer(data, dtype=np.uint8, count=count * TS_PACKET_SIZE, offset=offset).reshape(count, TS_PACKET_SIZE)
+            lost = np.flatnonzero(packets[:, 0] != SYNC_BYTE)
+            if lost.size == 0:
+                self.check_packets(packets, now)
+                self.carry = bytes(data[offset + count * TS_PACKET_SIZE:])
+                return
+            # Checked up to the packet that lost the sync, the stream continues at the next sync byte behind it
+            self.check_packets(packets[:lost[0]], now)
+            self.lost_sync()
+            resync = find_sync(data[offset + lost[0] * TS_PACKET_SIZE + 1:])
+            if resync is None:
+                self.carry = b''
+                self.synced = False
+                return
+            offset += lost[0] * TS_PACKET_SIZE + 1 + resync
+
+    def lost_sync(self):
+        self.errors['sync'] += 1
+        metrics.ts_errors.inc(1, self.key, 'sync')
+        self.last_cc.clear()
+
+    def check_packets(self, packets, now):
+        if len(packets) == 0:
+            return
+        pids = ((packets[:, 1].astype(np.uint16) & 0x1f) << 8) | packets[:, 2]
+        self.window_pid_packets += np.bincount(pids, minlength=NULL_PID + 1)
+
+        has_adaptation = (packets[:, 3] & 0x20) != 0
+        adaptation_length = np.where(has_adaptation, packets[:, 4], 0)
+        discontinuity = (adaptation_length > 0) & ((packets[:, 5] & 0x80) != 0)
+        self.check_continuity(pids, packets[:, 3], discontinuity)
+        has_pcr = (adaptation_length >= 7) & ((packets[:, 5] & 0x10) != 0)
+        if has_pcr.any():
+            self.check_pcr(pids[has_pcr], packets[has_pcr, 6:12].astype(np.int64), discontinuity[has_pcr], now)
+
+    def check_continuity(self, pids, flags, discontinuity):
+        """
+        Counts packets whose continuity counter doesn't follow the previous one of the same PID, packets without payload
+        keep the counter and a single repetition is allowed as a duplicate packet
+        """
+        selected = ((flags & 0x10) != 0) & (pids != NULL_PID)
+        pids = pids[selected]
+        if len(pids) == 0:
+            return
+        counters = flags[selected] & 0x0f
+        discontinuity = discontinuity[selected]
+        # Grouped by PID in stream order, so that every packet's predecessor of the same PID is its neighbour
+        order = np.argsort(pids, kind='stable')
+        pids, counters, discontinuity = pids[order], counters[order], discontinuity[order]
+        same_pid = pids[1:] == pids[:-1]
+        broken = same_pid & (counters[1:] != ((counters[:-1] + 1) & 0x0f)) & (counters[1:] != counters[:-1]) & ~discontinuity[1:]
+        errors = int(broken.sum())
+
+        # The first packet of each PID continues from the previous chunk, the last one is what the next chunk continues from
+        firsts = np.flatnonzero(np.concatenate(([True], ~same_pid)))
+        lasts = np.concatenate((firsts[1:] - 1, [len(pids) - 1]))
+        for first, last in zip(firsts.tolist(), lasts.tolist()):
+            pid = int(pids[first])
+            previous = self.last_cc.get(pid)
+            counter = int(counters[first])
+            if previous is not None and counter != (previous + 1) & 0x0f and counter != previous and not discontinuity[first]:
+                errors += 1
+            self.last_cc[pid] = int(counters[last])
+        if errors:
+            self.errors['continuity'] += errors
+            metrics.ts_errors.inc(errors, self.key, 'continuity')
+
+    def check_pcr(self, pids, fields, discontinuity, now):
+        """
+        Updates the jitter of each PCR PID from the chunk's last PCR: the difference between the time the PCR clock advanced
+        since the previous analyzed chunk and the time that passed between their arrival
+        """
+        base = (fields[:, 0] << 25) | (fields[:, 1] << 17) | (fields[:, 2] << 9) | (fields[:, 3] << 1) | (fields[:, 4] >> 7)
+        pcrs = base * 300 + (((fields[:, 4] & 1) << 8) | fields[:, 5])
+        for pid in np.unique(pids).tolist():
+            indices = np.flatnonzero(pids == pid)
+            pcr = int(pcrs[indices[-1]])
+            previous = self.pcr.get(pid)
+            self.pcr[pid] = (pcr, now)
+            if previous is None or discontinuity[indices].any():
+                continue
+            transit = (now - previous[1]) - ((pcr - previous[0]) % _pcr_wrap) / _pcr_clock
+            if abs(transit) > _pcr_max_step:
+                continue
+            jitter = self.pcr_jitter.get(pid, 0)
+            self.pcr_jitter[pid] = jitter + (abs(transit) - jitter) * _jitter_gain
+
+    def update_bitrates(self, now):
+        """
+        Bitrates of the PIDs over the past window, their share of the analyzed packets applied to all data that passed
+        """
+        analyzed_packets = int(self.window_pid_packets.sum())
+        if analyzed_packets > 0:
+            total_rate = self.window_bytes * 8 / (now - self.window_start)
+            pids = np.flatnonzero(self.window_pid_packets)
+            self.bitrates = {int(pid): total_rate * int(self.window_pid_packets[pid]) / analyzed_packets for pid in pids}
+        else:
+            self.bitrates = {}
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_pid_packets[:] = 0
+
+    def summary(self):
+        return {
+            'continuity_errors': self.errors['continuity'],
+            'sync_losses': self.errors['sync'],
+            'pcr_jitter_ms': {str(pid): round(jitter * 1000, 3) for pid, jitter in self.pcr_jitter.items()},
+            'pid_kbps': {str(pid): round(bitrate / 1000, 1) for pid, bitrate in self.bitrates.items()},
+        }
+
+class AnalyzerView():
+    """
+    A session's share of its channel's TsAnalyzer: the errors since the session started, and the bytes the proxy skipped for it
+    """
+
+    analyzer = None
+    baseline = None
+    dropped = None
+
+    def __init__(self, analyzer, dropped=None):
+        self.analyzer = analyzer
+        self.baseline = dict(analyzer.errors)
+        self.dropped = dropped
+
+    def summary(self):
+        summary = self.analyzer.summary()
+        summary['continuity_errors'] -= self.baseline['continuity']
+        summary['sync_losses'] -= self.baseline['sync']
+        if self.dropped is not None:
+            summary['skipped_bytes'] = self.dropped()
+        return summary
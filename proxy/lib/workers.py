@@ -0,0 +1,561 @@
+import os
+import time
+import queue
+import signal
+import shutil
+import socket
+import asyncio
+import logging
+import tempfile
+import threading
+import multiprocessing
+import concurrent.futures
+
+from multiprocessing.connection import Listener, Client
+
+import settings
+from lib import metrics
+from lib.drain import drain
+from lib.catalog import ChannelCatalog
+from lib.manager_client import _reportActionBegin, _reportActionEnd
+
+logger = logging.getLogger(__name__)
+
+_broker_name = 'broker.sock'
+_restart_delay = 1
+_stop_timeout = 5
+# Seconds a new generation of workers gets to listen on a reload
+_ready_timeout = 30
+
+class WorkerCallError(Exception):
+    pass
+
+def _worker_address(control_dir, index):
+    return os.path.join(control_dir, f'worker-{index}.sock')
+
+def listen_socket(host, port):
+    """
+    A listening socket for the proxy port that other worker processes can bind as well, the kernel spreads connections between them
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, int(port)))
+    sock.listen(settings.listen_backlog)
+    return sock
+
+def serve_calls(address, authkey, calls, name):
+    """
+    Answers (call, args) messages on a Unix socket, one thread per connection. Failures are sent back as WorkerCallError.
+    Returns the listener, closing it stops answering.
+    """
+    if os.path.exists(address):
+        os.unlink(address)  # Left behind by the previous process of a restarted worker
+    listener = Listener(address, 'AF_UNIX', authkey=authkey)
+
+    def handle(connection):
+        with connection:
+            while True:
+                try:
+                    call, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    result = calls[call](*args)
+                except Exception as err:
+                    result = WorkerCallError(f'{call} failed: {err!r}')
+                connection.send(result)
+
+    def accept_loop():
+        while True:
+            try:
+                connection = listener.accept()
+            except multiprocessing.AuthenticationError as err:
+                logger.warning(f'WORKERS: Rejected connection on {address}: {err!r}')
+                continue
+            except OSError:
+                return  # Closed
+            threading.Thread(target=handle, args=(connection, ), name=f'{name}-call', daemon=True).start()
+
+    threading.Thread(target=accept_loop, name=name, daemon=True).start()
+    return listener
+
+class CallClient():
+    """
+    Calls into another process of the proxy. Connections carry one call at a time, idle ones are kept for the next call.
+    """
+
+    address = ''
+    authkey = b''
+    idle = None
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.idle = []
+        self._lock = threading.Lock()
+
+    def call(self, call, *args):
+        with self._lock:
+            connection = self.idle.pop() if self.idle else None
+        if connection is None:
+            connection = Client(self.address, 'AF_UNIX', authkey=self.authkey)
+        try:
+            connection.send((call, args))
+            result = connection.recv()
+        except BaseException:
+            # E.g. the other process restarted, the next call connects again
+            connection.close()
+            raise
+        with self._lock:
+            self.idle.append(connection)
+        if isinstance(result, WorkerCallError):
+            raise result
+        return result
+
+def call_each(peers, call, *args):
+    """
+    Runs a call in each of the peers, returns the results of those that answered
+    """
+    results = []
+    for peer in peers:
+        try:
+            results.append(peer.call(call, *args))
+        except (OSError, EOFError, WorkerCallError) as err:
+            logger.warning(f'WORKERS: {call} on {peer.address} failed: {err!r}')
+    return results
+
+class CallQueue():
+    """
+    Runs calls into another process from a background thread, in the order they were queued, so that the caller never waits
+    for the other process. submit() returns a concurrent.futures.Future of the call's result.
+    """
+
+    client = None
+    calls = None
+
+    def __init__(self, client, name):
+        self.client = client
+        self.calls = queue.Queue()
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def submit(self, call, *args):
+        future = concurrent.futures.Future()
+        self.calls.put((future, call, args))
+        return future
+
+    def flush(self, timeout):
+        """
+        Waits until all queued calls ran, returns whether they did within timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        while self.calls.unfinished_tasks > 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        return self.calls.unfinished_tasks == 0
+
+    def _run(self):
+        while True:
+            future, call, args = self.calls.get()
+            try:
+                future.set_result(self.client.call(call, *args))
+            except Exception as err:
+                logger.warning(f'WORKERS: {call} on {self.client.address} failed: {err!r}')
+                future.set_exception(err)
+            finally:
+                self.calls.task_done()
+
+class RemoteCatalog(ChannelCatalog):
+    """
+    The supervisor's channel catalog as seen from a worker. Lookups are answered from a local copy refreshed from the supervisor,
+    line reservations are queued to the supervisor so that lines are counted once for all workers, without the loop waiting for it.
+    """
+
+    broker = None
+    calls = None
+    worker_id = ''
+
+    def __init__(self, broker, calls, worker_id):
+        super().__init__()
+        self.broker = broker
+        self.calls = calls
+        self.worker_id = worker_id
+
+    def start(self):
+        # Fetched once before the worker listens, so that its first stream starts find their channels
+        try:
+            self.refresh()
+        except Exception as err:
+            logger.warning(f'CATALOG: Fetching the catalog from the supervisor failed: {err!r}')
+        super().start()
+
+    def refresh(self):
+        # In the catalog's refresh thread, which may wait for the supervisor
+        catalog = self.broker.call('catalog', self.version)
+        with self._lock:
+            if catalog['channels'] is not None:
+                self.channels = catalog['channels']
+                self.by_tvg_id = catalog['by_tvg_id']
+                self.by_group = catalog['by_group']
+                self.version = catalog['version']
+            self.groups = catalog['groups']
+            self.upstreams = catalog['upstreams']
+
+    def reserve_line(self, channel, spare=0, held=False):
+        # Flask threads may wait for the answer
+        return self.calls.submit('reserve_line', self.worker_id, channel, spare, held).result()
+
+    async def reserve_line_async(self, channel, spare=0, held=False):
+        return await asyncio.wrap_future(self.calls.submit('reserve_line', self.worker_id, channel, spare, held))
+
+    def release_line(self, channel, held=False):
+        if channel is not None:
+            self.calls.submit('release_line', self.worker_id, channel, held)
+
+    def adopt_line(self, channel):
+        self.calls.submit('adopt_line', self.worker_id, channel)
+
+    def hold_line(self, channel):
+        self.calls.submit('hold_line', self.worker_id, channel)
+
+class RemoteReporter():
+    """
+    Queues session reports with the supervisor's reporter, the manager expects one sequence of events per proxy
+    """
+
+    calls = None
+    worker_id = ''
+
+    def __init__(self, calls, worker_id):
+        self.calls = calls
+        self.worker_id = worker_id
+
+    def report(self, action, client, ua_string, url, line=True):
+        self.calls.submit('report', self.worker_id, action, client, ua_string, url, line)
+
+    def flush(self, timeout):
+        # Handed to the supervisor, which ships them also after the worker exited
+        return self.calls.flush(timeout)
+
+class ClusterSessions():
+    """
+    A worker's session registry, stop requests and session listings also cover the sessions of the other workers,
+    including those of an earlier generation that are still draining after a reload
+    """
+
+    registry = None
+    broker = None
+    address = ''
+    authkey = b''
+    clients = None
+    # Gives up a warm line of this worker for the other workers, set by the stream server
+    on_evict = None
+
+    def __init__(self, registry, broker, address, authkey):
+        self.registry = registry
+        self.broker = broker
+        self.address = address
+        self.authkey = authkey
+        self.clients = {}
+
+    def __len__(self):
+        return len(self.registry)
+
+    def add(self, session):
+        self.registry.add(session)
+
+    def remove(self, session):
+        self.registry.remove(session)
+
+    def _peers(self):
+        for addresses in call_each([self.broker], 'peers'):
+            self.clients = {address: self.clients.get(address) or CallClient(address, self.authkey) for address in addresses if address != self.address}
+        return list(self.clients.values())
+
+    def _each_peer(self, call, *args):
+        # The broker answers for the supervisor itself, e.g. its metrics of manager calls
+        return call_each([self.broker] + self._peers(), call, *args)
+
+    def cancel(self, session_ids):
+        stopped, _ = self.registry.cancel(session_ids, log_missing=False)
+        for peer_stopped, _ in self._each_peer('cancel', session_ids):
+            stopped += [session_id for session_id in peer_stopped if session_id not in stopped]
+        missing = [session_id for session_id in session_ids if session_id not in stopped]
+        for session_id in missing:
+            logger.error(f'SESSIONS: Session {session_id} was not found')
+        return stopped, missing
+
+    def cancel_all(self):
+        # Only this worker's sessions, e.g. when it drains
+        return self.registry.cancel_all()
+
+    def snapshot(self):
+        sessions = self.registry.snapshot()
+        for peer_sessions in self._each_peer('snapshot'):
+            sessions += peer_sessions
+        return sessions
+
+    def peer_metrics(self):
+        return self._each_peer('metrics')
+
+    def evict_warm(self, upstream_id):
+        """
+        Asks the other workers to give up a pre-warmed or lingering line of the upstream, returns whether one did
+        """
+        for peer in self._peers():
+            if call_each([peer], 'evict', upstream_id) == [True]:
+                return True
+        return False
+
+def join_workers(worker_id, control_dir, authkey, registry):
+    """
+    Connects a worker process to the supervisor and its peers, returns the catalog, reporter and session registry to use
+    and a callback telling the supervisor that the worker listens
+    """
+    broker = CallClient(os.path.join(control_dir, _broker_name), authkey)
+    address = _worker_address(control_dir, worker_id)
+    sessions = ClusterSessions(registry, broker, address, authkey)
+    serve_calls(address, authkey, {
+        'cancel': lambda session_ids: registry.cancel(session_ids, log_missing=False),
+        'snapshot': registry.snapshot,
+        'metrics': metrics.collect,
+        'drain': drain.begin,
+        'evict': lambda upstream_id: sessions.on_evict is not None and sessions.on_evict(upstream_id),
+    }, 'worker-control')
+    metrics.add_peers(sessions.peer_metrics)
+    # Reservations and reports share one queue, so that the supervisor sees them in the order the worker made them
+    calls = CallQueue(broker, 'worker-broker-calls')
+    return RemoteCatalog(broker, calls, worker_id), RemoteReporter(calls, worker_id), sessions, lambda: broker.call('ready', worker_id)
+
+class WorkerLedger():
+    """
+    What a worker process took in the supervisor: lines of the channel catalog by upstream playlist and kind (reserved or held),
+    and the sessions it reported as begun with the lines they opened by stream path. A worker that dies gives them back through it.
+    """
+
+    lines = None
+    sessions = None
+    session_lines = None
+
+    def __init__(self):
+        self.lines = {}
+        self.sessions = {}
+        self.session_lines = {}
+
+    def count(self, counts, key, change):
+        counts[key] = counts.get(key, 0) + change
+        if counts[key] == 0:
+            del counts[key]
+
+    def reported(self, action, client, ua_string, url, line):
+        change = 1 if action == _reportActionBegin else -1
+        self.count(self.sessions, (client, ua_string, url), change)
+        if line:
+            self.count(self.session_lines, url, change)
+
+class WorkerSupervisor():
+    """
+    Runs WORKERS proxy processes that share the listening port through SO_REUSEPORT and restarts the ones that exit.
+    The supervisor holds what must exist once per proxy, the channel catalog with its line reservations and the session reporter,
+    workers use them through the broker socket, and the lines and sessions of a worker that dies are given back. Stop requests, session listings and metrics are fanned out to all workers.
+    SIGHUP reloads the workers without dropping a stream: a new generation is started from the code on disk and once it
+    listens, the old workers stop listening and drain. SIGTERM drains all workers, then the supervisor exits.
+    """
+
+    count = 0
+    catalog = None
+    reporter = None
+    target = None
+    control_dir = ''
+    authkey = b''
+    generation = 0
+    current = None
+    retired = None
+    ready = None
+    clients = None
+    requested = None
+    ledgers = None
+
+    def __init__(self, count, catalog, reporter, target):
+        self.count = count
+        self.catalog = catalog
+        self.reporter = reporter
+        self.target = target
+        # Worker ID -> process, of the current generation and of earlier ones that are draining
+        self.current = {}
+        self.retired = {}
+        self.ready = set()
+        self.clients = {}
+        # Worker ID -> WorkerLedger, written by the broker's threads of all workers
+        self.ledgers = {}
+        self._ledger_lock = threading.Lock()
+
+    def addresses(self):
+        return [_worker_address(self.control_dir, worker_id) for worker_id in list(self.current) + list(self.retired)]
+
+    def call_workers(self, worker_ids, call, *args):
+        for worker_id in worker_ids:
+            if worker_id not in self.clients:
+                self.clients[worker_id] = CallClient(_worker_address(self.control_dir, worker_id), self.authkey)
+        return call_each([self.clients[worker_id] for worker_id in worker_ids], call, *args)
+
+    def _ledger(self, worker_id):
+        return self.ledgers.setdefault(worker_id, WorkerLedger())
+
+    def reserve_line(self, worker_id, channel, spare=0, held=False):
+        reserved = self.catalog.reserve_line(channel, spare, held)
+        if reserved:
+            with self._ledger_lock:
+                ledger = self._ledger(worker_id)
+                ledger.count(ledger.lines, (channel['upstream_id'], held), 1)
+        return reserved
+
+    def release_line(self, worker_id, channel, held=False):
+        self.catalog.release_line(channel, held)
+        with self._ledger_lock:
+            ledger = self._ledger(worker_id)
+            ledger.count(ledger.lines, (channel['upstream_id'], held), -1)
+
+    def adopt_line(self, worker_id, channel):
+        self.catalog.adopt_line(channel)
+        with self._ledger_lock:
+            ledger = self._ledger(worker_id)
+            ledger.count(ledger.lines, (channel['upstream_id'], True), -1)
+            ledger.count(ledger.lines, (channel['upstream_id'], False), 1)
+
+    def hold_line(self, worker_id, channel):
+        self.catalog.hold_line(channel)
+        with self._ledger_lock:
+            ledger = self._ledger(worker_id)
+            ledger.count(ledger.lines, (channel['upstream_id'], True), 1)
+
+    def report(self, worker_id, action, client, ua_string, url, line=True):
+        # Recorded under the lock as well, so that a settled worker's Ends never overtake its own reports
+        with self._ledger_lock:
+            self._ledger(worker_id).reported(action, client, ua_string, url, line)
+            self.reporter.report(action, client, ua_string, url, line)
+
+    def settle(self, worker_id):
+        """
+        Gives back the lines of a worker that is no longer alive and ends the sessions it left open with the manager,
+        before a worker with the same ID is started
+        """
+        with self._ledger_lock:
+            ledger = self.ledgers.pop(worker_id, None)
+            if ledger is None or not ledger.lines and not ledger.sessions:
+                return
+            logger.warning(f'WORKERS: Worker {worker_id} left {sum(ledger.lines.values())} line(s) and {sum(ledger.sessions.values())} session(s) behind, releasing them')
+            for (upstream_id, held), count in ledger.lines.items():
+                for _ in range(count):
+                    self.catalog.release_line({'upstream_id': upstream_id}, held)
+            for (client, ua_string, url), count in ledger.sessions.items():
+                for _ in range(count):
+                    line = ledger.session_lines.get(url, 0) > 0
+                    if line:
+                        ledger.count(ledger.session_lines, url, -1)
+                    self.reporter.report(_reportActionEnd, client, ua_string, url, line)
+
+    def start_workers(self, context):
+        """
+        Starts the missing workers of the current generation, restarting the ones that exited
+        """
+        for index in range(self.count):
+            worker_id = f'{self.generation}-{index}'
+            process = self.current.get(worker_id)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                logger.warning(f'WORKERS: Worker {worker_id} exited with {process.exitcode}, restarting')
+                self.ready.discard(worker_id)
+                self.clients.pop(worker_id, None)
+                self.settle(worker_id)
+            self.current[worker_id] = context.Process(target=self.target, args=(worker_id, self.control_dir, self.authkey), name=f'proxy-worker-{worker_id}', daemon=True)
+            self.current[worker_id].start()
+
+    def reload(self, context):
+        """
+        Starts a new generation of workers, the old one drains once all new workers listen
+        """
+        old = self.current
+        self.generation += 1
+        self.current = {}
+        logger.warning(f'WORKERS: Reloading, starting generation {self.generation}')
+        self.start_workers(context)
+        deadline = time.monotonic() + _ready_timeout
+        while not self.ready.issuperset(self.current) and time.monotonic() < deadline:
+            if any(not process.is_alive() for process in self.current.values()):
+                break
+            time.sleep(0.1)
+        if not self.ready.issuperset(self.current):
+            logger.error(f'WORKERS: Generation {self.generation} did not come up, keeping the running workers')
+            for worker_id, process in self.current.items():
+                process.kill()
+                process.join(_stop_timeout)
+                self.settle(worker_id)
+            self.current = old
+            self.generation -= 1
+            return
+        self.retired.update(old)
+        self.call_workers(old, 'drain', True)
+
+    def serve_forever(self):
+        self.control_dir = tempfile.mkdtemp(prefix='iptv-proxy-')
+        self.authkey = os.urandom(32)
+        broker = serve_calls(os.path.join(self.control_dir, _broker_name), self.authkey, {
+            'catalog': self.catalog.snapshot,
+            'reserve_line': self.reserve_line,
+            'release_line': self.release_line,
+            'adopt_line': self.adopt_line,
+            'hold_line': self.hold_line,
+            'report': self.report,
+            'metrics': metrics.collect,
+            'peers': self.addresses,
+            'ready': self.ready.add,
+            # The supervisor runs no sessions, it only answers so that workers can treat it like a peer
+            'cancel': lambda session_ids: ([], list(session_ids)),
+            'snapshot': lambda: [],
+        }, 'worker-broker')
+        # The supervisor's metrics cover the workers as well, e.g. for the heartbeats sent to the manager
+        metrics.add_peers(lambda: self.call_workers(list(self.current) + list(self.retired), 'metrics'))
+
+        # Spawned rather than forked, the supervisor already runs threads
+        context = multiprocessing.get_context('spawn')
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'requested', 'drain'))
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, 'requested', 'reload'))
+        logger.info(f'WORKERS: Starting {self.count} worker(s)')
+        try:
+            while True:
+                requested, self.requested = self.requested, None
+                if requested == 'reload' and not drain.draining:
+                    self.reload(context)
+                elif requested == 'drain' and not drain.draining:
+                    drain.begin()
+                    self.call_workers(list(self.current) + list(self.retired), 'drain', False)
+                    self.retired.update(self.current)
+                    self.current = {}
+                for worker_id, process in list(self.retired.items()):
+                    if not process.is_alive():
+                        logger.info(f'WORKERS: Worker {worker_id} drained')
+                        del self.retired[worker_id]
+                        self.ready.discard(worker_id)
+                        self.clients.pop(worker_id, None)
+                        # Left behind by a worker that was killed or died while draining
+                        self.settle(worker_id)
+                    elif drain.draining and time.monotonic() > drain.deadline + _stop_timeout * 2:
+                        logger.warning(f'WORKERS: Worker {worker_id} did not finish draining, killing it')
+                        process.kill()
+                if drain.draining:
+                    if not self.retired:
+                        break
+                else:
+                    self.start_workers(context)
+                time.sleep(_restart_delay)
+            if not self.reporter.flush(_stop_timeout * 6):
+                logger.error('WORKERS: Reports not shipped before exiting, the manager\'s line counts may be off')
+        finally:
+            for process in list(self.current.values()) + list(self.retired.values()):
+                process.kill()
+            for process in list(self.current.values()) + list(self.retired.values()):
+                process.join(_stop_timeout)
+            broker.close()
+            shutil.rmtree(self.control_dir, ignore_errors=True)
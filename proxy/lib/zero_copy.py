@@ -0,0 +1,84 @@
+import os
+import sys
+import fcntl
+import socket
+import asyncio
+import logging
+
+import settings
+from lib.http_client import wait_fd
+
+logger = logging.getLogger(__name__)
+
+# Fallbacks for Python builds that don't expose the Linux constants
+_TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', 25)
+_F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+def splice_supported():
+    return sys.platform.startswith('linux') and hasattr(os, 'splice')
+
+def tune_client_socket(sock):
+    """
+    Applies the socket options for live video clients: fixed send buffer, low unsent data watermark and no Nagle delay
+    """
+    if sock is None:
+        return
+    try:
+        if settings.client_send_buffer > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, settings.client_send_buffer)
+        if settings.client_notsent_lowat > 0 and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, _TCP_NOTSENT_LOWAT, settings.client_notsent_lowat)
+        if settings.client_nodelay and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as err:
+        logger.warning(f'ZERO_COPY: Could not tune client socket: {err}')
+
+async def splice_relay(upstream_sock, client_sock, remaining=None, session=None):
+    """
+    Moves the upstream body to the client inside the kernel (socket -> pipe -> socket), without Python buffers.
+    Returns the number of bytes relayed once the upstream ends, the session's byte count is kept up to date meanwhile.
+    """
+    loop = asyncio.get_running_loop()
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    upstream_fd = upstream_sock.fileno()
+    # The client socket is still registered with its asyncio transport, so wait on a duplicate of it
+    client_fd = os.dup(client_sock.fileno())
+    pipe_read, pipe_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+        fcntl.fcntl(pipe_write, _F_SETPIPE_SZ, settings.zero_copy_pipe_size)
+    except OSError as err:
+        logger.debug(f'ZERO_COPY: Could not resize pipe: {err}')
+
+    relayed = 0
+    in_pipe = 0
+    try:
+        while remaining is None or remaining > 0 or in_pipe > 0:
+            if in_pipe == 0:
+                count = settings.zero_copy_pipe_size if remaining is None else min(settings.zero_copy_pipe_size, remaining)
+                try:
+                    moved = os.splice(upstream_fd, pipe_write, count, flags=flags)
+                except BlockingIOError:
+                    await asyncio.wait_for(wait_fd(loop, upstream_fd), settings.stream_timeout)
+                    continue
+                if moved == 0:
+                    break
+                in_pipe += moved
+                if remaining is not None:
+                    remaining -= moved
+            try:
+                moved = os.splice(pipe_read, client_fd, in_pipe, flags=flags)
+            except BlockingIOError:
+                await wait_fd(loop, client_fd, writable=True)
+                continue
+            in_pipe -= moved
+            relayed += moved
+            if session is not None:
+                session.relayed(moved)
+                delay = session.throttle(moved)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+    finally:
+        os.close(pipe_read)
+        os.close(pipe_write)
+        os.close(client_fd)
+    return relayed
@@ -1,3 +1,4 @@
 #!/usr/bin/env bash
 
-python3 ./proxy.py
+# exec, so that stop signals reach the proxy and it can drain
+exec python3 ./proxy.py
@@ -0,0 +1,233 @@
+import os
+import logging
+
+# TODO: Respect log levels / debug parameter
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# General default settings
+__DEFAULT_DEBUG = True
+__DEFAULT_SOCKET_ADDRESS = '0.0.0.0'
+__DEFAULT_PROXY_MODE = 'flask'
+__DEFAULT_WORKERS = 1
+__DEFAULT_DRAIN_TIMEOUT = 120
+
+# Reporting default settings
+__DEFAULT_REPORTING_URL = 'http://localhost'
+__DEFAULT_REPORTING_PORT = 8088
+__DEFAULT_REPORTING_TIMEOUT = 5
+__DEFAULT_REPORT_BATCH_SIZE = 100
+__DEFAULT_REPORT_BATCH_DELAY = 200
+__DEFAULT_REPORT_QUEUE_SIZE = 10000
+__DEFAULT_REPORT_RETRY_INTERVAL = 5
+
+# Proxy registration default settings
+__DEFAULT_PROXY_NAME = 'IPTV-Proxy'
+__DEFAULT_INTERNAL_PROXY_URL = 'http://localhost'
+__DEFAULT_INTERNAL_PROXY_PORT = 8089
+__DEFAULT_EXTERNAL_PROXY_URL = 'http://localhost'
+__DEFAULT_EXTERNAL_PROXY_PORT = 8089
+__DEFAULT_HEARTBEAT_INTERVAL = 10
+__DEFAULT_EGRESS_CAPACITY = 0
+
+# Upstream connection default settings
+__DEFAULT_USER_AGENT_STRING = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36)'
+__DEFAULT_STREAM_TIMEOUT = 15
+__DEFAULT_HEDGE_DELAY = 1000
+__DEFAULT_STALL_TIMEOUT = 5
+__DEFAULT_STALL_RECONNECTS = 3
+__DEFAULT_DNS_CACHE_TTL = 60
+__DEFAULT_TLS_SESSION_CACHE = True
+__DEFAULT_MULTICAST_INTERFACE = ''
+__DEFAULT_MULTICAST_RECEIVE_BUFFER = 8388608
+
+# Relay default settings (asyncio mode)
+__DEFAULT_RELAY_CHUNK_SIZE = 65536
+__DEFAULT_SESSION_BUFFER_CHUNKS = 32
+__DEFAULT_LISTEN_BACKLOG = 1024
+__DEFAULT_SHARED_UPSTREAMS = True
+__DEFAULT_RING_BUFFER_SIZE = 8 * 1024 * 1024
+__DEFAULT_ZERO_COPY = False
+__DEFAULT_ZERO_COPY_PIPE_SIZE = 1024 * 1024
+__DEFAULT_CLIENT_SEND_BUFFER = 1024 * 1024
+__DEFAULT_CLIENT_NOTSENT_LOWAT = 128 * 1024
+__DEFAULT_CLIENT_NODELAY = True
+__DEFAULT_TIMESHIFT_SIZE = 0
+__DEFAULT_START_CACHE = True
+__DEFAULT_TIMESHIFT_DIR = '/tmp'
+
+# Rate limit default settings
+__DEFAULT_RATE_LIMIT_CLIENT = 0
+__DEFAULT_RATE_LIMIT_UPSTREAM = 0
+__DEFAULT_RATE_LIMIT_GLOBAL = 0
+__DEFAULT_RATE_LIMIT_BURST = 4
+
+# Channel catalog default settings
+__DEFAULT_PREWARM_CHANNELS = 0
+__DEFAULT_PREWARM_NEIGHBOURS = False
+__DEFAULT_PREWARM_NEIGHBOUR_TIMEOUT = 30
+__DEFAULT_PREWARM_SPARE_LINES = 1
+__DEFAULT_PREWARM_INTERVAL = 300
+__DEFAULT_LINGER_TIMEOUT = 0
+__DEFAULT_CATALOG_ENABLED = True
+__DEFAULT_CATALOG_REFRESH_INTERVAL = 10
+__DEFAULT_CATALOG_FULL_REFRESH_INTERVAL = 600
+__DEFAULT_ADMISSION_QUEUE_SIZE = 10
+__DEFAULT_ADMISSION_QUEUE_TIMEOUT = 10
+
+# HLS default settings (asyncio mode)
+__DEFAULT_HLS_CACHE_SIZE = 256 * 1024 * 1024
+__DEFAULT_HLS_SEGMENT_MAX_AGE = 60
+__DEFAULT_HLS_PLAYLIST_MAX_AGE = 1
+__DEFAULT_HLS_SESSION_TIMEOUT = 30
+__DEFAULT_UPSTREAM_POOL_SIZE = 4
+__DEFAULT_HLS_OUTPUT_SEGMENT_DURATION = 4
+__DEFAULT_HLS_OUTPUT_WINDOW = 6
+__DEFAULT_TS_ANALYZER_SAMPLE = 0
+
+debug = os.environ['DEBUG'].lower() == 'true' if 'DEBUG' in os.environ else __DEFAULT_DEBUG
+socket_address = os.environ['SOCKET_ADDRESS'] if 'SOCKET_ADDRESS' in os.environ else __DEFAULT_SOCKET_ADDRESS
+proxy_mode = os.environ['PROXY_MODE'].lower() if 'PROXY_MODE' in os.environ else __DEFAULT_PROXY_MODE
+workers = int(os.environ['WORKERS']) if 'WORKERS' in os.environ else __DEFAULT_WORKERS
+workers = workers if workers > 0 else os.cpu_count()
+drain_timeout = int(os.environ['DRAIN_TIMEOUT']) if 'DRAIN_TIMEOUT' in os.environ else __DEFAULT_DRAIN_TIMEOUT
+
+reporting_url = os.environ['REPORTING_URL'] if 'REPORTING_URL' in os.environ else __DEFAULT_REPORTING_URL
+reporting_port = int(os.environ['REPORTING_PORT']) if 'REPORTING_PORT' in os.environ else __DEFAULT_REPORTING_PORT
+reporting_timeout = int(os.environ['REPORTING_TIMEOUT']) if 'REPORTING_TIMEOUT' in os.environ else __DEFAULT_REPORTING_TIMEOUT
+report_batch_size = int(os.environ['REPORT_BATCH_SIZE']) if 'REPORT_BATCH_SIZE' in os.environ else __DEFAULT_REPORT_BATCH_SIZE
+report_batch_delay = int(os.environ['REPORT_BATCH_DELAY']) if 'REPORT_BATCH_DELAY' in os.environ else __DEFAULT_REPORT_BATCH_DELAY
+report_queue_size = int(os.environ['REPORT_QUEUE_SIZE']) if 'REPORT_QUEUE_SIZE' in os.environ else __DEFAULT_REPORT_QUEUE_SIZE
+report_retry_interval = int(os.environ['REPORT_RETRY_INTERVAL']) if 'REPORT_RETRY_INTERVAL' in os.environ else __DEFAULT_REPORT_RETRY_INTERVAL
+
+proxy_name = os.environ['PROXY_NAME'] if 'PROXY_NAME' in os.environ else __DEFAULT_PROXY_NAME
+internal_proxy_url = os.environ['INTERNAL_PROXY_URL'] if 'INTERNAL_PROXY_URL' in os.environ else __DEFAULT_INTERNAL_PROXY_URL
+internal_proxy_port = os.environ['INTERNAL_PROXY_PORT'] if 'INTERNAL_PROXY_PORT' in os.environ else __DEFAULT_INTERNAL_PROXY_PORT
+external_proxy_url = os.environ['EXTERNAL_PROXY_URL'] if 'EXTERNAL_PROXY_URL' in os.environ else __DEFAULT_EXTERNAL_PROXY_URL
+external_proxy_port = os.environ['EXTERNAL_PROXY_PORT'] if 'EXTERNAL_PROXY_PORT' in os.environ else __DEFAULT_EXTERNAL_PROXY_PORT
+heartbeat_interval = float(os.environ['HEARTBEAT_INTERVAL']) if 'HEARTBEAT_INTERVAL' in os.environ else __DEFAULT_HEARTBEAT_INTERVAL
+egress_capacity = float(os.environ['EGRESS_CAPACITY']) if 'EGRESS_CAPACITY' in os.environ else __DEFAULT_EGRESS_CAPACITY
+
+user_agent_string = os.environ['USER_AGENT_STRING'] if 'USER_AGENT_STRING' in os.environ else __DEFAULT_USER_AGENT_STRING
+stream_timeout = int(os.environ['STREAM_TIMEOUT']) if 'STREAM_TIMEOUT' in os.environ else __DEFAULT_STREAM_TIMEOUT
+hedge_delay = int(os.environ['HEDGE_DELAY']) if 'HEDGE_DELAY' in os.environ else __DEFAULT_HEDGE_DELAY
+stall_timeout = int(os.environ['STALL_TIMEOUT']) if 'STALL_TIMEOUT' in os.environ else __DEFAULT_STALL_TIMEOUT
+stall_reconnects = int(os.environ['STALL_RECONNECTS']) if 'STALL_RECONNECTS' in os.environ else __DEFAULT_STALL_RECONNECTS
+dns_cache_ttl = int(os.environ['DNS_CACHE_TTL']) if 'DNS_CACHE_TTL' in os.environ else __DEFAULT_DNS_CACHE_TTL
+tls_session_cache = os.environ['TLS_SESSION_CACHE'].lower() == 'true' if 'TLS_SESSION_CACHE' in os.environ else __DEFAULT_TLS_SESSION_CACHE
+multicast_interface = os.environ['MULTICAST_INTERFACE'] if 'MULTICAST_INTERFACE' in os.environ else __DEFAULT_MULTICAST_INTERFACE
+multicast_receive_buffer = int(os.environ['MULTICAST_RECEIVE_BUFFER']) if 'MULTICAST_RECEIVE_BUFFER' in os.environ else __DEFAULT_MULTICAST_RECEIVE_BUFFER
+
+relay_chunk_size = int(os.environ['RELAY_CHUNK_SIZE']) if 'RELAY_CHUNK_SIZE' in os.environ else __DEFAULT_RELAY_CHUNK_SIZE
+session_buffer_chunks = int(os.environ['SESSION_BUFFER_CHUNKS']) if 'SESSION_BUFFER_CHUNKS' in os.environ else __DEFAULT_SESSION_BUFFER_CHUNKS
+listen_backlog = int(os.environ['LISTEN_BACKLOG']) if 'LISTEN_BACKLOG' in os.environ else __DEFAULT_LISTEN_BACKLOG
+shared_upstreams = os.environ['SHARED_UPSTREAMS'].lower() == 'true' if 'SHARED_UPSTREAMS' in os.environ else __DEFAULT_SHARED_UPSTREAMS
+ring_buffer_size = int(os.environ['RING_BUFFER_SIZE']) if 'RING_BUFFER_SIZE' in os.environ else __DEFAULT_RING_BUFFER_SIZE
+zero_copy = os.environ['ZERO_COPY'].lower() == 'true' if 'ZERO_COPY' in os.environ else __DEFAULT_ZERO_COPY
+zero_copy_pipe_size = int(os.environ['ZERO_COPY_PIPE_SIZE']) if 'ZERO_COPY_PIPE_SIZE' in os.environ else __DEFAULT_ZERO_COPY_PIPE_SIZE
+client_send_buffer = int(os.environ['CLIENT_SEND_BUFFER']) if 'CLIENT_SEND_BUFFER' in os.environ else __DEFAULT_CLIENT_SEND_BUFFER
+client_notsent_lowat = int(os.environ['CLIENT_NOTSENT_LOWAT']) if 'CLIENT_NOTSENT_LOWAT' in os.environ else __DEFAULT_CLIENT_NOTSENT_LOWAT
+client_nodelay = os.environ['CLIENT_NODELAY'].lower() == 'true' if 'CLIENT_NODELAY' in os.environ else __DEFAULT_CLIENT_NODELAY
+start_cache = os.environ['START_CACHE'].lower() == 'true' if 'START_CACHE' in os.environ else __DEFAULT_START_CACHE
+timeshift_size = int(os.environ['TIMESHIFT_SIZE']) if 'TIMESHIFT_SIZE' in os.environ else __DEFAULT_TIMESHIFT_SIZE
+timeshift_dir = os.environ['TIMESHIFT_DIR'] if 'TIMESHIFT_DIR' in os.environ else __DEFAULT_TIMESHIFT_DIR
+
+rate_limit_client = int(os.environ['RATE_LIMIT_CLIENT']) if 'RATE_LIMIT_CLIENT' in os.environ else __DEFAULT_RATE_LIMIT_CLIENT
+rate_limit_upstream = int(os.environ['RATE_LIMIT_UPSTREAM']) if 'RATE_LIMIT_UPSTREAM' in os.environ else __DEFAULT_RATE_LIMIT_UPSTREAM
+rate_limit_global = int(os.environ['RATE_LIMIT_GLOBAL']) if 'RATE_LIMIT_GLOBAL' in os.environ else __DEFAULT_RATE_LIMIT_GLOBAL
+rate_limit_burst = float(os.environ['RATE_LIMIT_BURST']) if 'RATE_LIMIT_BURST' in os.environ else __DEFAULT_RATE_LIMIT_BURST
+
+prewarm_channels = int(os.environ['PREWARM_CHANNELS']) if 'PREWARM_CHANNELS' in os.environ else __DEFAULT_PREWARM_CHANNELS
+prewarm_neighbours = os.environ['PREWARM_NEIGHBOURS'].lower() == 'true' if 'PREWARM_NEIGHBOURS' in os.environ else __DEFAULT_PREWARM_NEIGHBOURS
+prewarm_neighbour_timeout = int(os.environ['PREWARM_NEIGHBOUR_TIMEOUT']) if 'PREWARM_NEIGHBOUR_TIMEOUT' in os.environ else __DEFAULT_PREWARM_NEIGHBOUR_TIMEOUT
+prewarm_spare_lines = int(os.environ['PREWARM_SPARE_LINES']) if 'PREWARM_SPARE_LINES' in os.environ else __DEFAULT_PREWARM_SPARE_LINES
+prewarm_interval = int(os.environ['PREWARM_INTERVAL']) if 'PREWARM_INTERVAL' in os.environ else __DEFAULT_PREWARM_INTERVAL
+linger_timeout = int(os.environ['LINGER_TIMEOUT']) if 'LINGER_TIMEOUT' in os.environ else __DEFAULT_LINGER_TIMEOUT
+catalog_enabled = os.environ['CATALOG_ENABLED'].lower() == 'true' if 'CATALOG_ENABLED' in os.environ else __DEFAULT_CATALOG_ENABLED
+catalog_refresh_interval = int(os.environ['CATALOG_REFRESH_INTERVAL']) if 'CATALOG_REFRESH_INTERVAL' in os.environ else __DEFAULT_CATALOG_REFRESH_INTERVAL
+catalog_full_refresh_interval = int(os.environ['CATALOG_FULL_REFRESH_INTERVAL']) if 'CATALOG_FULL_REFRESH_INTERVAL' in os.environ else __DEFAULT_CATALOG_FULL_REFRESH_INTERVAL
+admission_queue_size = int(os.environ['ADMISSION_QUEUE_SIZE']) if 'ADMISSION_QUEUE_SIZE' in os.environ else __DEFAULT_ADMISSION_QUEUE_SIZE
+admission_queue_timeout = int(os.environ['ADMISSION_QUEUE_TIMEOUT']) if 'ADMISSION_QUEUE_TIMEOUT' in os.environ else __DEFAULT_ADMISSION_QUEUE_TIMEOUT
+
+hls_cache_size = int(os.environ['HLS_CACHE_SIZE']) if 'HLS_CACHE_SIZE' in os.environ else __DEFAULT_HLS_CACHE_SIZE
+hls_segment_max_age = int(os.environ['HLS_SEGMENT_MAX_AGE']) if 'HLS_SEGMENT_MAX_AGE' in os.environ else __DEFAULT_HLS_SEGMENT_MAX_AGE
+hls_playlist_max_age = float(os.environ['HLS_PLAYLIST_MAX_AGE']) if 'HLS_PLAYLIST_MAX_AGE' in os.environ else __DEFAULT_HLS_PLAYLIST_MAX_AGE
+hls_session_timeout = int(os.environ['HLS_SESSION_TIMEOUT']) if 'HLS_SESSION_TIMEOUT' in os.environ else __DEFAULT_HLS_SESSION_TIMEOUT
+upstream_pool_size = int(os.environ['UPSTREAM_POOL_SIZE']) if 'UPSTREAM_POOL_SIZE' in os.environ else __DEFAULT_UPSTREAM_POOL_SIZE
+hls_output_segment_duration = int(os.environ['HLS_OUTPUT_SEGMENT_DURATION']) if 'HLS_OUTPUT_SEGMENT_DURATION' in os.environ else __DEFAULT_HLS_OUTPUT_SEGMENT_DURATION
+hls_output_window = int(os.environ['HLS_OUTPUT_WINDOW']) if 'HLS_OUTPUT_WINDOW' in os.environ else __DEFAULT_HLS_OUTPUT_WINDOW
+
+ts_analyzer_sample = int(os.environ['TS_ANALYZER_SAMPLE']) if 'TS_ANALYZER_SAMPLE' in os.environ else __DEFAULT_TS_ANALYZER_SAMPLE
+
+logger.info(f'DEBUG: {debug}')
+logger.info(f'SOCKET_ADDRESS: {socket_address}')
+logger.info(f'PROXY_MODE: {proxy_mode}')
+logger.info(f'WORKERS: {workers}')
+logger.info(f'DRAIN_TIMEOUT: {drain_timeout}')
+
+logger.info(f'REPORTING_URL: {reporting_url}')
+logger.info(f'REPORTING_PORT: {reporting_port}')
+logger.info(f'REPORTING_TIMEOUT: {reporting_timeout}')
+logger.info(f'REPORT_BATCH_SIZE: {report_batch_size}')
+logger.info(f'REPORT_BATCH_DELAY: {report_batch_delay}')
+logger.info(f'REPORT_QUEUE_SIZE: {report_queue_size}')
+logger.info(f'REPORT_RETRY_INTERVAL: {report_retry_interval}')
+
+logger.info(f'PROXY_NAME: {proxy_name}')
+logger.info(f'INTERNAL_PROXY_URL: {internal_proxy_url}')
+logger.info(f'INTERNAL_PROXY_PORT: {internal_proxy_port}')
+logger.info(f'EXTERNAL_PROXY_URL: {external_proxy_url}')
+logger.info(f'EXTERNAL_PROXY_PORT: {external_proxy_port}')
+logger.info(f'HEARTBEAT_INTERVAL: {heartbeat_interval}')
+logger.info(f'EGRESS_CAPACITY: {egress_capacity}')
+
+logger.info(f'USER_AGENT_STRING: {user_agent_string}')
+logger.info(f'STREAM_TIMEOUT: {stream_timeout}')
+logger.info(f'HEDGE_DELAY: {hedge_delay}')
+logger.info(f'STALL_TIMEOUT: {stall_timeout}')
+logger.info(f'STALL_RECONNECTS: {stall_reconnects}')
+logger.info(f'DNS_CACHE_TTL: {dns_cache_ttl}')
+logger.info(f'TLS_SESSION_CACHE: {tls_session_cache}')
+logger.info(f'MULTICAST_INTERFACE: {multicast_interface}')
+logger.info(f'MULTICAST_RECEIVE_BUFFER: {multicast_receive_buffer}')
+
+logger.info(f'RELAY_CHUNK_SIZE: {relay_chunk_size}')
+logger.info(f'SESSION_BUFFER_CHUNKS: {session_buffer_chunks}')
+logger.info(f'LISTEN_BACKLOG: {listen_backlog}')
+logger.info(f'SHARED_UPSTREAMS: {shared_upstreams}')
+logger.info(f'RING_BUFFER_SIZE: {ring_buffer_size}')
+logger.info(f'ZERO_COPY: {zero_copy}')
+logger.info(f'ZERO_COPY_PIPE_SIZE: {zero_copy_pipe_size}')
+logger.info(f'CLIENT_SEND_BUFFER: {client_send_buffer}')
+logger.info(f'CLIENT_NOTSENT_LOWAT: {client_notsent_lowat}')
+logger.info(f'CLIENT_NODELAY: {client_nodelay}')
+logger.info(f'START_CACHE: {start_cache}')
+logger.info(f'TIMESHIFT_SIZE: {timeshift_size}')
+logger.info(f'TIMESHIFT_DIR: {timeshift_dir}')
+
+logger.info(f'RATE_LIMIT_CLIENT: {rate_limit_client}')
+logger.info(f'RATE_LIMIT_UPSTREAM: {rate_limit_upstream}')
+logger.info(f'RATE_LIMIT_GLOBAL: {rate_limit_global}')
+logger.info(f'RATE_LIMIT_BURST: {rate_limit_burst}')
+
+logger.info(f'PREWARM_CHANNELS: {prewarm_channels}')
+logger.info(f'PREWARM_NEIGHBOURS: {prewarm_neighbours}')
+logger.info(f'PREWARM_NEIGHBOUR_TIMEOUT: {prewarm_neighbour_timeout}')
+logger.info(f'PREWARM_SPARE_LINES: {prewarm_spare_lines}')
+logger.info(f'PREWARM_INTERVAL: {prewarm_interval}')
+logger.info(f'LINGER_TIMEOUT: {linger_timeout}')
+logger.info(f'CATALOG_ENABLED: {catalog_enabled}')
+logger.info(f'CATALOG_REFRESH_INTERVAL: {catalog_refresh_interval}')
+logger.info(f'CATALOG_FULL_REFRESH_INTERVAL: {catalog_full_refresh_interval}')
+logger.info(f'ADMISSION_QUEUE_SIZE: {admission_queue_size}')
+logger.info(f'ADMISSION_QUEUE_TIMEOUT: {admission_queue_timeout}')
+
+logger.info(f'HLS_CACHE_SIZE: {hls_cache_size}')
+logger.info(f'HLS_SEGMENT_MAX_AGE: {hls_segment_max_age}')
+logger.info(f'HLS_PLAYLIST_MAX_AGE: {hls_playlist_max_age}')
+logger.info(f'HLS_SESSION_TIMEOUT: {hls_session_timeout}')
+logger.info(f'UPSTREAM_POOL_SIZE: {upstream_pool_size}')
+logger.info(f'HLS_OUTPUT_SEGMENT_DURATION: {hls_output_segment_duration}')
+logger.info(f'HLS_OUTPUT_WINDOW: {hls_output_window}')
+
+logger.info(f'TS_ANALYZER_SAMPLE: {ts_analyzer_sample}')
@@ -0,0 +1,132 @@
+import time
+import asyncio
+import threading
+
+import settings
+from lib.admission import AdmissionQueue, ThreadedAdmissionQueue
+
+import pytest
+
+@pytest.fixture(autouse=True)
+def queue_settings(monkeypatch):
+    monkeypatch.setattr(settings, 'admission_queue_size', 2)
+    monkeypatch.setattr(settings, 'admission_queue_timeout', 5)
+
+class Lines():
+    """
+    Free lines of an upstream playlist, reserved after delay seconds
+    """
+
+    def __init__(self, free=0):
+        self.free = free
+
+    def reserver(self, delay=0):
+        async def reserve():
+            await asyncio.sleep(delay)
+            return self.take()
+        return reserve
+
+    def take(self):
+        if self.free > 0:
+            self.free -= 1
+            return True
+        return False
+
+def test_admits_at_once_with_a_free_line():
+    admission = AdmissionQueue()
+    assert asyncio.run(admission.admit(1, Lines(1).reserver()))
+    assert admission.queues == {}
+
+def test_no_queue_when_disabled(monkeypatch):
+    monkeypatch.setattr(settings, 'admission_queue_size', 0)
+    assert not asyncio.run(AdmissionQueue().admit(1, Lines().reserver()))
+
+def test_released_line_goes_to_the_longest_waiting():
+    admission = AdmissionQueue()
+    lines = Lines()
+
+    async def scenario():
+        first = asyncio.create_task(admission.admit(1, lines.reserver()))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(admission.admit(1, lines.reserver()))
+        await asyncio.sleep(0.01)
+        assert len(admission.queues[1]) == 2
+        lines.free = 1
+        admission.released({'upstream_id': 1})
+        assert await asyncio.wait_for(first, 0.5)
+        assert not second.done()
+        lines.free = 1
+        admission.released({'upstream_id': 1})
+        assert await asyncio.wait_for(second, 0.5)
+
+    asyncio.run(scenario())
+    assert admission.queues == {}
+
+def test_full_queue_is_refused():
+    admission = AdmissionQueue()
+    lines = Lines()
+
+    async def scenario():
+        waiting = [asyncio.create_task(admission.admit(1, lines.reserver())) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        assert not await admission.admit(1, lines.reserver())
+        lines.free = 2
+        admission.released({'upstream_id': 1})
+        assert await asyncio.wait_for(asyncio.gather(*waiting), 0.5) == [True, True]
+
+    asyncio.run(scenario())
+
+def test_timeout(monkeypatch):
+    monkeypatch.setattr(settings, 'admission_queue_timeout', 0.05)
+    admission = AdmissionQueue()
+    assert not asyncio.run(admission.admit(1, Lines().reserver()))
+    assert admission.queues == {}
+
+def test_starts_queued_while_reserve_awaits_share_the_queue():
+    # A full catalog makes reserve() wait for the eviction of warm upstreams, meanwhile another start queues up
+    admission = AdmissionQueue()
+    lines = Lines()
+
+    async def scenario():
+        slow = asyncio.create_task(admission.admit(1, lines.reserver(0.1)))
+        await asyncio.sleep(0.01)
+        fast = asyncio.create_task(admission.admit(1, lines.reserver()))
+        await asyncio.sleep(0.2)
+        assert len(admission.queues[1]) == 2
+        lines.free = 1
+        admission.released({'upstream_id': 1})
+        # Well before the recheck interval, only a waiter in the queue released() looks at is woken that fast
+        assert await asyncio.wait_for(fast, 0.5)
+        assert not slow.done()
+        lines.free = 1
+        admission.released({'upstream_id': 1})
+        assert await asyncio.wait_for(slow, 0.5)
+
+    asyncio.run(scenario())
+    assert admission.queues == {}
+
+def test_threaded_released_line_goes_to_the_longest_waiting():
+    admission = ThreadedAdmissionQueue()
+    lines = Lines()
+    admitted = []
+
+    def start(name):
+        if admission.admit(1, lines.take):
+            admitted.append(name)
+
+    threads = []
+    for name in ('first', 'second'):
+        thread = threading.Thread(target=start, args=(name, ))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.05)
+    assert len(admission.queues[1]) == 2
+    assert not admission.admit(1, lines.take)
+    for _ in threads:
+        lines.free += 1
+        admission.released({'upstream_id': 1})
+        time.sleep(0.1)
+    for thread in threads:
+        thread.join(1)
+    assert admitted == ['first', 'second']
+    assert admission.queues == {}
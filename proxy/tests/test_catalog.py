@@ -0,0 +1,122 @@
+import base64
+
+import pytest
+
+from lib import catalog as catalog_module
+from lib.catalog import ChannelCatalog
+
+url = 'http://upstream/live.ts'
+stream_path = '/stream/start/' + base64.b64encode(url.encode('utf-8')).decode('ascii')
+
+class Manager():
+    """
+    The manager's catalog, in_use counts the lines of the session reports it applied
+    """
+
+    def __init__(self, max_conns=2):
+        self.in_use = 0
+        self.max_conns = max_conns
+        self.failing = False
+
+    def get_catalog(self, since=None):
+        if self.failing:
+            raise ConnectionError('manager down')
+        return {
+            'version': 1, 'full': since is None, 'channel_count': 1,
+            'upstreams': [{'id': 1, 'enabled': True, 'max_conns': self.max_conns, 'in_use': self.in_use, 'mirrors': None}],
+            'groups': [{'id': 3, 'enabled': True}],
+            'channels': [{'url': url, 'name': 'Live', 'tvg_id': '', 'extra_info': None, 'enabled': True, 'upstream_id': 1, 'group_title_id': 3}],
+        }
+
+    def apply(self, catalog, *actions):
+        # The manager applies the reports, the reporter hands them to the catalog once it acknowledged them
+        events = [{'action': action, 'url': stream_path, 'line': True} for action in actions]
+        for event in events:
+            self.in_use += 1 if event['action'] == 'Begin' else -1
+        catalog.acknowledge(events)
+
+@pytest.fixture
+def manager(monkeypatch):
+    manager = Manager()
+    monkeypatch.setattr(catalog_module, 'get_catalog', manager.get_catalog)
+    return manager
+
+@pytest.fixture
+def catalog(manager):
+    catalog = ChannelCatalog()
+    catalog.refresh()
+    return catalog
+
+def test_reserves_up_to_max_conns(catalog):
+    channel = catalog.lookup(url)
+    assert catalog.reserve_line(channel)
+    assert catalog.reserve_line(channel)
+    assert not catalog.reserve_line(channel)
+    catalog.release_line(channel)
+    assert catalog.reserve_line(channel)
+
+def test_acknowledged_lines_move_to_the_managers_count(manager, catalog):
+    channel = catalog.lookup(url)
+    assert catalog.reserve_line(channel)
+    manager.apply(catalog, 'Begin')
+    catalog.refresh()
+    assert catalog.reserved == {1: 0}
+    assert catalog.reserve_line(channel)
+    assert not catalog.reserve_line(channel)
+
+def test_refresh_keeps_lines_whose_reports_are_not_acknowledged(manager, catalog):
+    channel = catalog.lookup(url)
+    assert catalog.reserve_line(channel)
+    assert catalog.reserve_line(channel)
+    manager.apply(catalog, 'Begin')
+    # The second report is still queued or in flight, the manager's in_use doesn't contain it yet
+    catalog.refresh()
+    assert catalog.reserved == {1: 1}
+    assert not catalog.reserve_line(channel)
+
+def test_acknowledged_before_a_failed_refresh_count_at_the_next_one(manager, catalog):
+    channel = catalog.lookup(url)
+    assert catalog.reserve_line(channel)
+    manager.apply(catalog, 'Begin')
+    manager.failing = True
+    with pytest.raises(ConnectionError):
+        catalog.refresh()
+    manager.failing = False
+    catalog.refresh()
+    assert catalog.reserved == {1: 0}
+    assert catalog.reserve_line(channel)
+    assert not catalog.reserve_line(channel)
+
+def test_ended_sessions_free_their_lines(manager, catalog):
+    channel = catalog.lookup(url)
+    assert catalog.reserve_line(channel)
+    manager.apply(catalog, 'Begin')
+    catalog.refresh()
+    catalog.release_line(channel)
+    manager.apply(catalog, 'End')
+    catalog.refresh()
+    assert catalog.reserved == {1: 0}
+    assert manager.in_use == 0
+
+def test_held_lines_count_until_released_or_adopted(catalog):
+    channel = catalog.lookup(url)
+    assert catalog.reserve_line(channel, held=True)
+    catalog.hold_line(channel)
+    assert not catalog.reserve_line(channel)
+    catalog.release_line(channel, held=True)
+    catalog.adopt_line(channel)
+    assert catalog.held == {1: 0}
+    assert catalog.reserved == {1: 1}
+    assert catalog.reserve_line(channel)
+
+def test_spare_lines_are_left_free(catalog):
+    channel = catalog.lookup(url)
+    assert not catalog.reserve_line(channel, spare=2)
+    assert catalog.reserve_line(channel, spare=1)
+    assert not catalog.reserve_line(channel, spare=1)
+
+def test_disabled_channels_get_no_line(catalog):
+    channel = dict(catalog.lookup(url), enabled=False)
+    assert not catalog.reserve_line(channel)
+    catalog.groups[3] = False
+    assert not catalog.reserve_line(catalog.lookup(url))
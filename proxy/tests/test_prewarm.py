@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+import settings
+from lib.catalog import ChannelCatalog
+from lib.channel_hub import HubRegistry
+from lib.prewarm import Prewarmer
+
+@pytest.fixture(autouse=True)
+def prewarm_settings(monkeypatch):
+    monkeypatch.setattr(settings, 'ring_buffer_size', 188 * 64)
+    monkeypatch.setattr(settings, 'timeshift_size', 0)
+    monkeypatch.setattr(settings, 'ts_analyzer_sample', 0)
+    monkeypatch.setattr(settings, 'prewarm_spare_lines', 1)
+    monkeypatch.setattr(settings, 'prewarm_neighbours', True)
+    monkeypatch.setattr(settings, 'prewarm_neighbour_timeout', 30)
+    monkeypatch.setattr(settings, 'linger_timeout', 30)
+
+class Upstream():
+    """
+    An upstream that never sends, as one between two chunks
+    """
+
+    read_timeout = None
+    closed = False
+
+    async def read(self, size):
+        await asyncio.Event().wait()
+
+    def passthrough_headers(self):
+        return {}
+
+    def close(self):
+        self.closed = True
+
+def catalog(max_conns=3):
+    catalog = ChannelCatalog()
+    catalog.upstreams = {1: {'id': 1, 'enabled': True, 'max_conns': max_conns, 'in_use': 0}}
+    catalog.channels = {f'http://upstream/{name}.ts': {'url': f'http://upstream/{name}.ts', 'upstream_id': 1, 'group_title_id': 3, 'enabled': True} for name in 'abc'}
+    catalog.by_group = {3: list(catalog.channels)}
+    return catalog
+
+def prewarmer(catalog):
+    async def opener(channel):
+        return Upstream()
+    return Prewarmer(HubRegistry(), catalog, opener)
+
+def lines(catalog):
+    return catalog.reserved.get(1, 0), catalog.held.get(1, 0)
+
+def test_warm_lines_leave_the_spare_lines_free():
+    async def scenario():
+        channels = catalog(max_conns=3)
+        warmer = prewarmer(channels)
+        for url in channels.channels:
+            await warmer.warm_up(channels.lookup(url), 'popular')
+        assert list(warmer.warm) == ['http://upstream/a.ts', 'http://upstream/b.ts']
+        assert lines(channels) == (0, 2)
+
+    asyncio.run(scenario())
+
+def test_viewer_takes_over_a_warm_line():
+    async def scenario():
+        channels = catalog()
+        warmer = prewarmer(channels)
+        channel = channels.lookup('http://upstream/a.ts')
+        await warmer.warm_up(channel, 'popular')
+        hub, opened_line = await warmer.hubs.acquire(channel['url'], None)
+        assert opened_line
+        assert warmer.warm == {}
+        assert lines(channels) == (1, 0)
+
+    asyncio.run(scenario())
+
+def test_evict_gives_a_warm_line_back():
+    async def scenario():
+        channels = catalog()
+        warmer = prewarmer(channels)
+        await warmer.warm_up(channels.lookup('http://upstream/a.ts'), 'popular')
+        hub = warmer.warm['http://upstream/a.ts'][0]
+        assert warmer.evict(1)
+        assert hub.upstream.closed
+        assert lines(channels) == (0, 0)
+        assert not warmer.evict(1)
+
+    asyncio.run(scenario())
+
+def test_last_viewer_leaving_keeps_the_upstream_on_a_held_line():
+    async def scenario():
+        channels = catalog()
+        warmer = prewarmer(channels)
+        channel = channels.lookup('http://upstream/a.ts')
+        assert channels.reserve_line(channel)
+
+        async def opener():
+            upstream = Upstream()
+            upstream.source = channel
+            return upstream
+
+        hub, _ = await warmer.hubs.acquire(channel['url'], opener)
+        assert warmer.hubs.release(hub)
+        # The stream server releases the viewer's line, the hub goes on on the held one
+        channels.release_line(channel)
+        assert warmer.warm[channel['url']][2] == 'linger'
+        assert not hub.ended
+        assert lines(channels) == (0, 1)
+
+    asyncio.run(scenario())
+
+def test_zapping_warms_the_next_channel_in_the_direction():
+    async def scenario():
+        channels = catalog()
+        warmer = prewarmer(channels)
+        warmer.zapped('10.0.0.1', channels.lookup('http://upstream/a.ts'))
+        warmer.zapped('10.0.0.1', channels.lookup('http://upstream/b.ts'))
+        await asyncio.sleep(0.01)
+        return set(warmer.warm)
+
+    # b's neighbour a was warmed by the first zap, zapping on from a to b only warms c
+    assert asyncio.run(scenario()) == {'http://upstream/b.ts', 'http://upstream/c.ts'}
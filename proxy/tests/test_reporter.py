@@ -0,0 +1,34 @@
+import settings
+from lib import reporter as reporter_module
+from lib.reporter import SessionReporter
+
+import pytest
+
+@pytest.fixture(autouse=True)
+def report_settings(monkeypatch):
+    monkeypatch.setattr(settings, 'report_batch_size', 2)
+    monkeypatch.setattr(settings, 'report_batch_delay', 50)
+    monkeypatch.setattr(settings, 'report_retry_interval', 0.05)
+
+def test_ships_in_order_and_retries_until_acknowledged(monkeypatch):
+    shipped = []
+    failures = [ConnectionError('manager down')]
+
+    def send_report_batch(events):
+        if failures:
+            raise failures.pop()
+        shipped.append([event['seq'] for event in events])
+        return {'applied': len(events), 'last_seq': events[-1]['seq']}
+
+    monkeypatch.setattr(reporter_module, 'send_report_batch', send_report_batch)
+    reporter = SessionReporter()
+    acknowledged = []
+    reporter.on_acknowledged = acknowledged.append
+    for client in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+        reporter.report('Begin', client, 'VLC', '/stream/start/aHR0cDovL3Vwc3RyZWFtL2xpdmUudHM=')
+    reporter.start()
+    assert reporter.flush(5)
+
+    first = reporter.seq - 2
+    assert shipped == [[first, first + 1], [first + 2]]
+    assert [[event['client'] for event in batch] for batch in acknowledged] == [['10.0.0.1', '10.0.0.2'], ['10.0.0.3']]
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+import settings
+from lib.resolver import Resolver
+
+@pytest.fixture(autouse=True)
+def cache_settings(monkeypatch):
+    monkeypatch.setattr(settings, 'dns_cache_ttl', 60)
+
+class FakeResolver(Resolver):
+    """
+    Answers lookups with the next of addresses after a short delay, counting them
+    """
+
+    def __init__(self, *addresses):
+        super().__init__()
+        self.addresses = list(addresses)
+        self.lookups = 0
+
+    async def _lookup(self, host, port):
+        self.lookups += 1
+        await asyncio.sleep(0.01)
+        addresses = self.addresses.pop(0)
+        if isinstance(addresses, Exception):
+            raise addresses
+        return addresses
+
+def expire(resolver, host, port, ttls):
+    resolver.entries[(host, port)].resolved -= ttls * settings.dns_cache_ttl
+
+def test_concurrent_lookups_share_one_query():
+    resolver = FakeResolver(['10.0.0.1'])
+
+    async def scenario():
+        return await asyncio.gather(*(resolver.resolve('upstream', 80) for _ in range(3)))
+
+    assert asyncio.run(scenario()) == [['10.0.0.1']] * 3
+    assert resolver.lookups == 1
+
+def test_cached_until_the_ttl():
+    resolver = FakeResolver(['10.0.0.1'], ['10.0.0.2'])
+
+    async def scenario():
+        first = await resolver.resolve('upstream', 80)
+        second = await resolver.resolve('upstream', 80)
+        return first, second
+
+    assert asyncio.run(scenario()) == (['10.0.0.1'], ['10.0.0.1'])
+    assert resolver.lookups == 1
+
+def test_expired_entries_are_served_while_refreshing():
+    resolver = FakeResolver(['10.0.0.1'], ['10.0.0.2'])
+
+    async def scenario():
+        await resolver.resolve('upstream', 80)
+        expire(resolver, 'upstream', 80, 2)
+        stale = await resolver.resolve('upstream', 80)
+        await asyncio.sleep(0.05)
+        return stale, await resolver.resolve('upstream', 80)
+
+    assert asyncio.run(scenario()) == (['10.0.0.1'], ['10.0.0.2'])
+    assert resolver.lookups == 2
+
+def test_failed_refresh_keeps_the_addresses():
+    resolver = FakeResolver(['10.0.0.1'], OSError('resolver down'))
+
+    async def scenario():
+        await resolver.resolve('upstream', 80)
+        expire(resolver, 'upstream', 80, 2)
+        await resolver.resolve('upstream', 80)
+        await asyncio.sleep(0.05)
+        return await resolver.resolve('upstream', 80)
+
+    assert asyncio.run(scenario()) == ['10.0.0.1']
+
+def test_too_old_entries_are_looked_up_again():
+    resolver = FakeResolver(['10.0.0.1'], ['10.0.0.2'])
+
+    async def scenario():
+        await resolver.resolve('upstream', 80)
+        expire(resolver, 'upstream', 80, 20)
+        return await resolver.resolve('upstream', 80)
+
+    assert asyncio.run(scenario()) == ['10.0.0.2']
+
+def test_failed_lookup_is_not_cached():
+    resolver = FakeResolver(OSError('no such host'), ['10.0.0.1'])
+
+    async def scenario():
+        with pytest.raises(OSError):
+            await resolver.resolve('upstream', 80)
+        return await resolver.resolve('upstream', 80)
+
+    assert asyncio.run(scenario()) == ['10.0.0.1']
+
+def test_forget():
+    resolver = FakeResolver(['10.0.0.1'], ['10.0.0.2'])
+
+    async def scenario():
+        await resolver.resolve('upstream', 80)
+        resolver.forget('upstream', 80)
+        return await resolver.resolve('upstream', 80)
+
+    assert asyncio.run(scenario()) == ['10.0.0.2']
@@ -0,0 +1,48 @@
+import pytest
+
+import settings
+from lib.shaping import TokenBucket, ShapedFlow, Shaper
+
+def test_bucket_allows_the_burst_then_the_rate():
+    bucket = TokenBucket(1000, 3000)
+    assert bucket.take(3000, 10) == 0
+    # Chunks are never split, the debt is paid back by waiting
+    assert bucket.take(500, 10) == pytest.approx(0.5)
+    assert bucket.take(500, 11) == 0
+    assert bucket.tokens == pytest.approx(0)
+
+def test_bucket_refills_up_to_the_burst():
+    bucket = TokenBucket(1000, 3000)
+    bucket.take(3000, 10)
+    assert bucket.take(3000, 100) == 0
+    assert bucket.take(1000, 100) == pytest.approx(1)
+
+def test_bucket_ignores_time_going_backwards():
+    bucket = TokenBucket(1000, 1000)
+    bucket.take(1000, 10)
+    assert bucket.take(1000, 9) == pytest.approx(1)
+
+def test_flow_waits_for_the_most_limiting_bucket():
+    slow = TokenBucket(1000, 0)
+    fast = TokenBucket(4000, 0)
+    assert ShapedFlow([('client', slow), ('global', fast)]).take(2000) == pytest.approx(2, rel=0.01)
+
+def test_shaper_limits_by_client_and_upstream(monkeypatch):
+    monkeypatch.setattr(settings, 'rate_limit_global', 0)
+    monkeypatch.setattr(settings, 'rate_limit_client', 8)
+    monkeypatch.setattr(settings, 'rate_limit_upstream', 16)
+    monkeypatch.setattr(settings, 'rate_limit_burst', 2)
+    shaper = Shaper()
+    flow = shaper.flow('10.0.0.1', {'upstream_id': 1}, 'http://upstream/live.ts')
+    assert [scope for scope, _ in flow.buckets] == ['client', 'upstream']
+    assert flow.buckets[0][1].rate == 1000
+    assert flow.buckets[0][1].burst == 2000
+    # Sessions of the same client share its bucket, unknown channels are limited by upstream host
+    other = shaper.flow('10.0.0.1', None, 'http://other/live.ts')
+    assert other.buckets[0][1] is flow.buckets[0][1]
+    assert ('upstream', 'other') in shaper.buckets
+
+def test_shaper_without_limits(monkeypatch):
+    for name in ('rate_limit_global', 'rate_limit_client', 'rate_limit_upstream'):
+        monkeypatch.setattr(settings, name, 0)
+    assert Shaper().flow('10.0.0.1', None, 'http://upstream/live.ts') is None
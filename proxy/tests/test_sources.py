@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import settings
+from lib.sources import SourceStats, race
+
+@pytest.fixture(autouse=True)
+def hedge_settings(monkeypatch):
+    monkeypatch.setattr(settings, 'hedge_delay', 50)
+    monkeypatch.setattr(settings, 'stream_timeout', 15)
+
+def sources(*names):
+    return [{'url': f'http://{name}/live.ts'} for name in names]
+
+def attempts(delays, started):
+    """
+    An attempt that answers with its source's host after delays[host] seconds, or raises if that is an exception
+    """
+    async def attempt(source):
+        host = source['url'].split('/')[2]
+        started.append(host)
+        delay = delays[host]
+        if isinstance(delay, Exception):
+            raise delay
+        await asyncio.sleep(delay)
+        return host
+    return attempt
+
+def test_first_source_wins_within_the_hedge_delay():
+    started = []
+    assert asyncio.run(race(sources('a', 'b'), attempts({'a': 0.01, 'b': 0}, started), lambda result: None)) == 'a'
+    assert started == ['a']
+
+def test_slow_source_is_hedged():
+    started = []
+    discarded = []
+    assert asyncio.run(race(sources('a', 'b'), attempts({'a': 1, 'b': 0.01}, started), discarded.append)) == 'b'
+    assert started == ['a', 'b']
+    assert discarded == []
+
+def test_failed_source_moves_on_at_once():
+    started = []
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        begin = loop.time()
+        result = await race(sources('a', 'b'), attempts({'a': ConnectionError('refused'), 'b': 0}, started), lambda result: None)
+        return result, loop.time() - begin
+
+    result, elapsed = asyncio.run(scenario())
+    assert result == 'b'
+    assert elapsed < settings.hedge_delay / 1000
+
+def test_all_failing_raises():
+    with pytest.raises(ConnectionError):
+        asyncio.run(race(sources('a', 'b'), attempts({'a': ConnectionError('a'), 'b': ConnectionError('b')}, []), lambda result: None))
+
+def test_results_of_cancelled_attempts_are_discarded():
+    discarded = []
+
+    async def attempt(source):
+        if source['url'] == 'http://a/live.ts':
+            await asyncio.sleep(0.1)
+            return 'a'
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            # Connected just as it was cancelled, the caller must close it
+            return 'b'
+
+    assert asyncio.run(race(sources('a', 'b'), attempt, discarded.append)) == 'a'
+    assert discarded == ['b']
+
+def test_sources_ordered_by_latency():
+    stats = SourceStats()
+    stats.observe('http://fast/live.ts', 0.01)
+    stats.failed('http://down/live.ts')
+    ordered = stats.order(sources('down', 'new', 'fast'))
+    assert [source['url'].split('/')[2] for source in ordered] == ['fast', 'new', 'down']
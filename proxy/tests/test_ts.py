@@ -0,0 +1,36 @@
+from lib.ts import TS_PACKET_SIZE, SYNC_BYTE, PacketAligner, find_sync
+
+def packets(count, pid=0x100):
+    return b''.join(bytes([SYNC_BYTE, pid >> 8, pid & 0xff, 0x10 | index % 16]) + bytes(TS_PACKET_SIZE - 4) for index in range(count))
+
+def test_find_sync_needs_consecutive_sync_bytes():
+    data = b'\x47garbage' + packets(4)
+    assert find_sync(data) == 8
+    # Too short to see the next packet, the first sync byte is taken
+    assert find_sync(packets(1)[:100]) == 0
+    assert find_sync(bytes(400)) is None
+
+def test_aligner_passes_whole_packets_only():
+    aligner = PacketAligner()
+    stream = packets(10)
+    out = b''
+    for start in range(0, len(stream), 500):
+        chunk = bytes(aligner.feed(stream[start:start + 500]))
+        assert len(chunk) % TS_PACKET_SIZE == 0
+        out += chunk
+    assert out == stream
+
+def test_aligner_continues_a_new_connection_at_its_first_packet():
+    aligner = PacketAligner()
+    first = bytes(aligner.feed(packets(3)[:400]))
+    aligner.restart()
+    # The new connection's response starts mid-packet, e.g. a resumed range
+    second = bytes(aligner.feed(packets(3)[50:] + packets(2)))
+    out = first + second
+    assert len(out) % TS_PACKET_SIZE == 0
+    assert all(out[offset] == SYNC_BYTE for offset in range(0, len(out), TS_PACKET_SIZE))
+
+def test_aligner_leaves_other_streams_alone():
+    aligner = PacketAligner()
+    assert aligner.feed(b'\x00\x00\x01\xba rest') == b'\x00\x00\x01\xba rest'
+    assert aligner.feed(b'odd') == b'odd'
@@ -0,0 +1,48 @@
+from lib.catalog import ChannelCatalog
+from lib.workers import WorkerSupervisor
+
+class Reporter():
+
+    def __init__(self):
+        self.events = []
+
+    def report(self, action, client, ua_string, url, line=True):
+        self.events.append((action, client, url, line))
+
+def catalog():
+    catalog = ChannelCatalog()
+    catalog.upstreams = {1: {'id': 1, 'enabled': True, 'max_conns': 2, 'in_use': 0}}
+    return catalog
+
+channel = {'url': 'http://upstream/live.ts', 'upstream_id': 1, 'group_title_id': 3, 'enabled': True}
+
+def test_settle_gives_back_a_dead_workers_lines_and_ends_its_sessions():
+    reporter = Reporter()
+    supervisor = WorkerSupervisor(2, catalog(), reporter, None)
+    assert supervisor.reserve_line('0-0', channel)
+    supervisor.report('0-0', 'Begin', '10.0.0.1', '', '/stream/start/live', True)
+    supervisor.report('0-0', 'Begin', '10.0.0.2', '', '/stream/start/live', False)
+    supervisor.hold_line('0-0', channel)
+    assert not supervisor.reserve_line('0-1', channel)
+
+    supervisor.settle('0-0')
+    assert supervisor.catalog.reserved == {1: 0}
+    assert supervisor.catalog.held == {1: 0}
+    # One of the sessions opened the line, so one End closes it
+    assert reporter.events[2:] == [('End', '10.0.0.1', '/stream/start/live', True), ('End', '10.0.0.2', '/stream/start/live', False)]
+    assert supervisor.reserve_line('0-1', channel)
+
+def test_settle_leaves_what_a_worker_gave_back():
+    reporter = Reporter()
+    supervisor = WorkerSupervisor(1, catalog(), reporter, None)
+    assert supervisor.reserve_line('0-0', channel, held=True)
+    supervisor.adopt_line('0-0', channel)
+    supervisor.report('0-0', 'Begin', '10.0.0.1', '', '/stream/start/live', True)
+    supervisor.report('0-0', 'End', '10.0.0.1', '', '/stream/start/live', True)
+    supervisor.release_line('0-0', channel)
+
+    supervisor.settle('0-0')
+    assert supervisor.catalog.reserved == {1: 0}
+    assert supervisor.catalog.held == {1: 0}
+    assert len(reporter.events) == 2
+    assert supervisor.ledgers == {}
@@ -0,0 +1,85 @@
+import socket
+import asyncio
+
+import pytest
+
+from lib.stream_server import AsyncStreamServer
+from lib.zero_copy import splice_relay, splice_supported
+
+pytestmark = pytest.mark.skipif(not splice_supported(), reason='splice() is not available')
+
+class Upstream():
+    """
+    The raw upstream response a zero-copy relay reads the body of
+    """
+
+    url = 'http://upstream/live.ts'
+
+    def __init__(self, sock, remaining):
+        self.sock = sock
+        self.remaining = remaining
+
+def test_splice_relay_moves_the_body():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        upstream, upstream_peer = socket.socketpair()
+        client, client_peer = socket.socketpair()
+        for sock in (upstream, upstream_peer, client, client_peer):
+            sock.setblocking(False)
+        body = bytes(range(256)) * 4096
+        received = bytearray()
+
+        async def receive():
+            while chunk := await loop.sock_recv(client_peer, 65536):
+                received.extend(chunk)
+
+        feeder = asyncio.ensure_future(loop.sock_sendall(upstream_peer, body + b'beyond the body'))
+        receiver = asyncio.ensure_future(receive())
+        relayed = await splice_relay(upstream, client, len(body))
+        client.close()
+        await receiver
+        feeder.cancel()
+        return relayed, bytes(received), body
+
+    relayed, received, body = asyncio.run(scenario())
+    assert relayed == len(body)
+    assert received == body
+
+def test_response_head_reaches_the_client_before_the_body():
+    # Below the transport's high-water mark, so that drain() alone doesn't wait for it
+    head = b'H' * (48 * 1024)
+    body = b'B' * (1024 * 1024)
+
+    async def scenario():
+        relayed = asyncio.get_running_loop().create_future()
+
+        async def handle(reader, writer):
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            upstream, upstream_peer = socket.socketpair()
+            upstream.setblocking(False)
+            upstream_peer.setblocking(False)
+            feeder = asyncio.ensure_future(asyncio.get_running_loop().sock_sendall(upstream_peer, body))
+            # More than the socket takes while the client doesn't read, part of the head waits in the transport's buffer
+            writer.write(head)
+            # Only the relay's own methods are used, no server state
+            await AsyncStreamServer.__new__(AsyncStreamServer).relay_zero_copy(reader, writer, Upstream(upstream, len(body)), None)
+            await feeder
+            writer.close()
+            relayed.set_result(True)
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(('127.0.0.1', port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await asyncio.sleep(0.2)  # Let the head back up
+        received = await asyncio.wait_for(reader.read(-1), 10)
+        await asyncio.wait_for(relayed, 10)
+        writer.close()
+        server.close()
+        return received
+
+    received = asyncio.run(scenario())
+    assert len(received) == len(head) + len(body)
+    assert received.find(b'B') == len(head)